@@ -0,0 +1,244 @@
+import numpy as np
+import mmdata.animation.solvers as solvers
+from mmdata.animation.geometry import Geometry
+from mmdata.animation.skeleton import Skeleton, SkeletonPose
+from mmdata.animation.skinning import SkinningEngine
+from mmdata.animation.animation_clip import AnimationClip, FramePose, ResampledClip
+from mmdata.animation.clip_sampler import ClipSampler
+
+
+class PoseState:
+    """
+    Everything that changes when a model is posed: bone transforms, bone matrices and morph influences.
+    A PoseState belongs to one caller at a time, e.g. one per thread.
+    """
+    def __init__(
+            self, n_bones: int, n_morphs: int, skeleton_pose: SkeletonPose = None, bone_matrices: np.ndarray = None,
+            influences: np.ndarray = None, ik_history: solvers.IkHistory = None):
+        """
+        :param n_bones:
+        :param n_morphs:
+        :param skeleton_pose: arrays to pose into, new ones are created if None
+        :param bone_matrices: (B, 4, 4) float32
+        :param influences: (M,)
+        :param ik_history: if given, IK is warm-started from the previous pose of this state
+        """
+        self.skeleton_pose = skeleton_pose if skeleton_pose is not None else SkeletonPose(n_bones)
+        self.bone_matrices = bone_matrices if bone_matrices is not None else np.zeros([n_bones, 4, 4], dtype=np.float32)
+        self.influences = influences if influences is not None else np.zeros([n_morphs])
+        self.ik_history = ik_history
+        # timestamps <= 0 mean the rest pose
+        self.timestamp = None
+        # CCD iterations and world matrices computed for the last solved pose
+        self.ik_iterations = 0
+        self.matrix_updates = 0
+
+
+class AnimatedModel:
+    """
+    AnimatedModel is a PMX model bound to an animation clip, which is never modified while posing.
+    All per-frame data is written into a PoseState, so one AnimatedModel can pose many frames concurrently,
+    e.g. from a thread pool, without locks and without copying the model.
+    """
+    def __init__(
+            self, geometry: Geometry, skeleton: Skeleton, animation: AnimationClip, sampler: ClipSampler = None,
+            analytic_ik=False, ik_tolerance: float = None, ik_warm_start=False):
+        """
+        :param geometry:
+        :param skeleton:
+        :param animation: clip bound to skeleton
+        :param sampler: sampler of animation, a new one is created if None
+        :param analytic_ik: solve two-bone IK chains in closed form, see IkSolver
+        :param ik_tolerance: effector distance at which CCD stops, see IkSolver
+        :param ik_warm_start: pose states warm-start IK from their previous pose, for coherent sequences of frames
+        """
+        self.geometry = geometry
+        self.skeleton = skeleton
+        self.animation = animation
+        self.sampler = sampler if sampler is not None else ClipSampler(animation, skeleton, geometry)
+        self.skinning = SkinningEngine(geometry.skin_indices, geometry.skin_weights)
+        self.ik_solver = solvers.IkSolver(skeleton, geometry.iks, analytic_ik, ik_tolerance)
+        self.grant_solver = solvers.GrantSolver(skeleton, geometry.grants)
+        self.ik_warm_start = ik_warm_start
+
+    def create_pose_state(self) -> PoseState:
+        state = PoseState(len(self.skeleton.bones), len(self.geometry.morph_targets), ik_history=self.create_ik_history())
+        self.rest_pose(state)
+        return state
+
+    def create_ik_history(self):
+        return solvers.IkHistory() if self.ik_warm_start else None
+
+    def rest_pose(self, state: PoseState) -> PoseState:
+        self.skeleton.rest_pose(state.skeleton_pose, state.bone_matrices)
+        state.influences[...] = 0.0
+        state.timestamp = 0.0
+        state.ik_iterations = 0
+        state.matrix_updates = 0
+        if state.ik_history is not None:
+            state.ik_history.reset()
+        return state
+
+    def pose(self, timestamp: float, state: PoseState = None) -> PoseState:
+        """
+        :param timestamp: of VMD
+        :param state: where the pose is written, a new one is created if None
+        :return: state
+        """
+        state = self.create_pose_state() if state is None else state
+
+        if timestamp > 0.0:
+            # ClipSampler does not keep any state, unlike the curve caches of AnimationClip.evaluate
+            poses, influences = self.sampler.sample(np.array([timestamp], dtype=np.float64))
+            self.pose_with_arrays(poses[0], influences[0], state)
+        else:
+            self.rest_pose(state)
+        state.timestamp = float(timestamp)
+        return state
+
+    def pose_with_arrays(self, pose: np.ndarray, influences: np.ndarray, state: PoseState) -> PoseState:
+        """
+        :param pose: (B, 7) positions and quaternions of all bones, see ClipSampler
+        :param influences: (M,) influences of all morphs
+        :param state:
+        :return: state
+        """
+        skeleton_pose = state.skeleton_pose
+        self.skeleton.rest_pose(skeleton_pose, state.bone_matrices)
+        skeleton_pose.positions[...] = pose[:, :3]
+        skeleton_pose.quaternions[...] = pose[:, 3:]
+        state.influences[...] = influences
+        state.timestamp = None
+        self.solve(state)
+        return state
+
+    def pose_skeleton(self, pose: np.ndarray, state: PoseState) -> PoseState:
+        """
+        Solve the skeleton only: no bone matrices, morph influences are left as they are.
+        :param pose: (B, 7) positions and quaternions of all bones, see ClipSampler
+        :param state:
+        :return: state
+        """
+        skeleton_pose = state.skeleton_pose
+        self.skeleton.rest_pose(skeleton_pose, state.bone_matrices)
+        skeleton_pose.positions[...] = pose[:, :3]
+        skeleton_pose.quaternions[...] = pose[:, 3:]
+        state.timestamp = None
+        self.solve(state, with_bone_matrices=False)
+        return state
+
+    def pose_frame(self, frame_pose: FramePose, state: PoseState) -> PoseState:
+        """
+        :param frame_pose: pose of the bound tracks, see AnimationClip.evaluate
+        :param state:
+        :return: state
+        """
+        binding = self.animation.binding
+        skeleton_pose = state.skeleton_pose
+        self.skeleton.rest_pose(skeleton_pose, state.bone_matrices)
+        skeleton_pose.positions[binding.bone_indices] = frame_pose.positions
+        skeleton_pose.quaternions[binding.bone_indices] = frame_pose.quaternions
+        state.influences[...] = 0.0
+        state.influences[binding.morph_indices] = frame_pose.influences
+        state.timestamp = None
+        self.solve(state)
+        return state
+
+    def pose_resampled(self, resampled: ResampledClip, index: int, state: PoseState, with_bone_matrices=True) -> PoseState:
+        """
+        Pose a frame of a resampled clip, IK and grants are skipped if they are already applied.
+        :param resampled: clip of this model, see resample
+        :param index: frame index
+        :param state:
+        :param with_bone_matrices: update the bone matrices for skinning too
+        :return: state
+        """
+        positions, quaternions, influences = resampled.get_frame(index)
+        skeleton_pose = state.skeleton_pose
+        self.skeleton.rest_pose(skeleton_pose, state.bone_matrices)
+        skeleton_pose.positions[...] = positions
+        skeleton_pose.quaternions[...] = quaternions
+        state.influences[...] = influences
+        state.timestamp = None
+
+        if not resampled.ik_applied:
+            self.solve(state, with_bone_matrices)
+            return state
+
+        skeleton_pose.matrix_updates = 0
+        self.skeleton.update_matrix_world(skeleton_pose)
+        if with_bone_matrices:
+            self.skeleton.update_bone_matrices(skeleton_pose, state.bone_matrices)
+        state.ik_iterations = 0
+        state.matrix_updates = skeleton_pose.matrix_updates
+        return state
+
+    def resample(self, fps: float, duration: float = None, apply_ik=True, batch_size=1024) -> ResampledClip:
+        """
+        :param fps: frames per second
+        :param duration: default is the duration of the clip
+        :param apply_ik: solve IK and grants into the resampled bone transforms
+        :param batch_size: number of frames sampled together
+        :return: resampled clip of this model
+        """
+        if not apply_ik:
+            return self.animation.resample(fps, self.sampler, duration, batch_size)
+        state = self.create_pose_state()
+
+        def solve(poses: np.ndarray, timestamps: np.ndarray):
+            for i in range(0, timestamps.shape[0]):
+                self.pose_skeleton(poses[i], state)
+                poses[i, :, :3] = state.skeleton_pose.positions
+                poses[i, :, 3:] = state.skeleton_pose.quaternions
+            return
+        return self.animation.resample(fps, self.sampler, duration, batch_size, solve)
+
+    def solve(self, state: PoseState, with_bone_matrices=True):
+        """
+        Forward kinematics, then IK and grants, then forward kinematics again.
+        :param state:
+        :param with_bone_matrices: update the bone matrices for skinning too
+        """
+        skeleton_pose = state.skeleton_pose
+        skeleton_pose.matrix_updates = 0
+        self.skeleton.update_matrix_world(skeleton_pose)
+        state.ik_iterations = self.ik_solver.update(skeleton_pose, state.ik_history)
+        self.grant_solver.update(skeleton_pose)
+        # only bones below the ones that IK and grants have rotated
+        self.skeleton.update_stale_matrix_world(skeleton_pose)
+        state.matrix_updates = skeleton_pose.matrix_updates
+        if with_bone_matrices:
+            self.skeleton.update_bone_matrices(skeleton_pose, state.bone_matrices)
+        return
+
+    def get_vertices(self, state: PoseState, out: np.ndarray = None) -> np.ndarray:
+        """
+        :param state:
+        :param out: (V, 3) buffer to write into, a new one is created if None
+        :return: (V, 3) posed vertices, rest vertices for the rest pose
+        """
+        if state.timestamp is not None and state.timestamp <= 0.0:
+            if out is None:
+                return self.geometry.vertices.copy()
+            out[...] = self.geometry.vertices
+            return out
+
+        # bone deformation, then morph deformation
+        vertices = self.skinning.skin(self.geometry.vertices, state.bone_matrices, out)
+        vertices += self.geometry.get_morph_offsets(state.influences)
+        vertices[:, 1] = vertices[:, 1] - 10.0
+        return vertices
+
+    def get_bone_vertices(self, state: PoseState) -> [dict]:
+        return self.skeleton.get_bone_vertices(state.skeleton_pose)
+
+    def get_joints(self, state: PoseState, joint_indices: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        :param state:
+        :param joint_indices: (J,) bone indices, see Skeleton.get_joint_indices
+        :param out: (J, 3) buffer to write into, a new one is created if None
+        :return: (J, 3) world positions of the joints, same as get_bone_vertices
+        """
+        out = np.empty([joint_indices.shape[0], 3]) if out is None else out
+        out[...] = state.skeleton_pose.matrix_world[joint_indices, :3, 3]
+        return out
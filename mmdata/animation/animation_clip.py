@@ -1,9 +1,11 @@
 import numpy as np
-from typing import List
-from mmdata.animation.animation_track import AnimationTrack, SkeletalTrack, MorphTrack
-from mmdata.animation.interpolation import BezierInterpolationMethod
+from typing import List, Union
+from mmdata.animation.animation_track import AnimationTrack, SkeletalTrack
+from mmdata.animation.interpolation import BezierInterpolationMethod, BezierCurveCache
 from mmdata.animation.geometry import Geometry
+from mmdata.animation.motion import Motion
 from mmdata.animation.skeleton import Skeleton
+from mmdata.utils.mmd_reader import VmdData
 
 
 class FramePoseData:
@@ -36,31 +38,192 @@ class FramePoseData:
         return
 
 
+class FramePose:
+    """
+    FramePose is a preallocated buffer of pose arrays for one timestamp of VMD.
+    Rows follow the order of PoseBinding.
+    """
+    def __init__(self, n_bones: int, n_morphs: int):
+        self.positions = np.zeros([n_bones, 3])
+        self.quaternions = np.zeros([n_bones, 4])
+        self.quaternions[:, 3] = 1.0
+        self.influences = np.zeros([n_morphs])
+
+
+class PoseBinding:
+    """
+    PoseBinding is the compiled link between tracks and the skeleton bones / morphs they drive.
+    The k-th position and rotation tracks drive the bone bone_indices[k].
+    The k-th morph track drives the morph morph_indices[k].
+    """
+    def __init__(
+            self, bone_indices: np.ndarray, position_tracks: List[AnimationTrack], rotation_tracks: List[AnimationTrack],
+            morph_indices: np.ndarray, morph_tracks: List[AnimationTrack]):
+        assert bone_indices.shape[0] == len(position_tracks) == len(rotation_tracks)
+        assert morph_indices.shape[0] == len(morph_tracks)
+        self.bone_indices = bone_indices
+        self.position_tracks = position_tracks
+        self.rotation_tracks = rotation_tracks
+        self.morph_indices = morph_indices
+        self.morph_tracks = morph_tracks
+
+    def create_frame_pose(self) -> FramePose:
+        return FramePose(self.bone_indices.shape[0], self.morph_indices.shape[0])
+
+
+class ClipCursor:
+    """
+    ClipCursor remembers the keyframe position of every track of a clip during sequential playback.
+    A cursor belongs to one playback, the clip itself is not modified.
+    """
+    def __init__(self):
+        self.indices = dict()
+
+    def locate(self, track: AnimationTrack, t: float) -> int:
+        """
+        :param track:
+        :param t: timestamp
+        :return: index of the first keyframe of track after t
+        """
+        key = id(track)
+        index = track.locate(t, self.indices.get(key, 0))
+        self.indices[key] = index
+        return index
+
+
+class ResampledClip:
+    """
+    ResampledClip is a clip sampled at a fixed frame rate into dense float32 arrays, frame i is at timestamp i / fps.
+    Rows cover all bones and morphs of the model, so a frame is a plain array slice.
+    If ik_applied, IK and grants are already solved into the bone transforms.
+    """
+    def __init__(
+            self, fps: float, positions: np.ndarray, quaternions: np.ndarray, influences: np.ndarray, ik_applied=False):
+        """
+        :param fps: frames per second
+        :param positions: (T, B, 3)
+        :param quaternions: (T, B, 4)
+        :param influences: (T, M)
+        :param ik_applied:
+        """
+        assert positions.shape[0] == quaternions.shape[0] == influences.shape[0]
+        self.fps = fps
+        self.positions = positions
+        self.quaternions = quaternions
+        self.influences = influences
+        self.ik_applied = ik_applied
+
+    @property
+    def n_frames(self) -> int:
+        return self.positions.shape[0]
+
+    def find_frame_index(self, timestamp: float) -> Union[int, None]:
+        """
+        :param timestamp:
+        :return: index of the frame, frames after the end of the clip hold its last pose.
+            None if timestamp is not a multiple of 1 / fps
+        """
+        index = int(round(timestamp * self.fps))
+        if abs(index / self.fps - timestamp) > 1e-6:
+            return None
+        return min(max(index, 0), self.n_frames - 1)
+
+    def get_frame_index(self, timestamp: float) -> int:
+        """
+        :param timestamp: must be a multiple of 1 / fps
+        :return: index of the frame, frames after the end of the clip hold its last pose
+        """
+        index = self.find_frame_index(timestamp)
+        if index is None:
+            raise ValueError(f"Timestamp {timestamp} is not a frame at {self.fps} fps")
+        return index
+
+    def get_frame(self, index: int):
+        """
+        :param index:
+        :return: positions (B, 3), quaternions (B, 4) and influences (M,) of the frame, views into the arrays
+        """
+        return self.positions[index], self.quaternions[index], self.influences[index]
+
+
 class AnimationClip:
     """
     Animation sequence that a VMD file describes.
     """
-    def __init__(self, tracks: List[AnimationTrack]):
+    def __init__(self, tracks: List[AnimationTrack], binding: PoseBinding = None):
         self.tracks = tracks
+        self.binding = binding
+
+    @staticmethod
+    def __sample(track: AnimationTrack, t: float, cursor: ClipCursor = None) -> np.ndarray:
+        if cursor is None:
+            return track.sample(t)
+        return track.sample(t, cursor.locate(track, t))
+
+    def evaluate(self, t: float, frame_pose: FramePose = None, cursor: ClipCursor = None) -> FramePose:
+        """
+        Sample all bound tracks directly into pose arrays.
+        :param t: timestamp
+        :param frame_pose: buffer to write into, a new one is created if None
+        :param cursor: keyframe positions of a sequential playback, keyframes are searched from scratch if None
+        :return: current pose
+        """
+        binding = self.binding
+        if frame_pose is None:
+            frame_pose = binding.create_frame_pose()
+
+        for k, track in enumerate(binding.position_tracks):
+            frame_pose.positions[k] = self.__sample(track, t, cursor)
+        for k, track in enumerate(binding.rotation_tracks):
+            frame_pose.quaternions[k] = self.__sample(track, t, cursor)
+        for k, track in enumerate(binding.morph_tracks):
+            frame_pose.influences[k] = self.__sample(track, t, cursor)
+        return frame_pose
+
+    def get_duration(self) -> float:
+        """
+        :return: timestamp of the last keyframe
+        """
+        return max([float(track.times[-1]) for track in self.tracks if track.times.shape[0] > 0], default=0.0)
+
+    def resample(self, fps: float, sampler, duration: float = None, batch_size=1024, solve=None) -> ResampledClip:
+        """
+        Sample the clip at every frame of a fixed frame rate.
+        :param fps: frames per second
+        :param sampler: ClipSampler of this clip
+        :param duration: default is the duration of the clip
+        :param batch_size: number of frames sampled together
+        :param solve: if given, called with the poses (T, B, 7) and timestamps (T,) of each batch to modify the poses,
+        e.g. to apply IK, the clip is then marked as ik_applied
+        :return: resampled clip
+        """
+        duration = self.get_duration() if duration is None else duration
+        n_frames = int(np.floor(duration * fps + 1e-9)) + 1
+        timestamps = np.arange(0, n_frames) / fps
+        positions = np.empty([n_frames, sampler.rest_positions.shape[0], 3], dtype=np.float32)
+        quaternions = np.empty([n_frames, sampler.rest_positions.shape[0], 4], dtype=np.float32)
+        influences = np.empty([n_frames, sampler.n_morphs], dtype=np.float32)
+
+        for start in range(0, n_frames, batch_size):
+            batch_timestamps = timestamps[start:(start + batch_size)]
+            poses, batch_influences = sampler.sample(batch_timestamps)
+            if solve is not None:
+                solve(poses, batch_timestamps)
+            positions[start:(start + batch_size)] = poses[:, :, :3]
+            quaternions[start:(start + batch_size)] = poses[:, :, 3:]
+            influences[start:(start + batch_size)] = batch_influences
+        return ResampledClip(fps, positions, quaternions, influences, solve is not None)
 
-    def get_frame_pose_data(self, t: float) -> FramePoseData:
+    def get_frame_pose_data(self, t: float, cursor: ClipCursor = None) -> FramePoseData:
         """
         :param t: timestamp
+        :param cursor: keyframe positions of a sequential playback, keyframes are searched from scratch if None
         :return: current pose
         """
         frame_interpolation = dict()
 
         for track in self.tracks:
-            times_bigger_than_t = track.times > t
-            bigger_index = np.where(times_bigger_than_t)[0]
-            bigger_index = -1 if bigger_index.shape[0] == 0 else bigger_index[0]
-
-            if bigger_index == -1:
-                # get last element since frame timestamp is bigger than the whole track
-                # no interpolation needed
-                frame_interpolation[track.name] = track.values[bigger_index]
-                continue
-            frame_interpolation[track.name] = track.get_value(bigger_index - 1, bigger_index, t)
+            frame_interpolation[track.name] = self.__sample(track, t, cursor)
 
         # convert to VPD
         return FramePoseData(frame_interpolation)
@@ -69,117 +232,79 @@ class AnimationClip:
 class AnimationClipBuilder:
     def __init__(self):
         # only Bezier is supported at the moment
-        self.interpolation_method = BezierInterpolationMethod()
+        self.interpolation_method = BezierInterpolationMethod(cache=BezierCurveCache())
         self.tracks: [AnimationTrack] = []
+        self.bone_indices: [int] = []
+        self.position_tracks: [AnimationTrack] = []
+        self.rotation_tracks: [AnimationTrack] = []
+        self.morph_indices: [int] = []
+        self.morph_tracks: [AnimationTrack] = []
 
     def reset(self):
         self.tracks = []
+        self.bone_indices = []
+        self.position_tracks = []
+        self.rotation_tracks = []
+        self.morph_indices = []
+        self.morph_tracks = []
 
-    def __build_skeletal_animation(self, vmd, skeleton: Skeleton):
+    def __build_skeletal_animation(self, motion: Motion, skeleton: Skeleton):
         """
-        :param vmd:
+        :param motion:
         :param skeleton:
         """
-        bones = skeleton.bones
-        bone_dict_name = dict()
-        motions = dict()
         tracks = []
 
-        # list existing bones
-        for bone in bones:
-            bone_dict_name[bone.name] = True
-
-        # group by name
-        for motion in vmd.motions:
-            if bone_dict_name.get(motion.name, False):
-                if motion.name not in motions:
-                    motions[motion.name] = []
-                motions[motion.name].append(motion)
-
-        # loop by name
-        for bone_name, bone_motions in motions.items():
-            bone_motions = sorted(bone_motions, key=lambda x: x.frame)
-            base_position = skeleton.bone_by_name[bone_name].position
-
-            times = []
-            positions = []
-            rotations = []
-            p_interpolations = []
-            r_interpolations = []
-
-            for step_bone_motion in bone_motions:
-                pos, q = step_bone_motion.pos, step_bone_motion.q
-                interpolation = step_bone_motion.complement
-                times.append(step_bone_motion.frame / 30)
-                positions.append(np.array([pos.x, pos.y, -pos.z]) + base_position)
-                rotations.append(np.array([q.x, -q.y, q.z, q.w]))
-
-                for int_index in range(0, 4):
-                    if int_index < 3:
-                        p_interpolations.append(np.array([
-                            interpolation[int_index + 0] / 127, interpolation[int_index + 8] / 127,
-                            interpolation[int_index + 4] / 127, interpolation[int_index + 12] / 127,
-                        ]))
-                    else:
-                        r_interpolations.append(np.array([
-                            interpolation[int_index + 0] / 127, interpolation[int_index + 8] / 127,
-                            interpolation[int_index + 4] / 127, interpolation[int_index + 12] / 127,
-                        ]))
-
-            times = np.array(times)
-            positions = np.stack(positions, axis=0)
-            rotations = np.stack(rotations, axis=0)
-            p_interpolations = np.stack(p_interpolations, axis=0)
-            r_interpolations = np.stack(r_interpolations, axis=0)
-
-            # example name: ".bones[センター].quaternion"
-            key_name = f".bones[{bone_name}]"
-            tracks.append(SkeletalTrack(f"{key_name}.position", times, positions, p_interpolations, self.interpolation_method))
-            tracks.append(SkeletalTrack(f"{key_name}.quaternion", times, rotations, r_interpolations, self.interpolation_method))
+        for bone_name, bone_index, rotation_track in motion.bind_bones([bone.name for bone in skeleton.bones]):
+            keyframes = motion.bone_keyframes[bone_name]
+            # positions are relative to the rest pose of this skeleton
+            positions = keyframes.positions + skeleton.rest.positions[bone_index]
+            position_track = SkeletalTrack(
+                f".bones[{bone_name}].position", keyframes.times, positions, keyframes.position_interpolations,
+                motion.interpolation_method)
+            tracks += [position_track, rotation_track]
+
+            self.bone_indices.append(bone_index)
+            self.position_tracks.append(position_track)
+            self.rotation_tracks.append(rotation_track)
         self.tracks += tracks
 
-    def __build_morph_animation(self, vmd, geometry: Geometry):
+    def __build_morph_animation(self, motion: Motion, geometry: Geometry):
         """
-        :param vmd:
+        :param motion:
         :param geometry:
         """
         tracks = []
-        morphs = dict()
-
-        # group by name
-        for vmd_morph in vmd.shapes:
-            if vmd_morph.name in geometry.morph_target_dict:
-                if vmd_morph.name not in morphs:
-                    morphs[vmd_morph.name] = []
-                morphs[vmd_morph.name].append(vmd_morph)
-
-        # loop by name
-        for morph_name, morph_motions in morphs.items():
-            morph_motions = sorted(morph_motions, key=lambda x: x.frame)
-
-            times = []
-            values = []
-
-            for step_morph_motion in morph_motions:
-                times.append(step_morph_motion.frame / 30)
-                values.append(step_morph_motion.ratio)
 
-            times = np.array(times)
-            values = np.array(values)
-
-            tracks.append(MorphTrack(
-                f".morphTargetInfluences[{geometry.morph_target_dict[morph_name]}]",
-                times, values))
+        for morph_index, morph_track in motion.bind_morphs([params["name"] for params in geometry.morph_targets]):
+            tracks.append(morph_track)
+            self.morph_indices.append(morph_index)
+            self.morph_tracks.append(morph_track)
         self.tracks += tracks
 
-    def from_vmd_and_skeleton(self, vmd, geometry: Geometry, skeleton: Skeleton):
+    def from_vmd_and_skeleton(self, vmd: Union[VmdData, Motion, object], geometry: Geometry, skeleton: Skeleton):
         """
-        :param vmd:
+        :param vmd: VmdData, Motion, or a motion that pymeshio.vmd.reader has read
         :param geometry:
         :param skeleton:
         :return: animation clip corresponding to VMD file
         """
+        if not isinstance(vmd, Motion):
+            vmd = Motion(vmd, self.interpolation_method)
+        return self.from_motion(vmd, geometry, skeleton)
+
+    def from_motion(self, motion: Motion, geometry: Geometry, skeleton: Skeleton):
+        """
+        :param motion: parsed VMD file, which may be shared between models
+        :param geometry:
+        :param skeleton:
+        :return: animation clip of the motion bound to the model
+        """
         self.reset()
-        self.__build_skeletal_animation(vmd, skeleton)
-        self.__build_morph_animation(vmd, geometry)
-        return AnimationClip(self.tracks)
+        self.__build_skeletal_animation(motion, skeleton)
+        self.__build_morph_animation(motion, geometry)
+
+        binding = PoseBinding(
+            np.array(self.bone_indices, dtype=np.int64), self.position_tracks, self.rotation_tracks,
+            np.array(self.morph_indices, dtype=np.int64), self.morph_tracks)
+        return AnimationClip(self.tracks, binding)
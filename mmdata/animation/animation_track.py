@@ -10,6 +10,42 @@ class AnimationTrack(ABC):
         self.times = times
         self.values = values
 
+    def locate(self, t: float, hint: int = 0) -> int:
+        """
+        Find the first keyframe after t, scanning forward from a previous result.
+        Sequential playback therefore takes amortized O(1), going backward falls back to a binary search.
+        :param t: timestamp
+        :param hint: result for an earlier timestamp
+        :return: index of the first keyframe whose time is bigger than t, number of keyframes if there is none
+        """
+        times = self.times
+        index = min(max(hint, 0), times.shape[0])
+
+        if index > 0 and times[index - 1] > t:
+            return int(np.searchsorted(times, t, side="right"))
+        while index < times.shape[0] and times[index] <= t:
+            index += 1
+        return index
+
+    def sample(self, t: float, bigger_index: int = None) -> np.ndarray:
+        """
+        Find the keyframes around t and interpolate them.
+        :param t: timestamp
+        :param bigger_index: result of locate(t), it is searched if None
+        :return: value
+        """
+        if bigger_index is None:
+            bigger_index = np.where(self.times > t)[0]
+            bigger_index = -1 if bigger_index.shape[0] == 0 else bigger_index[0]
+        elif bigger_index >= self.times.shape[0]:
+            bigger_index = -1
+
+        if bigger_index == -1:
+            # get last element since frame timestamp is bigger than the whole track
+            # no interpolation needed
+            return self.values[bigger_index]
+        return self.get_value(bigger_index - 1, bigger_index, t)
+
     @abstractmethod
     def get_value(self, start_index: int, end_index: int, t: float) -> np.ndarray:
         """
@@ -43,28 +79,17 @@ class SkeletalTrack(AnimationTrack):
         :return: times, values, interpolations
         """
         if times.shape[0] > 2:
-            times = times.copy()
-            values = values.copy()
-            interpolations = interpolations.copy()
-
             interp_stride = interpolations.shape[0] // times.shape[0]
-            index = 1
-            # skip any frame that has similar value to its previous and next frame
+            flat_values = values.reshape([times.shape[0], -1])
 
-            for ahead_index in range(2, times.shape[0]):
-                if np.any(values[index] != values[index - 1]) or np.any(values[index] != values[ahead_index]):
-                    index += 1
-
-                if ahead_index > index:
-                    times[index] = times[ahead_index]
-                    values[index] = values[ahead_index]
-
-                    for i in range(0, interp_stride):
-                        interpolations[index * interp_stride + i] = interpolations[ahead_index * interp_stride + i]
+            # skip any frame that has similar value to its previous and next frame
+            # so a run of equal frames keeps only its first and last frame
+            keep = np.ones([times.shape[0]], dtype=bool)
+            keep[1:-1] = np.any(flat_values[1:-1] != flat_values[:-2], axis=1) | np.any(flat_values[1:-1] != flat_values[2:], axis=1)
 
-            times = times[:(index + 1)]
-            values = values[:(index + 1)]
-            interpolations = interpolations[:((index + 1) * interp_stride)]
+            times = times[keep]
+            values = values[keep]
+            interpolations = interpolations[np.repeat(keep, interp_stride)]
         return times, values, interpolations
 
     def get_value(self, start_index: int, end_index: int, t: float):
@@ -1,32 +1,26 @@
 import os
 import pathlib
 import json
+import shutil
 import numpy as np
-import pymeshio.pmx.reader
-import pymeshio.vmd.reader
-import mmdata.animation.solvers as solvers
+import mmdata.utils.mmd_reader as mmd_reader
 import mmdata.utils.pmx_utils as pmx_utils
+from mmdata.utils.posed_mesh import PosedMesh, POSED_MESH_EXTENSION
 
 from typing import Union
 from PIL import Image, ImageOps
 from mmdata.animation.geometry import Geometry
+from mmdata.animation.model_cache import ModelCache
+from mmdata.animation.motion import Motion, MotionCache
 from mmdata.animation.skeleton import Skeleton
-from mmdata.animation.animation_clip import AnimationClipBuilder, FramePoseData
-from mmdata.utils import quaternion_utils
+from mmdata.animation.animation_clip import AnimationClipBuilder, ClipCursor, ResampledClip
+from mmdata.animation.animated_model import AnimatedModel, PoseState
+from mmdata.animation.clip_sampler import ClipSampler
+from mmdata.animation.clip_cache import ClipCache
 
 
-def get_default_weight(deform, j: int):
-    """
-    Get weight if there is not any info.
-    :param deform:
-    :param j:
-    :return: weight
-    """
-    if j == 0:
-        return 1.0
-    elif j == 1 and hasattr(deform, "weight0"):
-        return 1.0 - deform.weight0
-    return 0.0
+# OBJ, binary posed mesh (see PosedMesh), or both
+MESH_FORMATS = ["obj", "pmesh", "both"]
 
 
 class Animator:
@@ -34,92 +28,70 @@ class Animator:
     Animator takes in a PMX file and a VMD file.
     Given a timestamp, it poses the PMX model with the current VMD pose.
     """
-    def __init__(self, pmx_path: Union[str, pathlib.Path], vmd_path: Union[str, pathlib.Path]):
+    def __init__(
+            self, pmx_path: Union[str, pathlib.Path], vmd_path: Union[str, pathlib.Path],
+            model_cache: ModelCache = None, motion_cache: MotionCache = None, analytic_ik=False, ik_tolerance: float = None,
+            ik_warm_start=False):
+        """
+        :param pmx_path:
+        :param vmd_path:
+        :param model_cache: if given, the compiled model is loaded from the cache instead of parsing the PMX file,
+            then pmx is None
+        :param motion_cache: if given, the parsed VMD file is shared with other Animators of the same cache
+        :param analytic_ik: solve two-bone IK chains, e.g. legs, in closed form instead of CCD
+        :param ik_tolerance: effector distance at which CCD stops early, None runs all iterations of the PMX model
+        :param ik_warm_start: start IK from the previous frame, for coherent sequences, e.g. iter_frames and compute_joints
+        """
         self.character_dir = os.path.dirname(pmx_path)
         self.character_name = os.path.basename(self.character_dir).replace(" ", "_")
+        self.analytic_ik = analytic_ik
+        self.ik_tolerance = ik_tolerance
+        self.ik_warm_start = ik_warm_start
         # build skeleton
-        self.pmx = pymeshio.pmx.reader.read_from_file(pmx_path)
-        self.geometry = Geometry(self.pmx)
+        if model_cache is not None:
+            self.pmx = None
+            self.geometry = model_cache.load_or_build(pmx_path)
+        else:
+            self.pmx = mmd_reader.read_pmx(pmx_path)
+            self.geometry = Geometry(self.pmx)
         self.skeleton = Skeleton(*self.geometry.get_bone_hierarchy())
+        self.bind_motion(vmd_path, motion_cache)
 
-        # read animation clip
-        vmd = pymeshio.vmd.reader.read_from_file(vmd_path)
-        self.animation = AnimationClipBuilder().from_vmd_and_skeleton(vmd, self.geometry, self.skeleton)
+    def bind_motion(self, vmd_path: Union[str, pathlib.Path], motion_cache: MotionCache = None):
+        """
+        Switch to another VMD file, the model is neither parsed nor built again, e.g. to go through many motions of a model.
+        :param vmd_path:
+        :param motion_cache: if given, the parsed VMD file is shared with other Animators of the same cache
+        """
+        self.vmd_path = vmd_path
 
-    def __pose_skeleton_in_frame(self, pose_data: FramePoseData, accumulative=False):
-        bone_name_dict = dict()
-        self.skeleton.rest_pose()
+        # read animation clip
+        if motion_cache is not None:
+            motion = motion_cache.load(vmd_path)
+        else:
+            motion = Motion(mmd_reader.read_vmd(vmd_path))
+        self.animation = AnimationClipBuilder().from_motion(motion, self.geometry, self.skeleton)
+        self.sampler = ClipSampler(self.animation, self.skeleton, self.geometry)
 
-        for bone_index, bone in enumerate(self.skeleton.bones):
-            bone_name_dict[bone.name] = bone_index
+        # posing never modifies the model, the pose of this Animator lives in the arrays of its skeleton
+        self.model = AnimatedModel(
+            self.geometry, self.skeleton, self.animation, self.sampler, self.analytic_ik, self.ik_tolerance,
+            self.ik_warm_start)
+        self.skinning = self.model.skinning
+        self.pose_state = PoseState(
+            len(self.skeleton.bones), len(self.geometry.morph_targets),
+            self.skeleton.pose, self.skeleton.bone_matrices, self.geometry.morph_target_influences,
+            self.model.create_ik_history())
+        # CCD iterations of each frame of the last compute_joints
+        self.ik_iterations = np.zeros([0], dtype=np.int64)
+        return
 
-        for pose_bone_name, pose in pose_data.poses.items():
-            if isinstance(pose_bone_name, int):
-                self.geometry.morph_target_influences[pose_bone_name] = pose["influence"]
-            else:
-                bone_index = bone_name_dict.get(pose_bone_name, None)
-                if bone_index is not None:
-                    bone = self.skeleton.bones[bone_index]
-                    if accumulative:
-                        bone.position = bone.position + pose["pos"]
-                        bone.quaternion = quaternion_utils.multiply_quaternions(bone.quaternion, pose["q"])
-                    else:
-                        bone.position = pose["pos"]
-                        bone.quaternion = pose["q"]
-
-        # AnimationMixer has looping properties
-        # If t > max_t, t = t - max_t
-        # However, even without looping, somehow q.x = -q.x
-        self.skeleton.update_matrix_world()
-        self.skeleton.update_bone_matrices()
-
-        ik_solver = solvers.IkSolver(self.skeleton, self.geometry.iks)
-        ik_solver.update()
-        grant_solver = solvers.GrantSolver(self.skeleton, self.geometry.grants)
-        grant_solver.update()
-
-        self.skeleton.update_matrix_world()
-        self.skeleton.update_bone_matrices()
-
-    def __pose_vertices_with_skeleton(self, vertices: np.ndarray):
-        bone_matrices = self.skeleton.bone_matrices
-        morph_target_influences = self.geometry.morph_target_influences
-        morph_positions = self.geometry.morph_positions
-
-        for i in range(0, vertices.shape[0]):
-            vertex = vertices[i, :]
-            vertex = np.concatenate([vertex, [1.0]], axis=0).reshape([1, 4])
-            deform = self.pmx.vertices[i].deform
-
-            # bone deformation
-            deform_indices = [getattr(deform, f"index{j}", 0.0) for j in range(0, 4)]
-            deform_weights = [getattr(deform, f"weight{j}", get_default_weight(deform, j)) for j in range(0, 4)]
-            skinned_vertex = np.zeros_like(vertex)
-
-            for j in range(0, 4):
-                si, sw = int(deform_indices[j]), deform_weights[j]
-                bone_matrix = bone_matrices[si].transpose()
-                warped_vertex = np.matmul(vertex, bone_matrix) * sw
-                skinned_vertex += warped_vertex
-
-            # morph deformation
-            morphed_vertex = np.zeros_like(vertices[i, :])
-
-            for morph_index, morph_target in enumerate(morph_positions):
-                influence = morph_target_influences[morph_index]
-
-                if influence > 0.0:
-                    target = morph_target["array"][i, :]
-                    morphed_vertex += (target - vertices[i, :]) * influence
-
-            # output
-            skinned_vertex[0, :3] += morphed_vertex
-            vertices[i, :] = skinned_vertex[0, :3]
-
-        vertices[:, 1] = vertices[:, 1] - 10.0
-        return vertices
-
-    def copy_textures(self, texture_names: [str], output_dir: Union[str, pathlib.Path]):
+    def copy_textures(self, texture_names: [str], output_dir: Union[str, pathlib.Path], source_dir: Union[str, pathlib.Path] = None):
+        """
+        :param texture_names: texture paths relative to the PMX file
+        :param output_dir:
+        :param source_dir: directory where flipped textures were already written, if any
+        """
         visited_textures = set()
         for texture_name in texture_names:
             texture_path = os.path.join(self.character_dir, texture_name)
@@ -127,38 +99,230 @@ class Animator:
 
             if os.path.exists(texture_path) and (texture_path not in visited_textures):
                 visited_textures.add(texture_path)
+                new_texture_path = os.path.join(output_dir, texture_basename.replace(" ", "_"))
+
+                if source_dir is not None:
+                    shutil.copyfile(os.path.join(source_dir, texture_basename.replace(" ", "_")), new_texture_path)
+                    continue
                 texture_image = Image.open(texture_path)
                 texture_image = ImageOps.flip(texture_image)
-                new_texture_path = os.path.join(output_dir, texture_basename.replace(" ", "_"))
                 texture_image.save(new_texture_path, quality=100)
         return
 
-    def animate(self, timestamp: float, output_dir: Union[str, pathlib.Path]):
-        """
-        Build a OBJ that represents the PMX model in current pose.
-        :param timestamp: of VMD
-        :param output_dir: where OBJ and textures are stored
-        :return: mesh in OBJ format and textures
-        """
-        vertices = self.geometry.vertices.copy()
-        # capture model in animation
-        if timestamp > 0.0:
-            frame_pose_data = self.animation.get_frame_pose_data(timestamp)
-            self.__pose_skeleton_in_frame(frame_pose_data, accumulative=False)
-            vertices = self.__pose_vertices_with_skeleton(vertices)
+    def __write_frame(
+            self, vertices: np.ndarray, bone_vertices: [dict], output_dir: Union[str, pathlib.Path],
+            texture_dir: Union[str, pathlib.Path] = None, mesh_format="obj") -> dict:
+        # no mesh file for None, the mesh is handed over in memory
+        if mesh_format is not None and mesh_format not in MESH_FORMATS:
+            raise ValueError(f"Invalid mesh format: {mesh_format}")
+        mat_dict, mtl_output, texture_names = pmx_utils.pmx_to_mtl(self.geometry)
 
         # write object mesh
-        obj_content = pmx_utils.pmx_to_obj(self.pmx, self.geometry, vertices)
-        with open(os.path.join(output_dir, f"{self.character_name}.obj"), "w+") as file:
-            file.write(obj_content)
+        if mesh_format in ["obj", "both"]:
+            with open(os.path.join(output_dir, f"{self.character_name}.obj"), "w+") as file:
+                pmx_utils.write_obj(self.geometry, vertices, file)
+        if mesh_format in ["pmesh", "both"]:
+            posed_mesh = PosedMesh.from_geometry(self.geometry, vertices, mat_dict)
+            posed_mesh.save(os.path.join(output_dir, f"{self.character_name}{POSED_MESH_EXTENSION}"))
 
         # write bone
-        bone_vertices = self.skeleton.get_bone_vertices()
         json.dump(bone_vertices, open(os.path.join(output_dir, "bone_vertices.json"), "w+", encoding="utf-8"), indent=4, ensure_ascii=False)
 
         # write materials
-        mat_dict, mtl_output, texture_names = pmx_utils.pmx_to_mtl(self.pmx)
         with open(os.path.join(output_dir, "material.mtl"), "w+") as file:
             file.write(mtl_output)
-        self.copy_textures(texture_names, output_dir)
+        self.copy_textures(texture_names, output_dir, texture_dir)
         json.dump(mat_dict, open(os.path.join(output_dir, "material.json"), "w+", encoding="utf-8"), indent=4, ensure_ascii=False)
+        return mat_dict
+
+    def animate(self, timestamp: float, output_dir: Union[str, pathlib.Path], mesh_format="obj"):
+        """
+        Build a OBJ that represents the PMX model in current pose.
+        :param timestamp: of VMD
+        :param output_dir: where OBJ and textures are stored
+        :param mesh_format: "obj", "pmesh" for the binary PosedMesh, or "both"
+        :return: mesh in OBJ format and textures
+        """
+        # capture model in animation
+        state = self.model.pose(timestamp, self.pose_state)
+        self.__write_frame(
+            self.model.get_vertices(state), self.model.get_bone_vertices(state), output_dir, mesh_format=mesh_format)
+
+    def count_frames(self, start: float, stop: float, fps: float = 30.0) -> int:
+        """
+        :param start: first timestamp
+        :param stop: end timestamp, excluded
+        :param fps: frames per second
+        :return: number of frames that iter_frames yields
+        """
+        # tolerance, so that e.g. 0:1 at 30 fps is exactly 30 frames
+        return max(0, int(np.ceil((stop - start) * fps - 1e-9)))
+
+    def load_resampled(self, fps: float, clip_cache: ClipCache = None, apply_ik=True) -> ResampledClip:
+        """
+        :param fps: frames per second
+        :param clip_cache: if given, the resampled clip is loaded from the cache, or resampled and cached
+        :param apply_ik: IK-applied or IK-free variant
+        :return: clip resampled at fps
+        """
+        if clip_cache is None:
+            return self.model.resample(fps, apply_ik=apply_ik)
+        return clip_cache.load_or_build(self.vmd_path, self.model, fps, apply_ik)
+
+    def iter_frames(self, start: float, stop: float, fps: float = 30.0, resampled: ResampledClip = None):
+        """
+        Pose the model frame by frame at timestamps start + i / fps, lazily.
+        Keyframes are located with cursors that move forward with the playback, so a frame costs the same
+        whatever the length of the motion. All buffers are allocated once, memory does not grow with the number of frames.
+        Yielded arrays are overwritten by the next frame, copy them to keep them.
+        :param start: first timestamp
+        :param stop: end timestamp, excluded
+        :param fps: frames per second
+        :param resampled: if given, poses of its frames are read from this clip instead of being sampled, see load_resampled
+        :return: generator of (timestamp, (V, 3) vertices, (B, 3) bone positions, (M,) morph weights)
+        """
+        assert fps > 0.0
+        state = self.model.create_pose_state()
+        cursor = ClipCursor()
+        frame_pose = self.animation.binding.create_frame_pose()
+        vertices = np.empty_like(self.geometry.vertices, dtype=np.float64)
+        bone_positions = np.empty([len(self.skeleton.bones), 3])
+
+        for i in range(self.count_frames(start, stop, fps)):
+            timestamp = start + i / fps
+            # frames off the grid of the resampled clip are sampled
+            frame_index = resampled.find_frame_index(timestamp) if resampled is not None else None
+            if timestamp > 0.0 and frame_index is not None:
+                self.model.pose_resampled(resampled, frame_index, state)
+            elif timestamp > 0.0:
+                self.animation.evaluate(timestamp, frame_pose, cursor)
+                self.model.pose_frame(frame_pose, state)
+            else:
+                self.model.rest_pose(state)
+            state.timestamp = timestamp
+
+            self.model.get_vertices(state, vertices)
+            bone_positions[...] = state.skeleton_pose.matrix_world[:, :3, 3]
+            yield timestamp, vertices, bone_positions, state.influences
+
+    def compute_joints(self, timestamps: [float], batch_size=256, resampled: ResampledClip = None):
+        """
+        Joint trajectories only: poses are sampled and IK and grants are solved, but no vertex is skinned.
+        :param timestamps: (T,) of VMD
+        :param batch_size: number of frames sampled together
+        :param resampled: if given, poses of its frames are read from this clip instead of being sampled, see load_resampled
+        :return: (T, J, 3) world positions of the joints, English names of the joints
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape([-1])
+        joint_indices, joint_names = self.skeleton.get_joint_indices()
+        joints = np.empty([timestamps.shape[0], joint_indices.shape[0], 3])
+        self.ik_iterations = np.zeros([timestamps.shape[0]], dtype=np.int64)
+        state = self.model.create_pose_state()
+
+        for start in range(0, timestamps.shape[0], batch_size):
+            batch_timestamps = timestamps[start:(start + batch_size)]
+            # frames off the grid of the resampled clip are sampled
+            frame_indices = [
+                resampled.find_frame_index(timestamp) if resampled is not None else None for timestamp in batch_timestamps]
+            sampled = np.array([index is None for index in frame_indices], dtype=bool)
+            poses = dict()
+            if np.any(sampled):
+                poses = dict(zip(np.nonzero(sampled)[0].tolist(), self.sampler.sample(batch_timestamps[sampled])[0]))
+
+            for i, timestamp in enumerate(batch_timestamps):
+                if timestamp > 0.0 and frame_indices[i] is not None:
+                    self.model.pose_resampled(resampled, frame_indices[i], state, with_bone_matrices=False)
+                elif timestamp > 0.0:
+                    self.model.pose_skeleton(poses[i], state)
+                else:
+                    self.model.rest_pose(state)
+                self.model.get_joints(state, joint_indices, joints[start + i])
+                self.ik_iterations[start + i] = state.ik_iterations
+        return joints, joint_names
+
+    def save_joints(self, timestamps: [float], output_path: Union[str, pathlib.Path], resampled: ResampledClip = None):
+        """
+        Write joint trajectories of a motion into one .npz file:
+        joints (T, J, 3), names (J,), timestamps (T,), and with IK warm starts, CCD iterations of each frame (T,).
+        :param timestamps: of VMD
+        :param output_path:
+        :param resampled: if given, poses are read from this clip instead of being sampled, see load_resampled
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape([-1])
+        joints, joint_names = self.compute_joints(timestamps, resampled=resampled)
+        arrays = {"joints": joints.astype(np.float32), "names": np.array(joint_names), "timestamps": timestamps}
+        if self.ik_warm_start:
+            arrays["ik_iterations"] = self.ik_iterations
+        np.savez(output_path, **arrays)
+        return
+
+    def animate_many(
+            self, timestamps: [float], output_dirs: [Union[str, pathlib.Path]], batch_size=16, mesh_format="obj"):
+        """
+        Build OBJs of the PMX model at many timestamps.
+        PMX and VMD are parsed and bound once, poses are sampled and skinned in batches.
+        Every frame is written as soon as its batch is ready, so memory does not grow with the number of frames.
+        :param timestamps: of VMD
+        :param output_dirs: where OBJ and textures of each timestamp are stored
+        :param batch_size: number of frames sampled and skinned together
+        :param mesh_format: "obj", "pmesh" for the binary PosedMesh, or "both"
+        :return: generator of (timestamp, output_dir), one item after each written frame
+        """
+        output_dirs = list(output_dirs)
+        texture_dir = None
+
+        for i, timestamp, vertices, bone_vertices in self.__pose_many(timestamps, len(output_dirs), batch_size):
+            output_dir = output_dirs[i]
+            self.__write_frame(vertices, bone_vertices, output_dir, texture_dir, mesh_format)
+            texture_dir = output_dir if texture_dir is None else texture_dir
+            yield timestamp, output_dir
+
+    def animate_meshes(self, timestamps: [float], output_dirs: [Union[str, pathlib.Path]], batch_size=16):
+        """
+        Same as animate_many, but meshes are handed over in memory instead of being written, e.g. to Preprocessor.process_mesh.
+        Bones, materials and textures are still written into output_dirs.
+        :param timestamps: of VMD
+        :param output_dirs: where textures of each timestamp are stored
+        :param batch_size: number of frames sampled and skinned together
+        :return: generator of (timestamp, output_dir, posed mesh), one item after each frame
+        """
+        output_dirs = list(output_dirs)
+        texture_dir = None
+
+        for i, timestamp, vertices, bone_vertices in self.__pose_many(timestamps, len(output_dirs), batch_size):
+            output_dir = output_dirs[i]
+            mat_dict = self.__write_frame(vertices, bone_vertices, output_dir, texture_dir, mesh_format=None)
+            texture_dir = output_dir if texture_dir is None else texture_dir
+            yield timestamp, output_dir, PosedMesh.from_geometry(self.geometry, vertices, mat_dict)
+
+    def __pose_many(self, timestamps: [float], n_outputs: int, batch_size: int):
+        """
+        :return: generator of (index, timestamp, vertices, bone vertices) of every frame
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape([-1])
+        assert timestamps.shape[0] == n_outputs
+
+        for start in range(0, timestamps.shape[0], batch_size):
+            batch_timestamps = timestamps[start:(start + batch_size)]
+            poses, influences = self.sampler.sample(batch_timestamps)
+            bone_matrices = np.empty([batch_timestamps.shape[0]] + list(self.skeleton.bone_matrices.shape), dtype=np.float32)
+            bone_vertices = []
+
+            # skeleton: IK and grants are solved frame by frame
+            state = self.pose_state
+            for i, timestamp in enumerate(batch_timestamps):
+                if timestamp > 0.0:
+                    self.model.pose_with_arrays(poses[i], influences[i], state)
+                else:
+                    self.model.rest_pose(state)
+                    influences[i] = 0.0
+                bone_matrices[i] = state.bone_matrices
+                bone_vertices.append(self.model.get_bone_vertices(state))
+
+            # vertices: all frames of the batch are skinned at once
+            vertices = self.model.skinning.skin(self.geometry.vertices, bone_matrices) + self.geometry.get_morph_offsets(influences)
+            vertices[:, :, 1] = vertices[:, :, 1] - 10.0
+            vertices[batch_timestamps <= 0.0] = self.geometry.vertices
+
+            for i, timestamp in enumerate(batch_timestamps):
+                yield start + i, float(timestamp), vertices[i], bone_vertices[i]
@@ -0,0 +1,157 @@
+import os
+import pathlib
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from typing import Union
+from mmdata.animation.animated_model import AnimatedModel
+from mmdata.animation.animation_clip import ResampledClip
+from mmdata.animation.model_cache import get_default_cache_dir, get_cached_file_hash, get_mmdata_version, write_json
+from mmdata.animation.motion import get_name_signature
+
+
+# bump when the layout of cached entries changes
+CLIP_CACHE_FORMAT_VERSION = 1
+CLIP_ARRAY_NAMES = ["positions", "quaternions", "influences"]
+
+
+def get_bone_set_signature(model: AnimatedModel) -> str:
+    """
+    Resampled poses depend on the names, the hierarchy and the rest pose of the bones, and on the morph names.
+    :param model:
+    :return: signature that is equal for models with the same bone set
+    """
+    skeleton = model.skeleton
+    sha1 = hashlib.sha1()
+    sha1.update(get_name_signature([bone.name for bone in skeleton.bones]).encode("utf-8"))
+    sha1.update(get_name_signature([params["name"] for params in model.geometry.morph_targets]).encode("utf-8"))
+
+    for array in [skeleton.parent_indices, skeleton.rest.positions, skeleton.rest.quaternions, skeleton.rest.scales]:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+    return sha1.hexdigest()
+
+
+def get_variant(model: AnimatedModel, apply_ik: bool) -> str:
+    """
+    :param model:
+    :param apply_ik:
+    :return: name of the IK variant, IK-applied variants depend on the IK options of the model
+    """
+    if not apply_ik:
+        return "fk"
+    ik_solver = model.ik_solver
+    return f"ik_analytic{int(ik_solver.analytic)}_tolerance{ik_solver.tolerance}_warm{int(model.ik_warm_start)}"
+
+
+class ClipCache:
+    """
+    On-disk cache of clips resampled at a fixed frame rate, see AnimatedModel.resample.
+    An entry is a directory of float32 .npy arrays, memory-mapped on load, plus a small meta.json header.
+    Entries are keyed by the content hash of the VMD file, the frame rate, the bone set of the model and the IK variant.
+    Loading an entry does not copy any array, frames are read from disk when they are sliced.
+    """
+    def __init__(self, cache_dir: Union[str, pathlib.Path] = None, mmap=True):
+        """
+        :param cache_dir: default is $MMDATA_CACHE_DIR or ~/.cache/mmdata
+        :param mmap: memory-map arrays instead of reading them
+        """
+        self.cache_dir = str(cache_dir) if cache_dir is not None else get_default_cache_dir()
+        self.mmap = mmap
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry_dir(self, vmd_path: Union[str, pathlib.Path], model: AnimatedModel, fps: float, apply_ik: bool) -> str:
+        key = "_".join([
+            get_cached_file_hash(self.cache_dir, vmd_path), f"{float(fps):g}fps", get_bone_set_signature(model),
+            get_variant(model, apply_ik)])
+        return os.path.join(self.cache_dir, "clips", f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}_{get_mmdata_version()}")
+
+    def load(
+            self, vmd_path: Union[str, pathlib.Path], model: AnimatedModel, fps: float,
+            apply_ik=True) -> Union[ResampledClip, None]:
+        """
+        :param vmd_path: VMD file of the clip of model
+        :param model:
+        :param fps: frames per second
+        :param apply_ik: IK-applied or IK-free variant
+        :return: cached clip, or None if there is no valid entry
+        """
+        entry_dir = self.get_entry_dir(vmd_path, model, fps, apply_ik)
+
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), encoding="utf-8") as file:
+                header = json.load(file)["header"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if header.get("format_version") != CLIP_CACHE_FORMAT_VERSION or header.get("mmdata_version") != get_mmdata_version():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        try:
+            arrays = dict()
+            for name in CLIP_ARRAY_NAMES:
+                spec = header["arrays"][name]
+                array = np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="r" if self.mmap else None)
+                if str(array.dtype) != spec["dtype"] or list(array.shape) != spec["shape"]:
+                    raise ValueError(f"Invalid cached array: {name}")
+                arrays[name] = array
+            return ResampledClip(header["fps"], arrays["positions"], arrays["quaternions"], arrays["influences"], header["ik_applied"])
+        except (OSError, ValueError, KeyError):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+    def save(self, vmd_path: Union[str, pathlib.Path], model: AnimatedModel, resampled: ResampledClip):
+        """
+        Write the entry into a temporary directory first, so readers never see a half-written entry.
+        :param vmd_path:
+        :param model:
+        :param resampled: clip of model, see AnimatedModel.resample
+        """
+        entry_dir = self.get_entry_dir(vmd_path, model, resampled.fps, resampled.ik_applied)
+        arrays = {name: getattr(resampled, name) for name in CLIP_ARRAY_NAMES}
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_dir, f"{name}.npy"), np.ascontiguousarray(array, dtype=np.float32))
+            header = {
+                "format_version": CLIP_CACHE_FORMAT_VERSION,
+                "mmdata_version": get_mmdata_version(),
+                "fps": resampled.fps,
+                "ik_applied": resampled.ik_applied,
+                "arrays": {name: {"dtype": "float32", "shape": list(array.shape)} for name, array in arrays.items()},
+            }
+            write_json(os.path.join(temp_dir, "meta.json"), {"header": header})
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # another process may have written the same entry in the meantime
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+
+    def load_or_build(
+            self, vmd_path: Union[str, pathlib.Path], model: AnimatedModel, fps: float, apply_ik=True) -> ResampledClip:
+        """
+        :param vmd_path: VMD file of the clip of model
+        :param model:
+        :param fps: frames per second
+        :param apply_ik: IK-applied or IK-free variant
+        :return: cached clip, the clip is resampled and cached on a miss
+        """
+        resampled = self.load(vmd_path, model, fps, apply_ik)
+        if resampled is not None:
+            self.hits += 1
+            return resampled
+
+        self.misses += 1
+        resampled = model.resample(fps, apply_ik=apply_ik)
+        self.save(vmd_path, model, resampled)
+        # serve the memory-mapped entry, like later runs
+        loaded = self.load(vmd_path, model, fps, apply_ik)
+        return loaded if loaded is not None else resampled
@@ -0,0 +1,156 @@
+import numpy as np
+import mmdata.utils.quaternion_utils as quaternion_utils
+from typing import List
+from mmdata.animation.animation_track import AnimationTrack
+from mmdata.animation.animation_clip import AnimationClip
+from mmdata.animation.interpolation import solve_bezier
+from mmdata.animation.geometry import Geometry
+from mmdata.animation.skeleton import Skeleton
+
+
+class PackedTracks:
+    """
+    Keyframes of K tracks packed into padded (K, N, ...) arrays.
+    Missing keyframes have infinite time and repeat the last value.
+    """
+    def __init__(self, tracks: List[AnimationTrack], value_size: int, interpolation_size: int = 0):
+        n_tracks = len(tracks)
+        n_keys = max([track.times.shape[0] for track in tracks], default=1)
+
+        self.counts = np.array([track.times.shape[0] for track in tracks], dtype=np.int64)
+        self.times = np.full([n_tracks, n_keys], np.inf)
+        self.values = np.zeros([n_tracks, n_keys, value_size])
+        self.interpolations = np.zeros([n_tracks, n_keys, interpolation_size, 4]) if interpolation_size > 0 else None
+
+        for k, track in enumerate(tracks):
+            count = track.times.shape[0]
+            self.times[k, :count] = track.times
+            self.values[k, :count] = track.values.reshape([count, value_size])
+            self.values[k, count:] = self.values[k, count - 1]
+
+            if self.interpolations is not None:
+                self.interpolations[k, :count] = track.interpolations.reshape([count, interpolation_size, 4])
+
+    def locate(self, timestamps: np.ndarray):
+        """
+        Find the keyframes around every timestamp for every track.
+        :param timestamps: (T,)
+        :return: start and end keyframe indices (T, K), and mask of timestamps after the last keyframe (T, K)
+        """
+        end_indices = np.stack([
+            np.searchsorted(self.times[k], timestamps, side="right") for k in range(0, self.times.shape[0])], axis=1)
+        end_indices = end_indices.reshape([timestamps.shape[0], self.times.shape[0]])
+        after_last = end_indices >= self.counts[None, :]
+
+        # the keyframe before the first one is the last one, as values[-1] of a track
+        start_indices = np.where(end_indices == 0, self.counts[None, :] - 1, end_indices - 1)
+        end_indices = np.minimum(end_indices, self.counts[None, :] - 1)
+        return start_indices, end_indices, after_last
+
+    def gather(self, array: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        """
+        :param array: (K, N, ...)
+        :param indices: (T, K)
+        :return: (T, K, ...)
+        """
+        return array[np.arange(0, self.times.shape[0])[None, :], indices]
+
+
+class ClipSampler:
+    """
+    ClipSampler evaluates all tracks of an AnimationClip for many timestamps in single vectorized passes.
+    """
+    def __init__(self, clip: AnimationClip, skeleton: Skeleton, geometry: Geometry):
+        binding = clip.binding
+        interpolation_method = binding.position_tracks[0].interpolation_method if binding.position_tracks else None
+
+        self.bone_indices = binding.bone_indices
+        self.morph_indices = binding.morph_indices
+        self.rest_positions = np.array(skeleton.rest.positions)
+        self.rest_quaternions = np.array(skeleton.rest.quaternions)
+        self.n_morphs = len(geometry.morph_targets)
+        self.loop = getattr(interpolation_method, "loop", 15)
+        self.eps = getattr(interpolation_method, "eps", 1e-5)
+
+        self.positions = PackedTracks(binding.position_tracks, 3, 3)
+        self.rotations = PackedTracks(binding.rotation_tracks, 4, 1)
+        self.morphs = PackedTracks(binding.morph_tracks, 1)
+
+    def __compute_weights(self, packed: PackedTracks, timestamps: np.ndarray, gated: bool):
+        start_indices, end_indices, after_last = packed.locate(timestamps)
+        start_times = packed.gather(packed.times, start_indices)
+        end_times = packed.gather(packed.times, end_indices)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = (timestamps[:, None] - start_times) / (end_times - start_times)
+        if gated:
+            # for bones, use Bezier interpolation
+            ratio = np.where((end_times - start_times) < (1 / 30 * 1.5), 0.0, ratio)
+        return start_indices, end_indices, after_last, ratio
+
+    def sample_bones(self, timestamps: np.ndarray):
+        """
+        :param timestamps: (T,)
+        :return: positions (T, K, 3) and quaternions (T, K, 4) of the bound bones
+        """
+        # positions: one Bezier curve per channel
+        packed = self.positions
+        start_indices, end_indices, after_last, weight = self.__compute_weights(packed, timestamps, True)
+        start_values = packed.gather(packed.values, start_indices)
+        end_values = packed.gather(packed.values, end_indices)
+        params = packed.gather(packed.interpolations, start_indices)
+
+        weight = np.broadcast_to(weight[..., None], start_values.shape)
+        ratio = solve_bezier(weight, params[..., 0], params[..., 1], params[..., 2], params[..., 3], self.loop, self.eps)
+        positions = start_values * (1.0 - ratio) + end_values * ratio
+        positions = np.where(after_last[..., None], packed.values[np.arange(0, packed.counts.shape[0]), packed.counts - 1], positions)
+
+        # quaternions: one Bezier curve, then slerp
+        packed = self.rotations
+        start_indices, end_indices, after_last, weight = self.__compute_weights(packed, timestamps, True)
+        start_values = packed.gather(packed.values, start_indices)
+        end_values = packed.gather(packed.values, end_indices)
+        params = packed.gather(packed.interpolations, start_indices)[..., 0, :]
+
+        ratio = solve_bezier(weight, params[..., 0], params[..., 1], params[..., 2], params[..., 3], self.loop, self.eps)
+        quaternions = quaternion_utils.batch_slerp(start_values, end_values, ratio)
+        quaternions[..., 0] = -quaternions[..., 0]
+        quaternions = np.where(after_last[..., None], packed.values[np.arange(0, packed.counts.shape[0]), packed.counts - 1], quaternions)
+        return positions, quaternions
+
+    def sample_morphs(self, timestamps: np.ndarray):
+        """
+        :param timestamps: (T,)
+        :return: influences (T, L) of the bound morphs
+        """
+        packed = self.morphs
+        start_indices, end_indices, after_last, ratio = self.__compute_weights(packed, timestamps, False)
+        start_values = packed.gather(packed.values, start_indices)[..., 0]
+        end_values = packed.gather(packed.values, end_indices)[..., 0]
+
+        with np.errstate(invalid="ignore"):
+            influences = start_values * (1.0 - ratio) + end_values * ratio
+        influences = np.where(after_last, packed.values[np.arange(0, packed.counts.shape[0]), packed.counts - 1, 0], influences)
+        return influences
+
+    def sample(self, timestamps: np.ndarray):
+        """
+        Evaluate the whole clip.
+        :param timestamps: (T,)
+        :return: pose tensor (T, B, 7) of positions and quaternions for all bones, influences (T, M) for all morphs
+        """
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+        n_frames = timestamps.shape[0]
+
+        poses = np.empty([n_frames, self.rest_positions.shape[0], 7])
+        poses[:, :, :3] = self.rest_positions[None]
+        poses[:, :, 3:] = self.rest_quaternions[None]
+        influences = np.zeros([n_frames, self.n_morphs])
+
+        if self.bone_indices.shape[0] > 0:
+            positions, quaternions = self.sample_bones(timestamps)
+            poses[:, self.bone_indices, :3] = positions
+            poses[:, self.bone_indices, 3:] = quaternions
+        if self.morph_indices.shape[0] > 0:
+            influences[:, self.morph_indices] = self.sample_morphs(timestamps)
+        return poses, influences
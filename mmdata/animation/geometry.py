@@ -1,91 +1,117 @@
 import numpy as np
+import scipy.sparse
+from typing import Union
 from mmdata.animation.skeleton import Bone
+from mmdata.utils.mmd_reader import PmxData
 
 
 class Geometry:
     """
     Geometry of a PMX model: vertices, normals, faces, bones, grants, etc.
     """
-    def __init__(self, pmx):
+    def __init__(self, pmx: Union[PmxData, object]):
+        """
+        :param pmx: PmxData, or a model that pymeshio.pmx.reader has read
+        """
+        if not isinstance(pmx, PmxData):
+            pmx = PmxData.from_pymeshio(pmx)
+        flip_z = np.array([1.0, 1.0, -1.0])
+
         # read core attributes
-        self.vertices = np.stack([[v.position.x, v.position.y, -v.position.z] for v in pmx.vertices], axis=0)
-        self.normals = np.stack([[v.normal.x, v.normal.y, v.normal.z] for v in pmx.vertices], axis=0)
-        self.uvs = np.stack([[v.uv.x, v.uv.y] for v in pmx.vertices], axis=0)
-        self.faces = np.array([pmx.indices[i:(i + 3)] for i in range(0, len(pmx.indices), 3)])
+        vertices = pmx.vertices
+        self.vertices = vertices["position"].astype(np.float64) * flip_z
+        self.normals = vertices["normal"].astype(np.float64)
+        self.uvs = vertices["uv"].astype(np.float64)
+        self.faces = pmx.indices.astype(np.int64).reshape([-1, 3])
+
+        # skinning: BDEF1/BDEF2/BDEF4 are packed into 4 influences per vertex
+        # BDEF1 has an implicit weight of 1, BDEF2 and SDEF have an implicit second weight of 1 - weight0
+        deform_types = vertices["deform_type"]
+        self.skin_indices = vertices["bone_indices"].astype(np.int64)
+        self.skin_weights = vertices["bone_weights"].astype(np.float64)
+        self.skin_weights[deform_types == 0, 0] = 1.0
+        two_weights = (deform_types == 1) | (deform_types == 3)
+        self.skin_weights[two_weights, 1] = 1.0 - self.skin_weights[two_weights, 0]
+
+        # materials: faces of the i-th material follow faces of the previous ones
+        self.materials = Geometry.read_materials(pmx)
 
         # bones
         self.bones = []
         self.bone_type_table = dict()
 
-        for body in pmx.rigidbodies:
-            value = body.mode
-            if body.bone_index in self.bone_type_table:
-                value = max(body.mode, self.bone_type_table.get(body.bone_index))
-            self.bone_type_table[body.bone_index] = value
+        for body in pmx.rigid_bodies:
+            bone_index, value = int(body["bone_index"]), int(body["mode"])
+            if bone_index in self.bone_type_table:
+                value = max(value, self.bone_type_table.get(bone_index))
+            self.bone_type_table[bone_index] = value
 
+        bone_positions = pmx.bones["position"].astype(np.float64) * flip_z
         for bone_index, bone in enumerate(pmx.bones):
+            parent_index = int(bone["parent_index"])
             out_bone = {
                 "index": bone_index,
-                "transformation_class": bone.layer,
-                "parent": bone.parent_index,
-                "name": bone.name,
-                "pos": np.array([bone.position.x, bone.position.y, -bone.position.z]),
+                "transformation_class": int(bone["layer"]),
+                "parent": parent_index,
+                "name": pmx.bone_names[bone_index],
+                "pos": bone_positions[bone_index].copy(),
                 "rot": np.array([0, 0, 0, 1], dtype=np.float32),
                 "scl": np.array([1, 1, 1]),
                 "rigid_body_type": self.bone_type_table.get(bone_index, -1),
             }
-            if bone.parent_index != -1:
-                parent_bone = pmx.bones[bone.parent_index]
-                parent_pos = np.array([parent_bone.position.x, parent_bone.position.y, -parent_bone.position.z])
-                out_bone["pos"] -= parent_pos
+            if parent_index != -1:
+                out_bone["pos"] -= bone_positions[parent_index]
             self.bones.append(out_bone)
 
         # ik
         self.iks = []
 
         for bone_index, bone in enumerate(pmx.bones):
-            if bone.ik is None:
+            if not (bone["flag"] & 0x0020):
                 continue
 
             ik_param = {
                 "target": bone_index,
-                "effector": bone.ik.target_index,
-                "iteration": bone.ik.loop,
-                "max_angle": bone.ik.limit_radian,
+                "effector": int(bone["ik_target_index"]),
+                "iteration": int(bone["ik_loop"]),
+                "max_angle": float(bone["ik_limit_radian"]),
                 "links": [],
             }
 
-            for link in bone.ik.link:
+            link_start = int(bone["ik_link_start"])
+            for link in pmx.ik_links[link_start:(link_start + int(bone["ik_link_count"]))]:
+                limit_angle = int(link["limit_angle"])
                 link_param = {
-                    "index": link.bone_index,
+                    "index": int(link["bone_index"]),
                     "enabled": True,
-                    "limit_rotation": link.limit_angle == 1,
+                    "limit_rotation": limit_angle == 1,
                 }
-                if link.limit_angle == 1:
-                    link_param["rotation_max"] = np.array([-link.limit_min[0], -link.limit_min[1], -link.limit_min[2]])
-                    link_param["rotation_min"] = np.array([-link.limit_max[0], -link.limit_max[1], -link.limit_max[2]])
+                if limit_angle == 1:
+                    link_param["rotation_max"] = -link["limit_min"].astype(np.float64)
+                    link_param["rotation_min"] = -link["limit_max"].astype(np.float64)
                 ik_param["links"].append(link_param)
 
             self.iks.append(ik_param)
             self.bones[bone_index]["ik"] = ik_param
 
         # grant
-        self.grant_entry_map = {}
+        grant_entry_map = {}
         self.grants = []
         root_entry = {"parent": None, "children": [], "grant_param": None, "visited": False}
 
         for bone_index, bone in enumerate(pmx.bones):
-            if bone.getExternalRotationFlag() or bone.getExternalTranslationFlag():
+            flag = int(bone["flag"])
+            if flag & (0x0100 | 0x0200):
                 grant_param = {
                     "index": bone_index,
-                    "parent_index": bone.effect_index,
-                    "ratio": bone.effect_factor,
-                    "is_local": bone.hasFlag(0x0080),
-                    "affect_rotation": bone.getExternalRotationFlag(),
-                    "affect_position": bone.getExternalTranslationFlag(),
-                    "transform_class": bone.layer,
+                    "parent_index": int(bone["effect_index"]),
+                    "ratio": float(bone["effect_factor"]),
+                    "is_local": (flag & 0x0080) != 0,
+                    "affect_rotation": (flag & 0x0100) != 0,
+                    "affect_position": (flag & 0x0200) != 0,
+                    "transform_class": int(bone["layer"]),
                 }
-                self.grant_entry_map[bone_index] = {
+                grant_entry_map[bone_index] = {
                     "parent": None,
                     "children": [],
                     "grant_param": grant_param,
@@ -93,10 +119,10 @@ class Geometry:
                 }
 
         # build a tree of grant hierarchy
-        for bone_index, grant_entry in self.grant_entry_map.items():
+        for bone_index, grant_entry in grant_entry_map.items():
             parent_index = grant_entry["grant_param"]["parent_index"]
-            if parent_index in self.grant_entry_map:
-                parent_grant_entry = self.grant_entry_map[parent_index]
+            if parent_index in grant_entry_map:
+                parent_grant_entry = grant_entry_map[parent_index]
             else:
                 parent_grant_entry = root_entry
             grant_entry["parent"] = parent_grant_entry
@@ -106,42 +132,146 @@ class Geometry:
         self.__traverse_grant(root_entry)
 
         # morph
+        # position offsets are stored as a sparse (morphs, V * 3) matrix, only touched vertices take memory
         self.morph_targets = []
-        self.morph_positions = []
         self.morph_target_influences = []
         self.morph_target_dict = dict()
+        morph_rows, morph_columns, morph_deltas = [], [], []
 
-        for morph in pmx.morphs:
-            params = {"name": morph.name}
-            attribute = {
-                "array": np.zeros([len(pmx.vertices), 3], dtype=np.float32),
-                "name": morph.name,
-            }
+        morph_types = pmx.morphs["morph_type"]
+        n_morphs = morph_types.shape[0]
+        vertex_offsets, group_offsets = pmx.vertex_morph_offsets, pmx.group_morph_offsets
+        # offsets of a morph are contiguous, in morph order
+        vertex_starts = np.searchsorted(vertex_offsets["morph_index"], np.arange(0, n_morphs + 1))
+        group_starts = np.searchsorted(group_offsets["morph_index"], np.arange(0, n_morphs + 1))
 
-            for i in range(0, self.vertices.shape[0]):
-                attribute["array"][i, :] = self.vertices[i, :]
+        def add_vertex_offsets(morph_index, target_index, value):
+            offsets = vertex_offsets[vertex_starts[target_index]:vertex_starts[target_index + 1]]
+            morph_rows.append(np.full([offsets.shape[0] * 3], morph_index, dtype=np.int64))
+            morph_columns.append((offsets["vertex_index"].astype(np.int64)[:, None] * 3 + np.arange(0, 3)).reshape([-1]))
+            morph_deltas.append((offsets["position_offset"].astype(np.float64) * value).reshape([-1]))
 
-            if morph.morph_type == 0:
-                for offset in morph.offsets:
-                    morph2 = pmx.morphs[offset.morph_index]
-                    if morph2.morph_type == 1:
-                        for offset2 in morph2.offsets:
-                            i = offset2.vertex_index
-                            position_offset = np.array([offset2.position_offset[j] for j in range(0, 3)])
-                            attribute["array"][i, :] += position_offset * offset.value
+        for morph_index, morph_name in enumerate(pmx.morph_names):
+            params = {"name": morph_name}
 
-            elif morph.morph_type == 1:
-                for offset in morph.offsets:
-                    i = offset.vertex_index
-                    position_offset = np.array([offset.position_offset[j] for j in range(0, 3)])
-                    attribute["array"][i, :] += position_offset
+            if morph_types[morph_index] == 0:
+                # group morphs are expanded into their vertex morphs once
+                for offset in group_offsets[group_starts[morph_index]:group_starts[morph_index + 1]]:
+                    target_index = int(offset["target_index"]) % n_morphs
+                    if morph_types[target_index] == 1:
+                        add_vertex_offsets(morph_index, target_index, float(offset["value"]))
+
+            elif morph_types[morph_index] == 1:
+                add_vertex_offsets(morph_index, morph_index, 1.0)
 
             self.morph_targets.append(params)
-            self.morph_positions.append(attribute)
             self.morph_target_influences.append(0)
-            self.morph_target_dict[morph.name] = len(self.morph_positions) - 1
+            self.morph_target_dict[morph_name] = len(self.morph_targets) - 1
 
         self.morph_target_influences = np.array(self.morph_target_influences, dtype=np.float32)
+        # duplicated (morph, vertex) entries are summed up
+        self.morph_offsets = scipy.sparse.csr_matrix(
+            (np.concatenate(morph_deltas + [np.zeros([0])]).astype(np.float32),
+             (np.concatenate(morph_rows + [np.zeros([0], dtype=np.int64)]),
+              np.concatenate(morph_columns + [np.zeros([0], dtype=np.int64)]))),
+            shape=(len(self.morph_targets), self.vertices.shape[0] * 3))
+
+    @staticmethod
+    def read_materials(pmx: PmxData) -> [dict]:
+        """
+        :param pmx:
+        :return: name, vertex_count, texture and diffuse_color of each material
+        """
+        materials = []
+        for material_index, mat in enumerate(pmx.materials):
+            materials.append({
+                "name": pmx.material_names[material_index],
+                "vertex_count": int(mat["vertex_count"]),
+                "texture": pmx.textures[int(mat["texture_index"])] if len(pmx.textures) > 0 else "",
+                "diffuse_color": [float(c) for c in mat["diffuse_color"]],
+            })
+        return materials
+
+    def state_dict(self) -> (dict, dict):
+        """
+        Split the Geometry into plain metadata and NumPy arrays, e.g. to store it on disk.
+        :return: metadata (JSON serializable), arrays
+        """
+        bones = [{key: bone[key] for key in ["index", "transformation_class", "parent", "name", "rigid_body_type"]} for bone in self.bones]
+        iks = [
+            dict(ik, links=[
+                {key: (value.tolist() if isinstance(value, np.ndarray) else value) for key, value in link.items()}
+                for link in ik["links"]])
+            for ik in self.iks]
+        meta = {
+            "bones": bones,
+            "bone_type_table": [[bone_index, value] for bone_index, value in self.bone_type_table.items()],
+            "iks": iks,
+            "grants": self.grants,
+            "morph_targets": self.morph_targets,
+            "materials": self.materials,
+        }
+        arrays = {
+            "vertices": self.vertices,
+            "normals": self.normals,
+            "uvs": self.uvs,
+            "faces": self.faces,
+            "skin_indices": self.skin_indices,
+            "skin_weights": self.skin_weights,
+            "bone_positions": np.array([bone["pos"] for bone in self.bones]).reshape([-1, 3]),
+            "bone_rotations": np.array([bone["rot"] for bone in self.bones]).reshape([-1, 4]),
+            "bone_scales": np.array([bone["scl"] for bone in self.bones]).reshape([-1, 3]),
+            "morph_offsets_data": self.morph_offsets.data,
+            "morph_offsets_indices": self.morph_offsets.indices,
+            "morph_offsets_indptr": self.morph_offsets.indptr,
+        }
+        return meta, arrays
+
+    @classmethod
+    def from_state_dict(cls, meta: dict, arrays: dict):
+        """
+        Rebuild a Geometry from the output of state_dict without any PMX parsing.
+        :param meta:
+        :param arrays:
+        :return: Geometry
+        """
+        geometry = cls.__new__(cls)
+        geometry.vertices = arrays["vertices"]
+        geometry.normals = arrays["normals"]
+        geometry.uvs = arrays["uvs"]
+        geometry.faces = arrays["faces"]
+        geometry.skin_indices = arrays["skin_indices"]
+        geometry.skin_weights = arrays["skin_weights"]
+        geometry.materials = meta["materials"]
+        geometry.bone_type_table = {bone_index: value for bone_index, value in meta["bone_type_table"]}
+
+        geometry.bones = []
+        for bone_index, bone in enumerate(meta["bones"]):
+            geometry.bones.append(dict(
+                bone,
+                pos=np.array(arrays["bone_positions"][bone_index]),
+                rot=np.array(arrays["bone_rotations"][bone_index]),
+                scl=np.array(arrays["bone_scales"][bone_index])))
+
+        geometry.iks = []
+        for ik in meta["iks"]:
+            ik_param = dict(ik, links=[
+                {key: (np.array(value) if key in ["rotation_max", "rotation_min"] else value) for key, value in link.items()}
+                for link in ik["links"]])
+            geometry.iks.append(ik_param)
+            geometry.bones[ik_param["target"]]["ik"] = ik_param
+
+        geometry.grants = [dict(grant) for grant in meta["grants"]]
+        for grant_param in geometry.grants:
+            geometry.bones[grant_param["index"]]["grant"] = grant_param
+
+        geometry.morph_targets = meta["morph_targets"]
+        geometry.morph_target_dict = {params["name"]: morph_index for morph_index, params in enumerate(geometry.morph_targets)}
+        geometry.morph_target_influences = np.zeros([len(geometry.morph_targets)], dtype=np.float32)
+        geometry.morph_offsets = scipy.sparse.csr_matrix(
+            (arrays["morph_offsets_data"], arrays["morph_offsets_indices"], arrays["morph_offsets_indptr"]),
+            shape=(len(geometry.morph_targets), geometry.vertices.shape[0] * 3))
+        return geometry
 
     def __traverse_grant(self, entry):
         if entry["grant_param"] is not None:
@@ -154,6 +284,27 @@ class Geometry:
                 self.__traverse_grant(child)
         return
 
+    def get_morph_offsets(self, influences: np.ndarray = None) -> np.ndarray:
+        """
+        Blend position offsets of all active morphs.
+        Only rows of morphs that have positive influence are visited.
+        :param influences: (M,) or (T, M) morph influences, default is morph_target_influences
+        :return: (V, 3) or (T, V, 3) vertex offsets
+        """
+        if influences is None:
+            influences = self.morph_target_influences
+        influences = np.asarray(influences, dtype=np.float64)
+        batch_shape = influences.shape[:-1]
+        influences = influences.reshape([-1, influences.shape[-1]])
+
+        active = np.nonzero(np.any(influences > 0.0, axis=0))[0]
+        if active.shape[0] == 0:
+            return np.zeros(batch_shape + self.vertices.shape)
+
+        weights = np.maximum(influences[:, active], 0.0)
+        offsets = self.morph_offsets[active].T.dot(weights.T).T
+        return offsets.reshape(batch_shape + self.vertices.shape)
+
     def get_bone_hierarchy(self) -> ([Bone], [Bone]):
         bones = []
         top_most = []
@@ -1,4 +1,126 @@
+import numpy as np
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+def solve_bezier(x: np.ndarray, x1, x2, y1, y2, loop=15, eps=1e-5) -> np.ndarray:
+    """
+    Vectorized version of BezierInterpolationMethod.compute_ratio.
+    Every element runs the same bisection steps as the scalar solver, so results are identical.
+    :param x: (N,) weights
+    :param x1: (N,) or scalar control point
+    :param x2: (N,) or scalar control point
+    :param y1: (N,) or scalar control point
+    :param y2: (N,) or scalar control point
+    :param loop: number of bisection steps
+    :param eps: tolerance to stop early
+    :return: (N,) ratios
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x1, x2, y1, y2 = [np.broadcast_to(np.asarray(v, dtype=np.float64), x.shape) for v in (x1, x2, y1, y2)]
+
+    c = 0.5
+    t = np.full(x.shape, c)
+    s = 1.0 - t
+    sst3, stt3, ttt = np.zeros(x.shape), np.zeros(x.shape), np.zeros(x.shape)
+    active = np.ones(x.shape, dtype=bool)
+
+    for i in range(0, loop):
+        sst3 = np.where(active, 3.0 * s * s * t, sst3)
+        stt3 = np.where(active, 3.0 * s * t * t, stt3)
+        ttt = np.where(active, t * t * t, ttt)
+        ft = (sst3 * x1) + (stt3 * x2) + ttt - x
+
+        active &= np.abs(ft) >= eps
+        if not np.any(active):
+            break
+
+        c /= 2.0
+        t = np.where(active, np.where(ft < 0, t + c, t - c), t)
+        s = 1.0 - t
+    return (sst3 * y1) + (stt3 * y2) + ttt
+
+
+class BezierCurveCache:
+    """
+    LRU cache of Bezier curves keyed by the quantized control points (x1, x2, y1, y2).
+    VMD control points are 7-bit integers, so a motion has only a few hundred distinct curves.
+    With table_size > 0, a curve is a dense ratio table that is looked up with linear interpolation.
+    Otherwise, exact solves are memoized per curve.
+    """
+    def __init__(self, max_curves=1024, table_size=0, max_solves=4096, quantization=127):
+        self.max_curves = max_curves
+        self.table_size = table_size
+        self.max_solves = max_solves
+        self.quantization = quantization
+        self.curves = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # curves dropped by the LRU, and memoized solves dropped when a curve of dict mode is full
+        self.evictions = 0
+        self.solve_evictions = 0
+
+    def get_key(self, params) -> tuple:
+        return tuple(int(round(float(p) * self.quantization)) for p in params)
+
+    def get_curve(self, params, method):
+        """
+        Find the entry of a curve, build it if needed.
+        :param params: (x1, x2, y1, y2)
+        :param method: BezierInterpolationMethod used to solve the curve
+        :return: ratio table (table_size,) or dict of memoized solves
+        """
+        key = self.get_key(params)
+        curve = self.curves.get(key, None)
+
+        if curve is not None:
+            self.curves.move_to_end(key)
+            # in dict mode, hits are counted per memoized solve instead
+            if self.table_size > 0:
+                self.hits += 1
+            return curve
+
+        if self.table_size > 0:
+            x1, x2, y1, y2 = params
+            grid = np.linspace(0.0, 1.0, self.table_size)
+            curve = solve_bezier(grid, x1, x2, y1, y2, loop=method.loop, eps=method.eps)
+            self.misses += 1
+        else:
+            curve = dict()
+
+        self.curves[key] = curve
+        if len(self.curves) > self.max_curves:
+            self.curves.popitem(last=False)
+            self.evictions += 1
+        return curve
+
+    def compute_ratio(self, weight: float, params, method):
+        curve = self.get_curve(params, method)
+
+        if self.table_size > 0:
+            position = min(max(weight, 0.0), 1.0) * (self.table_size - 1)
+            index = min(int(position), self.table_size - 2)
+            fraction = position - index
+            return curve[index] * (1.0 - fraction) + curve[index + 1] * fraction
+
+        ratio = curve.get(weight, None)
+        if ratio is not None:
+            self.hits += 1
+            return ratio
+
+        self.misses += 1
+        ratio = method.solve(weight, params)
+        if len(curve) >= self.max_solves:
+            self.solve_evictions += len(curve)
+            curve.clear()
+        curve[weight] = ratio
+        return ratio
+
+    def stats(self) -> dict:
+        return {
+            "curves": len(self.curves), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "solve_evictions": self.solve_evictions,
+        }
 
 
 class InterpolationMethod(ABC):
@@ -20,12 +142,18 @@ class BezierInterpolationMethod(InterpolationMethod):
     """
     Only Bezier is supported.
     """
-    def __init__(self, loop=15, eps=1e-5):
+    def __init__(self, loop=15, eps=1e-5, cache: BezierCurveCache = None):
         super(BezierInterpolationMethod, self).__init__()
         self.loop = loop
         self.eps = eps
+        self.cache = cache
 
     def compute_ratio(self, weight: int, params: [int]):
+        if self.cache is not None:
+            return self.cache.compute_ratio(weight, params, self)
+        return self.solve(weight, params)
+
+    def solve(self, weight: int, params: [int]):
         x = weight
         x1, x2, y1, y2 = params
 
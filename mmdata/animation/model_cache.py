@@ -0,0 +1,171 @@
+import os
+import pathlib
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import mmdata.utils.mmd_reader as mmd_reader
+
+from typing import Union
+from mmdata.animation.geometry import Geometry
+
+
+# bump when the layout of cached entries changes
+CACHE_FORMAT_VERSION = 1
+
+
+def get_default_cache_dir() -> str:
+    return os.environ.get("MMDATA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mmdata"))
+
+
+def compute_file_hash(path: Union[str, pathlib.Path], chunk_size=1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_cached_file_hash(cache_dir: str, path: Union[str, pathlib.Path]) -> str:
+    """
+    Hash of a file content. The hash is remembered per path, size and mtime, so unchanged files are not re-read.
+    :param cache_dir:
+    :param path:
+    :return: hash
+    """
+    stat = os.stat(path)
+    path_key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    path_file = os.path.join(cache_dir, "paths", f"{path_key}.json")
+
+    try:
+        with open(path_file) as file:
+            path_info = json.load(file)
+        if path_info["size"] == stat.st_size and path_info["mtime_ns"] == stat.st_mtime_ns:
+            return path_info["hash"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    file_hash = compute_file_hash(path)
+    os.makedirs(os.path.dirname(path_file), exist_ok=True)
+    write_json(path_file, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash})
+    return file_hash
+
+
+def write_json(path: str, content: dict):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(content, file, ensure_ascii=False)
+
+
+def get_mmdata_version() -> str:
+    import mmdata
+    return mmdata.__version__
+
+
+class ModelCache:
+    """
+    On-disk cache of compiled PMX models, so a model is parsed only once.
+    An entry is a directory of .npy arrays, memory-mapped on load, plus a small meta.json header.
+    Entries are keyed by the content hash of the PMX file and the mmdata version.
+    An entry is rebuilt when its header does not match, e.g. after an upgrade, or when an array is missing or broken.
+    """
+    def __init__(self, cache_dir: Union[str, pathlib.Path] = None, mmap=True):
+        """
+        :param cache_dir: default is $MMDATA_CACHE_DIR or ~/.cache/mmdata
+        :param mmap: memory-map arrays instead of reading them
+        """
+        self.cache_dir = str(cache_dir) if cache_dir is not None else get_default_cache_dir()
+        self.mmap = mmap
+        self.hits = 0
+        self.misses = 0
+
+    def get_pmx_hash(self, pmx_path: Union[str, pathlib.Path]) -> str:
+        """
+        Hash of the PMX content, see get_cached_file_hash.
+        :param pmx_path:
+        :return: hash
+        """
+        return get_cached_file_hash(self.cache_dir, pmx_path)
+
+    def get_entry_dir(self, pmx_hash: str) -> str:
+        return os.path.join(self.cache_dir, "models", f"{pmx_hash}_{get_mmdata_version()}")
+
+    def load(self, pmx_path: Union[str, pathlib.Path]) -> Union[Geometry, None]:
+        """
+        :param pmx_path:
+        :return: cached Geometry, or None if there is no valid entry
+        """
+        pmx_hash = self.get_pmx_hash(pmx_path)
+        entry_dir = self.get_entry_dir(pmx_hash)
+
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), encoding="utf-8") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        header = meta.get("header", {})
+        if (header.get("format_version") != CACHE_FORMAT_VERSION or header.get("mmdata_version") != get_mmdata_version()
+                or header.get("pmx_hash") != pmx_hash):
+            self.invalidate(pmx_path)
+            return None
+
+        try:
+            arrays = dict()
+            for name, spec in header["arrays"].items():
+                array = np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="r" if self.mmap else None)
+                if str(array.dtype) != spec["dtype"] or list(array.shape) != spec["shape"]:
+                    raise ValueError(f"Invalid cached array: {name}")
+                arrays[name] = array
+            return Geometry.from_state_dict(meta["geometry"], arrays)
+        except (OSError, ValueError, KeyError):
+            self.invalidate(pmx_path)
+            return None
+
+    def save(self, pmx_path: Union[str, pathlib.Path], geometry: Geometry):
+        """
+        Write the entry into a temporary directory first, so readers never see a half-written entry.
+        :param pmx_path:
+        :param geometry:
+        """
+        pmx_hash = self.get_pmx_hash(pmx_path)
+        entry_dir = self.get_entry_dir(pmx_hash)
+        meta, arrays = geometry.state_dict()
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+            header = {
+                "format_version": CACHE_FORMAT_VERSION,
+                "mmdata_version": get_mmdata_version(),
+                "pmx_hash": pmx_hash,
+                "arrays": {name: {"dtype": str(array.dtype), "shape": list(array.shape)} for name, array in arrays.items()},
+            }
+            write_json(os.path.join(temp_dir, "meta.json"), {"header": header, "geometry": meta})
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # another process may have written the same entry in the meantime
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+
+    def invalidate(self, pmx_path: Union[str, pathlib.Path]):
+        shutil.rmtree(self.get_entry_dir(self.get_pmx_hash(pmx_path)), ignore_errors=True)
+
+    def load_or_build(self, pmx_path: Union[str, pathlib.Path]) -> Geometry:
+        """
+        :param pmx_path:
+        :return: cached Geometry, the PMX file is parsed and cached on a miss
+        """
+        geometry = self.load(pmx_path)
+        if geometry is not None:
+            self.hits += 1
+            return geometry
+
+        self.misses += 1
+        geometry = Geometry(mmd_reader.read_pmx(pmx_path))
+        self.save(pmx_path, geometry)
+        return geometry
@@ -0,0 +1,179 @@
+import os
+import pathlib
+import hashlib
+import numpy as np
+import mmdata.utils.mmd_reader as mmd_reader
+from typing import Union
+from mmdata.animation.animation_track import SkeletalTrack, MorphTrack
+from mmdata.animation.interpolation import InterpolationMethod, BezierInterpolationMethod, BezierCurveCache
+from mmdata.utils.mmd_reader import VmdData
+
+
+def group_keyframes(keyframes: np.ndarray):
+    """
+    Group keyframes by name, in order of the first appearance of each name.
+    Keyframes of a group are sorted by frame, keyframes of the same frame keep the file order.
+    :param keyframes: structured array that has name_index and frame
+    :return: list of (name index, keyframes)
+    """
+    order = np.argsort(keyframes["frame"], kind="stable")
+    order = order[np.argsort(keyframes["name_index"][order], kind="stable")]
+    name_indices = keyframes["name_index"][order]
+
+    unique_indices, first_indices = np.unique(keyframes["name_index"], return_index=True)
+    starts = np.searchsorted(name_indices, unique_indices, side="left")
+    ends = np.searchsorted(name_indices, unique_indices, side="right")
+    groups = []
+
+    for k in np.argsort(first_indices, kind="stable"):
+        groups.append((int(unique_indices[k]), keyframes[order[starts[k]:ends[k]]]))
+    return groups
+
+
+def get_name_signature(names: [str]) -> str:
+    """
+    :param names: bone or morph names of a model, in index order
+    :return: signature that is equal for models with the same names
+    """
+    return hashlib.sha1("\x00".join(names).encode("utf-8")).hexdigest()
+
+
+class BoneKeyframes:
+    """
+    Keyframes of one bone, sorted by frame.
+    Positions are offsets from the rest position of the bone, so they do not depend on any model.
+    """
+    def __init__(
+            self, times: np.ndarray, positions: np.ndarray, rotations: np.ndarray,
+            position_interpolations: np.ndarray, rotation_interpolations: np.ndarray):
+        self.times = times
+        self.positions = positions
+        self.rotations = rotations
+        self.position_interpolations = position_interpolations
+        self.rotation_interpolations = rotation_interpolations
+
+
+class MorphKeyframes:
+    """
+    Keyframes of one morph, sorted by frame.
+    """
+    def __init__(self, times: np.ndarray, values: np.ndarray):
+        self.times = times
+        self.values = values
+
+
+class Motion:
+    """
+    Skeleton-independent content of a VMD file: keyframes are grouped by name, sorted and converted once.
+    Binding a Motion to a model only resolves bone and morph names.
+    Bindings are memoized by the signature of the names, models that share a bone set share them.
+    """
+    def __init__(self, vmd: Union[VmdData, object], interpolation_method: InterpolationMethod = None):
+        """
+        :param vmd: VmdData, or a motion that pymeshio.vmd.reader has read
+        :param interpolation_method: default is a cached Bezier interpolation
+        """
+        if not isinstance(vmd, VmdData):
+            vmd = VmdData.from_pymeshio(vmd)
+        if interpolation_method is None:
+            interpolation_method = BezierInterpolationMethod(cache=BezierCurveCache())
+
+        self.path = vmd.path
+        self.interpolation_method = interpolation_method
+        self.bone_keyframes = dict()
+        self.morph_keyframes = dict()
+        self.bone_bindings = dict()
+        self.morph_bindings = dict()
+
+        for name_index, keyframes in group_keyframes(vmd.motions):
+            # Bezier control points (x1, x2, y1, y2) of channels x, y, z and rotation
+            interpolation = keyframes["interpolation"]
+            curves = np.stack([
+                interpolation[:, 0:4], interpolation[:, 8:12], interpolation[:, 4:8], interpolation[:, 12:16]], axis=-1) / 127
+
+            self.bone_keyframes[vmd.motion_names[name_index]] = BoneKeyframes(
+                keyframes["frame"] / 30,
+                keyframes["position"].astype(np.float64) * np.array([1.0, 1.0, -1.0]),
+                keyframes["quaternion"].astype(np.float64) * np.array([1.0, -1.0, 1.0, 1.0]),
+                curves[:, :3].reshape([-1, 4]),
+                curves[:, 3])
+
+        for name_index, keyframes in group_keyframes(vmd.shapes):
+            self.morph_keyframes[vmd.shape_names[name_index]] = MorphKeyframes(
+                keyframes["frame"] / 30, keyframes["weight"].astype(np.float64))
+
+    def bind_bones(self, bone_names: [str]):
+        """
+        Resolve animated bones against the bones of a model.
+        Rotation tracks do not depend on the rest pose, so they are shared by all models of a binding.
+        :param bone_names: bone names of the model, in index order
+        :return: list of (bone name, bone index, rotation track)
+        """
+        signature = get_name_signature(bone_names)
+        binding = self.bone_bindings.get(signature, None)
+
+        if binding is None:
+            bone_index_by_name = {bone_name: bone_index for bone_index, bone_name in enumerate(bone_names)}
+            binding = []
+
+            for bone_name, keyframes in self.bone_keyframes.items():
+                if bone_name not in bone_index_by_name:
+                    continue
+                # example name: ".bones[センター].quaternion"
+                rotation_track = SkeletalTrack(
+                    f".bones[{bone_name}].quaternion", keyframes.times, keyframes.rotations,
+                    keyframes.rotation_interpolations, self.interpolation_method)
+                binding.append((bone_name, bone_index_by_name[bone_name], rotation_track))
+            self.bone_bindings[signature] = binding
+        return binding
+
+    def bind_morphs(self, morph_names: [str]):
+        """
+        Resolve animated morphs against the morphs of a model.
+        :param morph_names: morph names of the model, in index order
+        :return: list of (morph index, morph track)
+        """
+        signature = get_name_signature(morph_names)
+        binding = self.morph_bindings.get(signature, None)
+
+        if binding is None:
+            morph_index_by_name = {morph_name: morph_index for morph_index, morph_name in enumerate(morph_names)}
+            binding = []
+
+            for morph_name, keyframes in self.morph_keyframes.items():
+                if morph_name not in morph_index_by_name:
+                    continue
+                morph_index = morph_index_by_name[morph_name]
+                morph_track = MorphTrack(f".morphTargetInfluences[{morph_index}]", keyframes.times, keyframes.values)
+                binding.append((morph_index, morph_track))
+            self.morph_bindings[signature] = binding
+        return binding
+
+
+class MotionCache:
+    """
+    In-memory cache of Motions, so a VMD file is parsed once however many models it animates.
+    Entries are keyed by path, and are re-read when the size or modification time of the file changes.
+    """
+    def __init__(self):
+        self.motions = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, vmd_path: Union[str, pathlib.Path]) -> Motion:
+        """
+        :param vmd_path:
+        :return: cached Motion, the VMD file is parsed on a miss
+        """
+        stat = os.stat(vmd_path)
+        key = os.path.abspath(vmd_path)
+        entry = self.motions.get(key, None)
+
+        if entry is not None and entry[0] == (stat.st_size, stat.st_mtime_ns):
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        motion = Motion(mmd_reader.read_vmd(vmd_path))
+        self.motions[key] = ((stat.st_size, stat.st_mtime_ns), motion)
+        return motion
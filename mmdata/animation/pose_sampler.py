@@ -0,0 +1,132 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from mmdata.animation.animator import Animator
+from mmdata.animation.clip_cache import ClipCache
+from mmdata.animation.skeleton import Skeleton
+
+
+def get_descriptor_bones(skeleton: Skeleton) -> np.ndarray:
+    """
+    Bones on the chains from the roots down to the joints, see Skeleton.get_joint_indices.
+    Roots are left out, their rotation is the orientation of the whole model, which renders from all sides anyway.
+    :param skeleton:
+    :return: (K,) bone indices
+    """
+    joint_indices, _ = skeleton.get_joint_indices()
+    bone_indices = set()
+
+    for joint_index in joint_indices:
+        index = int(joint_index)
+        while index != -1 and skeleton.parent_indices[index] != -1:
+            bone_indices.add(index)
+            index = int(skeleton.parent_indices[index])
+    return np.array(sorted(bone_indices), dtype=np.int64)
+
+
+def compute_pose_descriptors(quaternions: np.ndarray, bone_indices: np.ndarray) -> np.ndarray:
+    """
+    :param quaternions: (T, B, 4) local rotations of all bones, e.g. of a ResampledClip
+    :param bone_indices: (K,) bones to describe
+    :return: (T, K * 4) descriptors, quaternions are flipped to w >= 0 as q and -q are the same rotation
+    """
+    q = np.asarray(quaternions[:, bone_indices], dtype=np.float64)
+    q = np.where(q[..., 3:4] < 0.0, -q, q)
+    return q.reshape([q.shape[0], -1])
+
+
+class PoseDiversitySampler:
+    """
+    PoseDiversitySampler picks the frames whose poses differ the most, over one or many motions of a model.
+    Near-duplicate poses, e.g. of repeated dance moves, are then processed only once.
+    Poses are compared with descriptors of the relative bone rotations, after IK.
+    """
+    def __init__(self):
+        self.descriptors = []
+        self.timestamps = []
+        self.motion_indices = []
+        self.n_motions = 0
+
+    def add(self, descriptors: np.ndarray, timestamps: np.ndarray) -> int:
+        """
+        :param descriptors: (T, D) pose descriptors of a motion
+        :param timestamps: (T,)
+        :return: index of the motion
+        """
+        assert descriptors.shape[0] == timestamps.shape[0]
+        self.descriptors.append(descriptors)
+        self.timestamps.append(timestamps)
+        self.motion_indices.append(np.full([timestamps.shape[0]], self.n_motions, dtype=np.int64))
+        self.n_motions += 1
+        return self.n_motions - 1
+
+    def add_motion(self, animator: Animator, fps: float, clip_cache: ClipCache = None) -> int:
+        """
+        Candidates are all frames of the motion at fps, except timestamp 0 which is the rest pose for Animator.
+        :param animator:
+        :param fps: frames per second
+        :param clip_cache: if given, the resampled clip is loaded from the cache, or resampled and cached
+        :return: index of the motion
+        """
+        resampled = animator.load_resampled(fps, clip_cache, apply_ik=True)
+        timestamps = np.arange(0, resampled.n_frames) / fps
+        descriptors = compute_pose_descriptors(resampled.quaternions, get_descriptor_bones(animator.skeleton))
+        return self.add(descriptors[timestamps > 0.0], timestamps[timestamps > 0.0])
+
+    def __get_candidates(self):
+        descriptors = np.concatenate(self.descriptors, axis=0)
+        timestamps = np.concatenate(self.timestamps, axis=0)
+        motion_indices = np.concatenate(self.motion_indices, axis=0)
+        return descriptors, timestamps, motion_indices
+
+    def __to_selection(self, selected: np.ndarray, timestamps: np.ndarray, motion_indices: np.ndarray) -> [[float]]:
+        selection = [[] for _ in range(0, self.n_motions)]
+        for index in np.sort(selected):
+            selection[motion_indices[index]].append(float(timestamps[index]))
+        return selection
+
+    def select_diverse(self, n_frames: int) -> [[float]]:
+        """
+        Greedy farthest-point sampling: every new frame is the one farthest from all frames chosen so far.
+        The first frame is the one farthest from the mean pose.
+        A new frame only gets closer to frames within the current farthest distance of it, which a KD-tree finds.
+        :param n_frames: number of frames to choose, fewer are chosen if the frames have fewer distinct poses
+        :return: sorted timestamps of each motion
+        """
+        descriptors, timestamps, motion_indices = self.__get_candidates()
+        n_frames = min(n_frames, descriptors.shape[0])
+        if n_frames <= 0:
+            return self.__to_selection(np.zeros([0], dtype=np.int64), timestamps, motion_indices)
+
+        tree = cKDTree(descriptors)
+        selected = [int(np.argmax(np.linalg.norm(descriptors - descriptors.mean(axis=0), axis=1)))]
+        distances = np.linalg.norm(descriptors - descriptors[selected[0]], axis=1)
+
+        while len(selected) < n_frames:
+            index = int(np.argmax(distances))
+            # every remaining frame repeats a chosen pose
+            if distances[index] <= 0.0:
+                break
+            selected.append(index)
+            neighbours = np.array(tree.query_ball_point(descriptors[index], distances[index]), dtype=np.int64)
+            distances[neighbours] = np.minimum(
+                distances[neighbours], np.linalg.norm(descriptors[neighbours] - descriptors[index], axis=1))
+        return self.__to_selection(np.array(selected, dtype=np.int64), timestamps, motion_indices)
+
+    def select_distinct(self, distance: float) -> [[float]]:
+        """
+        Greedy in time order: a frame is chosen unless it is within distance of a frame chosen before.
+        Neighbours are found with a KD-tree over all frames.
+        :param distance: minimum distance between the descriptors of chosen frames
+        :return: sorted timestamps of each motion
+        """
+        descriptors, timestamps, motion_indices = self.__get_candidates()
+        tree = cKDTree(descriptors)
+        suppressed = np.zeros([descriptors.shape[0]], dtype=bool)
+        selected = []
+
+        for index in range(0, descriptors.shape[0]):
+            if suppressed[index]:
+                continue
+            selected.append(index)
+            suppressed[tree.query_ball_point(descriptors[index], distance)] = True
+        return self.__to_selection(np.array(selected, dtype=np.int64), timestamps, motion_indices)
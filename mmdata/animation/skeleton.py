@@ -5,10 +5,124 @@ import mmdata.utils.quaternion_utils as quaternion_utils
 from mmdata.configs.bone_dictionary import bone_jp_to_eng_converter
 
 
+def compose_matrices(positions: np.ndarray, quaternions: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """
+    Build local matrices of many bones at once.
+    :param positions: (N, 3)
+    :param quaternions: (N, 4)
+    :param scales: (N, 3)
+    :return: (N, 4, 4)
+    """
+    p, q, s = positions, quaternions, scales
+    qx2, qy2, qz2 = (q[:, 0] + q[:, 0]), (q[:, 1] + q[:, 1]), (q[:, 2] + q[:, 2])
+    qxx, qxy, qxz = (q[:, 0] * qx2), (q[:, 0] * qy2), (q[:, 0] * qz2)
+    qyy, qyz, qzz = (q[:, 1] * qy2), (q[:, 1] * qz2), (q[:, 2] * qz2)
+    qwx, qwy, qwz = (q[:, 3] * qx2), (q[:, 3] * qy2), (q[:, 3] * qz2)
+
+    matrices = np.zeros([positions.shape[0], 4, 4])
+    matrices[:, 0, 0] = (1.0 - (qyy + qzz)) * s[:, 0]
+    matrices[:, 0, 1] = (qxy - qwz) * s[:, 1]
+    matrices[:, 0, 2] = (qxz + qwy) * s[:, 2]
+    matrices[:, 0, 3] = p[:, 0]
+    matrices[:, 1, 0] = (qxy + qwz) * s[:, 0]
+    matrices[:, 1, 1] = (1.0 - (qxx + qzz)) * s[:, 1]
+    matrices[:, 1, 2] = (qyz - qwx) * s[:, 2]
+    matrices[:, 1, 3] = p[:, 1]
+    matrices[:, 2, 0] = (qxz - qwy) * s[:, 0]
+    matrices[:, 2, 1] = (qyz + qwx) * s[:, 1]
+    matrices[:, 2, 2] = (1.0 - (qxx + qyy)) * s[:, 2]
+    matrices[:, 2, 3] = p[:, 2]
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
+def compose_matrix(position: np.ndarray, quaternion: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """
+    Same as compose_matrices for one bone, without the overhead of array operations on tiny arrays.
+    :param position: (3,)
+    :param quaternion: (4,)
+    :param scale: (3,)
+    :return: (4, 4)
+    """
+    px, py, pz = position.tolist()
+    x, y, z, w = quaternion.tolist()
+    sx, sy, sz = scale.tolist()
+    qx2, qy2, qz2 = (x + x), (y + y), (z + z)
+    qxx, qxy, qxz = (x * qx2), (x * qy2), (x * qz2)
+    qyy, qyz, qzz = (y * qy2), (y * qz2), (z * qz2)
+    qwx, qwy, qwz = (w * qx2), (w * qy2), (w * qz2)
+
+    return np.array([
+        [(1.0 - (qyy + qzz)) * sx, (qxy - qwz) * sy, (qxz + qwy) * sz, px],
+        [(qxy + qwz) * sx, (1.0 - (qxx + qzz)) * sy, (qyz - qwx) * sz, py],
+        [(qxz - qwy) * sx, (qyz + qwx) * sy, (1.0 - (qxx + qyy)) * sz, pz],
+        [0.0, 0.0, 0.0, 1.0],
+    ])
+
+
+def decompose_matrix(mw: np.ndarray):
+    """
+    :param mw: (4, 4) world matrix
+    :return: position (3,), quaternion (4,), scale (3,)
+    """
+    position = mw[:3, 3].copy()
+    scale = np.array([
+        np.linalg.norm(np.array([mw[0, 0], mw[1, 0], mw[2, 0]])),
+        np.linalg.norm(np.array([mw[0, 1], mw[1, 1], mw[2, 1]])),
+        np.linalg.norm(np.array([mw[0, 2], mw[1, 2], mw[2, 2]])),
+    ])
+
+    if np.linalg.det(mw) < 0.0:
+        scale[0] = -scale[0]
+
+    temp_m = mw.copy()
+    temp_m[:, 0] *= (1.0 / scale[0])
+    temp_m[:, 1] *= (1.0 / scale[1])
+    temp_m[:, 2] *= (1.0 / scale[2])
+    q = quaternion_utils.quaternion_from_rotation_matrix(temp_m)
+    return position, q, scale
+
+
+class SkeletonPose:
+    """
+    Transforms of N bones stored in flat arrays: local TRS, local matrices and world matrices.
+    World matrices of stale bones are out of date, see Skeleton.invalidate.
+    """
+    def __init__(self, n: int):
+        self.positions = np.zeros([n, 3])
+        self.quaternions = np.zeros([n, 4])
+        self.quaternions[:, 3] = 1.0
+        self.scales = np.ones([n, 3])
+        self.matrices = np.tile(np.eye(4), [n, 1, 1])
+        self.matrix_world = np.tile(np.eye(4), [n, 1, 1])
+        self.stale = np.zeros([n], dtype=bool)
+        # number of world matrices computed, reset by its owner, e.g. once per frame
+        self.matrix_updates = 0
+
+    def copy_from(self, other: SkeletonPose):
+        self.positions[...] = other.positions
+        self.quaternions[...] = other.quaternions
+        self.scales[...] = other.scales
+        self.matrices[...] = other.matrices
+        self.matrix_world[...] = other.matrix_world
+        self.stale[...] = other.stale
+        return self
+
+
+class _BoneStorage:
+    """
+    Storage of a Bone that does not belong to a Skeleton yet.
+    """
+    def __init__(self):
+        self.pose = SkeletonPose(1)
+        self.rest = SkeletonPose(1)
+
+
 class Bone:
     """
     Bone is a component of a big Skeleton.
     Bone may have a parent and zero-N children.
+    Transforms are views into the arrays of the Skeleton that owns the Bone.
     """
     def __init__(self, name: str, position: np.ndarray, quaternion: np.ndarray, scale: np.ndarray):
         """
@@ -18,18 +132,79 @@ class Bone:
         :param scale: (3,)
         """
         self.name = name
+        self._storage = _BoneStorage()
+        self._index = 0
         self.position = position
         self.quaternion = quaternion
         self.scale = scale
-        self.rest_position = position
-        self.rest_quaternion = quaternion
-        self.rest_scale = scale
+        self._storage.rest.copy_from(self._storage.pose)
 
         self.matrix = self.compute_local_matrix()
         self.matrix_world = self.matrix.copy()
         self.parent = None
         self.children = []
 
+    def bind(self, storage, index: int):
+        """
+        Move the Bone into the arrays of a Skeleton.
+        :param storage: object that has pose and rest, e.g. Skeleton
+        :param index: index of the Bone in storage
+        """
+        self._storage = storage
+        self._index = index
+
+    @property
+    def position(self) -> np.ndarray:
+        return self._storage.pose.positions[self._index]
+
+    @position.setter
+    def position(self, value: np.ndarray):
+        self._storage.pose.positions[self._index] = value
+
+    @property
+    def quaternion(self) -> np.ndarray:
+        return self._storage.pose.quaternions[self._index]
+
+    @quaternion.setter
+    def quaternion(self, value: np.ndarray):
+        self._storage.pose.quaternions[self._index] = value
+
+    @property
+    def scale(self) -> np.ndarray:
+        return self._storage.pose.scales[self._index]
+
+    @scale.setter
+    def scale(self, value: np.ndarray):
+        self._storage.pose.scales[self._index] = value
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._storage.pose.matrices[self._index]
+
+    @matrix.setter
+    def matrix(self, value: np.ndarray):
+        self._storage.pose.matrices[self._index] = value
+
+    @property
+    def matrix_world(self) -> np.ndarray:
+        return self._storage.pose.matrix_world[self._index]
+
+    @matrix_world.setter
+    def matrix_world(self, value: np.ndarray):
+        self._storage.pose.matrix_world[self._index] = value
+
+    @property
+    def rest_position(self) -> np.ndarray:
+        return self._storage.rest.positions[self._index]
+
+    @property
+    def rest_quaternion(self) -> np.ndarray:
+        return self._storage.rest.quaternions[self._index]
+
+    @property
+    def rest_scale(self) -> np.ndarray:
+        return self._storage.rest.scales[self._index]
+
     def rest_pose(self):
         self.position = self.rest_position
         self.quaternion = self.rest_quaternion
@@ -37,40 +212,11 @@ class Bone:
         self.matrix = self.compute_local_matrix()
 
     def compute_local_matrix(self):
-        p = self.position
-        q = self.quaternion
-        s = self.scale
-        qx2, qy2, qz2 = (q[0] + q[0]), (q[1] + q[1]), (q[2] + q[2])
-        qxx, qxy, qxz = (q[0] * qx2), (q[0] * qy2), (q[0] * qz2)
-        qyy, qyz, qzz = (q[1] * qy2), (q[1] * qz2), (q[2] * qz2)
-        qwx, qwy, qwz = (q[3] * qx2), (q[3] * qy2), (q[3] * qz2)
-
-        matrix_world = np.array([
-            [(1.0 - (qyy + qzz)) * s[0], (qxy - qwz) * s[1], (qxz + qwy) * s[2], p[0]],
-            [(qxy + qwz) * s[0], (1.0 - (qxx + qzz)) * s[1], (qyz - qwx) * s[2], p[1]],
-            [(qxz - qwy) * s[0], (qyz + qwx) * s[1], (1.0 - (qxx + qyy)) * s[2], p[2]],
-            [0.0, 0.0, 0.0, 1.0],
-        ])
-        return matrix_world
+        pose, i = self._storage.pose, self._index
+        return compose_matrices(pose.positions[i:(i + 1)], pose.quaternions[i:(i + 1)], pose.scales[i:(i + 1)])[0]
 
     def decompose_matrix_world(self):
-        mw = self.matrix_world
-        position = self.matrix_world[:3, 3].copy()
-        scale = np.array([
-            np.linalg.norm(np.array([mw[0, 0], mw[1, 0], mw[2, 0]])),
-            np.linalg.norm(np.array([mw[0, 1], mw[1, 1], mw[2, 1]])),
-            np.linalg.norm(np.array([mw[0, 2], mw[1, 2], mw[2, 2]])),
-        ])
-
-        if np.linalg.det(mw) < 0.0:
-            scale[0] = -scale[0]
-
-        temp_m = self.matrix_world.copy()
-        temp_m[:, 0] *= (1.0 / scale[0])
-        temp_m[:, 1] *= (1.0 / scale[1])
-        temp_m[:, 2] *= (1.0 / scale[2])
-        q = quaternion_utils.quaternion_from_rotation_matrix(temp_m)
-        return position, q, scale
+        return decompose_matrix(self.matrix_world)
 
     def add(self, child: Bone):
         """
@@ -84,7 +230,7 @@ class Bone:
     def update_matrix_world(self):
         self.matrix = self.compute_local_matrix()
         if self.parent is None:
-            self.matrix_world = self.matrix.copy()
+            self.matrix_world = self.matrix
         else:
             self.matrix_world = np.matmul(self.parent.matrix_world, self.matrix)
         for child in self.children:
@@ -96,51 +242,246 @@ class Skeleton:
     """
     Skeleton is a hierarchy of Bones.
     Some Bones are top-most bones, which do not have a parent.
+    Transforms of all Bones live in flat arrays, world matrices are updated one tree level at a time.
+    Methods that take a SkeletonPose only read the Skeleton, so one Skeleton can pose many SkeletonPoses at once.
+    By default, they work on the pose of the Skeleton itself.
     """
     def __init__(self, bones: [Bone], top_most: [Bone]):
         self.bones = bones
         self.top_most = top_most
         self.bone_inverses = None
         self.bone_matrices = None
+        self.rest_bone_matrices = None
         self.bone_by_name = dict()
+        self.bone_index_by_name = dict()
+
+        # hierarchy
+        bone_index_dict = {id(bone): bone_index for bone_index, bone in enumerate(bones)}
+        self.parent_indices = np.array([
+            bone_index_dict.get(id(bone.parent), -1) if bone.parent is not None else -1 for bone in bones], dtype=np.int64)
+        self.depths = self.__compute_depths(self.parent_indices)
+        self.order = np.argsort(self.depths, kind="stable")
+        self.levels = [self.order[self.depths[self.order] == depth] for depth in range(0, int(self.depths.max(initial=-1)) + 1)]
+        self.subtrees = self.__compute_subtrees(self.parent_indices)
+
+        # move bone transforms into flat arrays
+        self.pose = SkeletonPose(len(bones))
+        self.rest = SkeletonPose(len(bones))
+
+        for bone_index, bone in enumerate(bones):
+            self.rest.positions[bone_index] = bone.rest_position
+            self.rest.quaternions[bone_index] = bone.rest_quaternion
+            self.rest.scales[bone_index] = bone.rest_scale
+            self.pose.positions[bone_index] = bone.position
+            self.pose.quaternions[bone_index] = bone.quaternion
+            self.pose.scales[bone_index] = bone.scale
+            bone.bind(self, bone_index)
+
+        # bind pose does not change between frames, compute it once and freeze it
+        self.__build_bind_pose()
         self.rest_pose()
 
-    def rest_pose(self):
-        self.bone_matrices = np.zeros([len(self.bones), 4, 4], dtype=np.float32)
-        bone_inverses = []
+    @staticmethod
+    def __compute_depths(parent_indices: np.ndarray) -> np.ndarray:
+        depths = np.full(parent_indices.shape, -1, dtype=np.int64)
 
-        for i in range(0, len(self.bones)):
-            self.bones[i].rest_pose()
+        for bone_index in range(0, parent_indices.shape[0]):
+            chain = []
+            index = bone_index
+            while index != -1 and depths[index] == -1:
+                chain.append(index)
+                index = parent_indices[index]
+            depth = -1 if index == -1 else depths[index]
+            for index in reversed(chain):
+                depth += 1
+                depths[index] = depth
+        return depths
+
+    @staticmethod
+    def __compute_subtrees(parent_indices: np.ndarray) -> [[int]]:
+        """
+        :param parent_indices:
+        :return: every bone followed by its descendants, parents before children like Bone.update_matrix_world
+        """
+        children = [[] for _ in range(0, parent_indices.shape[0])]
+        for bone_index, parent_index in enumerate(parent_indices):
+            if parent_index != -1:
+                children[parent_index].append(bone_index)
 
-        for top_bone in self.top_most:
-            top_bone.update_matrix_world()
+        subtrees = []
+        for bone_index in range(0, parent_indices.shape[0]):
+            subtree = []
+            stack = [bone_index]
+            while len(stack) > 0:
+                index = stack.pop()
+                subtree.append(index)
+                stack += reversed(children[index])
+            subtrees.append(subtree)
+        return subtrees
 
-        for i in range(0, len(self.bones)):
-            inverse = np.linalg.inv(self.bones[i].matrix_world)
-            bone_inverses.append(inverse)
-        self.bone_inverses = np.stack(bone_inverses, axis=0)
+    def __build_bind_pose(self):
+        self.pose.copy_from(self.rest)
+        self.update_matrix_world()
+        self.rest.copy_from(self.pose)
+        self.bone_inverses = np.linalg.inv(self.rest.matrix_world)
+        self.rest_bone_matrices = np.matmul(self.rest.matrix_world, self.bone_inverses).astype(np.float32)
+        self.bone_matrices = self.rest_bone_matrices.copy()
 
-        for bone in self.bones:
+        for bone_index, bone in enumerate(self.bones):
             self.bone_by_name[bone.name] = bone
+            self.bone_index_by_name[bone.name] = bone_index
+
+        for array in [
+                self.rest.positions, self.rest.quaternions, self.rest.scales, self.rest.matrices, self.rest.matrix_world,
+                self.bone_inverses, self.rest_bone_matrices]:
+            array.setflags(write=False)
         return
 
-    def update_matrix_world(self):
-        for bone in self.top_most:
-            bone.update_matrix_world()
+    def rest_pose(self, pose: SkeletonPose = None, bone_matrices: np.ndarray = None):
+        """
+        Reset all bones to the cached bind pose.
+        :param pose: default is the pose of the Skeleton
+        :param bone_matrices: (B, 4, 4) default is bone_matrices of the Skeleton
+        """
+        pose = self.pose if pose is None else pose
+        bone_matrices = self.bone_matrices if bone_matrices is None else bone_matrices
+        pose.copy_from(self.rest)
+        bone_matrices[...] = self.rest_bone_matrices
         return
 
-    def update_bone_matrices(self):
-        for bone_index, bone in enumerate(self.bones):
-            offset_matrix = np.matmul(bone.matrix_world, self.bone_inverses[bone_index])
-            self.bone_matrices[bone_index, ...] = offset_matrix
+    def update_matrix_world(self, pose: SkeletonPose = None):
+        pose = self.pose if pose is None else pose
+        pose.matrices[...] = compose_matrices(pose.positions, pose.quaternions, pose.scales)
+
+        for depth, level in enumerate(self.levels):
+            if depth == 0:
+                pose.matrix_world[level] = pose.matrices[level]
+            else:
+                pose.matrix_world[level] = np.matmul(pose.matrix_world[self.parent_indices[level]], pose.matrices[level])
+        pose.stale[...] = False
+        pose.matrix_updates += len(self.bones)
+        return
+
+    def invalidate(self, bone_indices, pose: SkeletonPose = None):
+        """
+        Rebuild the local matrices of bones whose transforms have changed, and mark their subtrees as stale.
+        World matrices are recomputed later, on access or by update_stale_matrix_world.
+        :param bone_indices: bone index, or list of bone indices
+        :param pose:
+        """
+        pose = self.pose if pose is None else pose
+        if np.ndim(bone_indices) == 0:
+            pose.matrices[bone_indices] = compose_matrix(
+                pose.positions[bone_indices], pose.quaternions[bone_indices], pose.scales[bone_indices])
+            pose.stale[self.subtrees[bone_indices]] = True
+            return
+
+        pose.matrices[bone_indices] = compose_matrices(
+            pose.positions[bone_indices], pose.quaternions[bone_indices], pose.scales[bone_indices])
+        for bone_index in bone_indices:
+            pose.stale[self.subtrees[bone_index]] = True
+        return
+
+    def get_matrix_world(self, bone_index: int, pose: SkeletonPose = None) -> np.ndarray:
+        """
+        Bring the world matrix of a bone up to date, along with its stale ancestors only.
+        :param bone_index:
+        :param pose:
+        :return: (4, 4) world matrix, a view into the pose
+        """
+        pose = self.pose if pose is None else pose
+        chain = []
+        index = bone_index
+        while index != -1 and pose.stale[index]:
+            chain.append(index)
+            index = self.parent_indices[index]
+
+        for index in reversed(chain):
+            parent_index = self.parent_indices[index]
+            if parent_index == -1:
+                pose.matrix_world[index] = pose.matrices[index]
+            else:
+                pose.matrix_world[index] = np.matmul(pose.matrix_world[parent_index], pose.matrices[index])
+            pose.stale[index] = False
+        pose.matrix_updates += len(chain)
+        return pose.matrix_world[bone_index]
+
+    def get_world_position(self, bone_index: int, pose: SkeletonPose = None) -> np.ndarray:
+        """
+        :param bone_index:
+        :param pose:
+        :return: (3,) world position of the bone, a view into the pose
+        """
+        return self.get_matrix_world(bone_index, pose)[:3, 3]
+
+    def update_stale_matrix_world(self, pose: SkeletonPose = None):
+        """
+        Same as update_matrix_world, but only stale bones are recomputed.
+        :param pose:
+        """
+        pose = self.pose if pose is None else pose
+
+        for depth, level in enumerate(self.levels):
+            level = level[pose.stale[level]]
+            if level.shape[0] == 0:
+                continue
+            if depth == 0:
+                pose.matrix_world[level] = pose.matrices[level]
+            else:
+                pose.matrix_world[level] = np.matmul(pose.matrix_world[self.parent_indices[level]], pose.matrices[level])
+            pose.matrix_updates += level.shape[0]
+        pose.stale[...] = False
         return
 
-    def get_bone_vertices(self):
+    def update_subtree_matrix_world(self, bone_index: int, pose: SkeletonPose = None):
+        """
+        Same as Bone.update_matrix_world: update a bone and all of its descendants.
+        :param bone_index:
+        :param pose:
+        """
+        pose = self.pose if pose is None else pose
+        subtree = self.subtrees[bone_index]
+        if self.parent_indices[bone_index] != -1:
+            self.get_matrix_world(self.parent_indices[bone_index], pose)
+        # local matrices do not depend on each other, build them at once
+        pose.matrices[subtree] = compose_matrices(pose.positions[subtree], pose.quaternions[subtree], pose.scales[subtree])
+
+        for index in subtree:
+            parent_index = self.parent_indices[index]
+            if parent_index == -1:
+                pose.matrix_world[index] = pose.matrices[index]
+            else:
+                pose.matrix_world[index] = np.matmul(pose.matrix_world[parent_index], pose.matrices[index])
+        pose.stale[subtree] = False
+        pose.matrix_updates += len(subtree)
+        return
+
+    def decompose_matrix_world(self, bone_index: int, pose: SkeletonPose = None):
+        return decompose_matrix(self.get_matrix_world(bone_index, pose))
+
+    def update_bone_matrices(self, pose: SkeletonPose = None, bone_matrices: np.ndarray = None):
+        pose = self.pose if pose is None else pose
+        bone_matrices = self.bone_matrices if bone_matrices is None else bone_matrices
+        bone_matrices[...] = np.matmul(pose.matrix_world, self.bone_inverses)
+        return
+
+    def get_joint_indices(self):
+        """
+        Joints are the bones that bone_jp_to_eng_converter knows, in bone order, as in get_bone_vertices.
+        :return: (J,) bone indices, English names of the joints
+        """
+        joint_indices = [bone_index for bone_index, bone in enumerate(self.bones) if bone.name in bone_jp_to_eng_converter]
+        joint_names = [bone_jp_to_eng_converter[self.bones[bone_index].name] for bone_index in joint_indices]
+        return np.array(joint_indices, dtype=np.int64), joint_names
+
+    def get_bone_vertices(self, pose: SkeletonPose = None):
+        pose = self.pose if pose is None else pose
         bone_vertices = []
 
-        for bone in self.bones:
+        for bone_index, bone in enumerate(self.bones):
             if bone.name in bone_jp_to_eng_converter:
-                position, _, _ = bone.decompose_matrix_world()
+                # world position is the translation of the world matrix
+                position = pose.matrix_world[bone_index, :3, 3]
                 position = [position[0], position[1], position[2]]
                 bone_vertices.append({
                     "name": bone_jp_to_eng_converter.get(bone.name, ""),
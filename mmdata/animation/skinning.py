@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class SkinningEngine:
+    """
+    SkinningEngine applies linear blend skinning to every vertex at once.
+    Bone indices and weights of BDEF1/BDEF2/BDEF4 deforms are packed into (V, 4) arrays.
+    """
+    def __init__(self, skin_indices: np.ndarray, skin_weights: np.ndarray):
+        """
+        :param skin_indices: (V, 4) bone indices
+        :param skin_weights: (V, 4) bone weights
+        """
+        assert skin_indices.shape == skin_weights.shape
+        self.skin_indices = np.ascontiguousarray(skin_indices, dtype=np.int64)
+        self.skin_weights = np.ascontiguousarray(skin_weights, dtype=np.float64)
+
+    def skin(self, vertices: np.ndarray, bone_matrices: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Warp rest vertices with the current bone matrices.
+        Leading dimensions of bone_matrices are batch dimensions, e.g. (T, B, 4, 4) skins T frames at once.
+        :param vertices: (V, 3) rest vertices
+        :param bone_matrices: (..., B, 4, 4) offset matrices of the skeleton
+        :param out: (..., V, 3) buffer to write into, a new one is created if None
+        :return: (..., V, 3) skinned vertices
+        """
+        homogeneous = np.concatenate([vertices, np.ones([vertices.shape[0], 1])], axis=1)[..., None]
+        if out is None:
+            skinned = np.zeros(bone_matrices.shape[:-3] + (vertices.shape[0], 3))
+        else:
+            skinned = out
+            skinned[...] = 0.0
+
+        for j in range(0, self.skin_indices.shape[1]):
+            weights = self.skin_weights[:, j]
+            # skip influences that no vertex uses, e.g. the last 2 slots of BDEF2
+            if not np.any(weights):
+                continue
+            matrices = bone_matrices[..., self.skin_indices[:, j], :3, :]
+            skinned += np.matmul(matrices, homogeneous)[..., 0] * weights[:, None]
+        return skinned
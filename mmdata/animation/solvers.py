@@ -1,6 +1,9 @@
+from __future__ import annotations
+
 import math
 import numpy as np
 import mmdata.utils.quaternion_utils as quaternion_utils
+from mmdata.animation.skeleton import SkeletonPose
 
 
 class GrantSolver:
@@ -8,62 +11,246 @@ class GrantSolver:
         self.skeleton = skeleton
         self.grants = grants
 
-    def update(self):
-        for grant in self.grants:
-            self.__update_one(grant)
-        return
+        # grants are sorted from parent to children, grants of one level do not depend on each other
+        grant_levels = dict()
+        levels = []
+
+        for grant in grants:
+            level = grant_levels.get(grant["parent_index"], -1) + 1
+            grant_levels[grant["index"]] = level
+            if grant["is_local"] or not grant["affect_rotation"]:
+                # TODO: no implementation for local and position grants
+                continue
+            while len(levels) <= level:
+                levels.append([])
+            levels[level].append(grant)
+
+        self.rotation_levels = [
+            (
+                np.array([grant["index"] for grant in level_grants], dtype=np.int64),
+                np.array([grant["parent_index"] for grant in level_grants], dtype=np.int64),
+                np.array([grant["ratio"] for grant in level_grants], dtype=np.float64),
+            )
+            for level_grants in levels if len(level_grants) > 0
+        ]
+        self.bone_indices = np.concatenate([bone_indices for bone_indices, _, _ in self.rotation_levels] + [np.zeros([0], dtype=np.int64)])
 
-    def __update_one(self, grant):
-        bone = self.skeleton.bones[grant["index"]]
-        parent_bone = self.skeleton.bones[grant["parent_index"]]
-
-        if grant["is_local"]:
-            # TODO: no implementation
-            pass
-        else:
-            if grant["affect_position"]:
-                # TODO: no implementation
-                pass
-            if grant["affect_rotation"]:
-                self.__add_grant_rotation(bone, parent_bone.quaternion, grant["ratio"])
+    def update(self, pose: SkeletonPose = None):
+        """
+        :param pose: default is the pose of the skeleton
+        """
+        pose = self.skeleton.pose if pose is None else pose
+        quaternions = pose.quaternions
+        identity = np.array([0.0, 0.0, 0.0, 1.0])
+
+        for bone_indices, parent_indices, ratios in self.rotation_levels:
+            temp_q = quaternion_utils.batch_slerp(identity[None], quaternions[parent_indices], ratios)
+            quaternions[bone_indices] = quaternion_utils.batch_multiply_quaternions(quaternions[bone_indices], temp_q)
+        if self.bone_indices.shape[0] > 0:
+            self.skeleton.invalidate(self.bone_indices, pose)
         return
 
-    def __add_grant_rotation(self, bone, q, ratio):
-        temp_q = np.array([0.0, 0.0, 0.0, 1.0])
-        temp_q = quaternion_utils.slerp(temp_q, q, ratio)
-        bone.quaternion = quaternion_utils.multiply_quaternions(bone.quaternion, temp_q)
+
+def get_two_bone_chain(ik, parent_indices: np.ndarray):
+    """
+    Detect knee-style chains: the effector is a child of a hinge, e.g. a knee whose rotation is limited to one axis,
+    and the hinge is a child of a free joint, e.g. a thigh.
+    :param ik: IK of Geometry.iks
+    :param parent_indices: (B,) parent of each bone, -1 for roots
+    :return: (hinge link, root link, hinge axis) or None if the chain is not a two-bone chain
+    """
+    links = ik["links"]
+    if len(links) != 2 or not all(link["enabled"] for link in links):
+        return None
+    hinge, root = links
+    if root["limit_rotation"] or not hinge["limit_rotation"]:
+        return None
+    if parent_indices[ik["effector"]] != hinge["index"] or parent_indices[hinge["index"]] != root["index"]:
+        return None
+
+    # exactly one axis may rotate
+    free_axes = [k for k in range(0, 3) if hinge["rotation_min"][k] != 0.0 or hinge["rotation_max"][k] != 0.0]
+    if len(free_axes) != 1:
+        return None
+    return hinge, root, free_axes[0]
+
+
+class IkHistory:
+    """
+    Solved IK links of the previous frame of one sequence, see IkSolver.update.
+    Warm starts replace the keyframed rotations of IK links, as CCD would override them anyway.
+    """
+    def __init__(self, max_target_jump=1.0, min_iterations=2, min_progress=1e-4):
+        """
+        :param max_target_jump: distance the target may move between frames, beyond it the IK is cold-started
+        :param min_iterations: smallest iteration cap of a warm start
+        :param min_progress: a warm start stops once an iteration brings the effector closer by less than this distance
+        """
+        self.max_target_jump = max_target_jump
+        self.min_iterations = min_iterations
+        self.min_progress = min_progress
+        # IK index -> (target position, link quaternions, iterations)
+        self.entries = dict()
+
+    def reset(self):
+        self.entries.clear()
 
 
 class IkSolver:
-    def __init__(self, skeleton, iks):
+    def __init__(self, skeleton, iks, analytic=False, tolerance: float = None):
+        """
+        :param skeleton:
+        :param iks: IKs of Geometry
+        :param analytic: solve two-bone chains, e.g. legs, in closed form instead of CCD
+        :param tolerance: stop CCD once the effector is closer to the target than this distance, None runs all iterations
+        """
         self.skeleton = skeleton
         self.iks = iks
+        self.analytic = analytic
+        self.tolerance = tolerance
+        self.two_bone_chains = [
+            get_two_bone_chain(ik, skeleton.parent_indices) if analytic else None
+            for ik in iks]
+        # for warm starts
+        self.link_indices = [np.array([link["index"] for link in ik["links"]], dtype=np.int64) for ik in iks]
 
-    def update(self):
-        for ik in self.iks:
-            self.__update_one(ik)
-        return
+    def update(self, pose: SkeletonPose = None, history: IkHistory = None) -> int:
+        """
+        :param pose: default is the pose of the skeleton
+        :param history: solved links of the previous frame, to warm-start CCD on coherent sequences
+        :return: number of CCD iterations of this frame
+        """
+        pose = self.skeleton.pose if pose is None else pose
+        n_iterations = 0
+
+        for ik_index, (ik, two_bone_chain) in enumerate(zip(self.iks, self.two_bone_chains)):
+            if two_bone_chain is not None and self.__update_two_bone(ik, two_bone_chain, pose):
+                continue
+            if history is None:
+                n_iterations += self.__update_one(ik, pose)
+                continue
+
+            iteration, min_progress = self.__warm_start(ik_index, ik, pose, history)
+            ik_iterations = self.__update_one(ik, pose, iteration, min_progress)
+            history.entries[ik_index] = (
+                self.skeleton.get_world_position(ik["target"], pose).copy(), pose.quaternions[self.link_indices[ik_index]].copy(), ik_iterations)
+            n_iterations += ik_iterations
+        return n_iterations
+
+    def __warm_start(self, ik_index: int, ik, pose: SkeletonPose, history: IkHistory) -> (int, float):
+        """
+        Start from the links of the previous frame, unless the target has jumped since then.
+        :return: iteration cap and minimum progress of this IK, None on a cold start
+        """
+        entry = history.entries.get(ik_index, None)
+        target_pos = self.skeleton.get_world_position(ik["target"], pose)
+        if entry is None or np.linalg.norm(target_pos - entry[0]) > history.max_target_jump:
+            # cold start
+            return ik["iteration"], None
 
-    def __update_one(self, ik):
-        effector = self.skeleton.bones[ik["effector"]]
-        target = self.skeleton.bones[ik["target"]]
+        previous_target_pos, link_quaternions, previous_iterations = entry
+        pose.quaternions[self.link_indices[ik_index]] = link_quaternions
+        self.skeleton.invalidate(self.link_indices[ik_index], pose)
+        # the previous frame is a close guess: allow twice its iterations, and stop when CCD stalls
+        return min(ik["iteration"], max(history.min_iterations, 2 * previous_iterations)), history.min_progress
 
-        target_pos, _, _ = target.decompose_matrix_world()
+    def __update_two_bone(self, ik, two_bone_chain, pose: SkeletonPose) -> bool:
+        """
+        Bend the hinge so that the effector is as far from the root as the target is, then swing the root onto the target.
+        :return: False if the chain is degenerate, CCD is used instead
+        """
+        skeleton = self.skeleton
+        hinge, root, axis_index = two_bone_chain
+        hinge_index, root_index = hinge["index"], root["index"]
+
+        # hinge and effector offsets in the frames of their parents, they do not change while solving
+        b = pose.positions[hinge_index]
+        c = pose.positions[ik["effector"]]
+        u = np.zeros([3])
+        u[axis_index] = 1.0
+
+        target_pos = skeleton.get_world_position(ik["target"], pose).copy()
+        root_pos = skeleton.get_world_position(root_index, pose)
+        b_norm, c_norm = np.linalg.norm(b), np.linalg.norm(c)
+        distance = min(max(np.linalg.norm(target_pos - root_pos), abs(b_norm - c_norm)), b_norm + c_norm)
+
+        # |b + R(angle) c|^2 = distance^2, R rotates around u: b.R(angle)c = const + p * cos(angle) + q * sin(angle)
+        const = np.dot(b, u) * np.dot(u, c)
+        p = np.dot(b, c) - const
+        q = np.dot(b, np.cross(u, c))
+        r = math.hypot(p, q)
+        if r < 1e-8:
+            return False
+
+        cos_value = ((distance * distance - b_norm * b_norm - c_norm * c_norm) / 2.0 - const) / r
+        phi = math.atan2(q, p)
+        delta = math.acos(min(max(cos_value, -1.0), 1.0))
+        angle_min, angle_max = hinge["rotation_min"][axis_index], hinge["rotation_max"][axis_index]
+
+        # of both solutions, take the one inside the limits, or the closest one after clamping
+        best_angle, best_error = None, None
+        for angle in [phi + delta, phi - delta]:
+            angle = math.atan2(math.sin(angle), math.cos(angle))
+            clamped = min(max(angle, angle_min), angle_max)
+            if best_error is None or abs(clamped - angle) < best_error:
+                best_angle, best_error = clamped, abs(clamped - angle)
+
+        euler = np.zeros([3])
+        euler[axis_index] = best_angle
+        pose.quaternions[hinge_index] = quaternion_utils.euler_to_quaternion(euler)
+        skeleton.invalidate(hinge_index, pose)
+
+        # swing the root, same as a CCD step without the angle limit
+        root_pos, root_q, _ = skeleton.decompose_matrix_world(root_index, pose)
+        inv_root_q = quaternion_utils.invert_quaternion(root_q)
+        effector_vec = quaternion_utils.vector_apply_quaternion(skeleton.get_world_position(ik["effector"], pose) - root_pos, inv_root_q)
+        target_vec = quaternion_utils.vector_apply_quaternion(target_pos - root_pos, inv_root_q)
+        effector_norm, target_norm = np.linalg.norm(effector_vec), np.linalg.norm(target_vec)
+        if effector_norm < 1e-8 or target_norm < 1e-8:
+            return True
+
+        effector_vec, target_vec = effector_vec / effector_norm, target_vec / target_norm
+        angle = math.acos(min(max(float(np.dot(target_vec, effector_vec)), -1.0), 1.0))
+        axis = np.cross(effector_vec, target_vec)
+        axis_norm = np.linalg.norm(axis)
+        if angle < 1e-5 or axis_norm < 1e-8:
+            return True
+
+        _q = quaternion_utils.set_quaternion_from_axis_angle(axis / axis_norm, angle)
+        pose.quaternions[root_index] = quaternion_utils.multiply_quaternions(pose.quaternions[root_index], _q)
+        skeleton.invalidate(root_index, pose)
+        return True
+
+    def __update_one(self, ik, pose: SkeletonPose, iteration: int = None, min_progress: float = None) -> int:
+        """
+        :param iteration: iteration cap, default is the one of the PMX model
+        :param min_progress: stop once an iteration brings the effector closer by less than this distance, None never stops
+        :return: number of iterations
+        """
+        skeleton = self.skeleton
+        effector_index = ik["effector"]
+
+        target_pos = skeleton.get_world_position(ik["target"], pose).copy()
         links = ik["links"]
-        iteration = ik["iteration"]
+        iteration = ik["iteration"] if iteration is None else iteration
+        n_iterations = 0
+        distance = np.inf
 
         for i in range(0, iteration):
             rotated = False
+            if self.tolerance is not None and np.linalg.norm(skeleton.get_world_position(effector_index, pose) - target_pos) < self.tolerance:
+                break
+            n_iterations += 1
 
             for link in links:
                 if not link["enabled"]:
                     continue
 
-                link_bone = self.skeleton.bones[link["index"]]
-                link_pos, link_q, link_scale = link_bone.decompose_matrix_world()
+                link_index = link["index"]
+                link_pos, link_q, link_scale = skeleton.decompose_matrix_world(link_index, pose)
                 inv_link_q = quaternion_utils.invert_quaternion(link_q)
 
-                effector_pos, _, _ = effector.decompose_matrix_world()
+                effector_pos = skeleton.get_world_position(effector_index, pose).copy()
 
                 # work in link world
                 effector_vec = effector_pos - link_pos
@@ -86,17 +273,23 @@ class IkSolver:
                 axis = np.cross(effector_vec, target_vec)
                 axis = axis / np.linalg.norm(axis)
                 _q = quaternion_utils.set_quaternion_from_axis_angle(axis, angle)
-                link_bone.quaternion = quaternion_utils.multiply_quaternions(link_bone.quaternion, _q)
+                pose.quaternions[link_index] = quaternion_utils.multiply_quaternions(pose.quaternions[link_index], _q)
 
                 if link["limit_rotation"]:
                     # TODO: fix Object3D.rotation property, conversion between Euler and Quaternion
-                    link_rotation = quaternion_utils.quaternion_to_euler(link_bone.quaternion)
+                    link_rotation = quaternion_utils.quaternion_to_euler(pose.quaternions[link_index])
                     link_rotation = np.clip(link_rotation, link["rotation_min"], link["rotation_max"])
-                    link_bone.quaternion = quaternion_utils.euler_to_quaternion(link_rotation)
+                    pose.quaternions[link_index] = quaternion_utils.euler_to_quaternion(link_rotation)
 
-                link_bone.update_matrix_world()
+                # descendants are brought up to date only when they are read
+                skeleton.invalidate(link_index, pose)
                 rotated = True
 
             if not rotated:
                 break
-        return
+            if min_progress is not None:
+                previous_distance = distance
+                distance = np.linalg.norm(skeleton.get_world_position(effector_index, pose) - target_pos)
+                if previous_distance - distance < min_progress:
+                    break
+        return n_iterations
@@ -1,15 +1,23 @@
 import sys
 import os
 import glob
+import json
 import argparse
 import logging
 import trimesh
+import numpy as np
 import mmdata.utils.mesh_utils as mesh_utils
+from typing import Union
 from natsort import natsorted
-from mmdata.animation.animator import Animator
+from mmdata.animation.animator import Animator, MESH_FORMATS
+from mmdata.animation.model_cache import ModelCache
+from mmdata.animation.clip_cache import ClipCache
+from mmdata.animation.motion import MotionCache
+from mmdata.animation.pose_sampler import PoseDiversitySampler
 from mmdata.preprocessing.preprocessor import Preprocessor
 from mmdata.renderer.renderer import Renderer
 from mmdata.configs.configs import render_config
+from mmdata.utils.posed_mesh import POSED_MESH_EXTENSION
 
 
 logging.basicConfig(
@@ -29,6 +37,16 @@ To pose a PMX model with a VMD file, use:
     mmdata pose -p ./model.pmx -v ./motion.vmd -t 10.0 -o ./mesh_output
 To generate mesh reconstruction training data, use:
     mmdata gen -p ./pmx_input -v ./motion.vmd -t 10.0 -m ./mesh_output -i ./image_output
+To generate data of many poses at once, use:
+    mmdata gen -p ./pmx_input -v ./motion.vmd --frame-range 0:300:30 -m ./mesh_output -i ./image_output
+To export every frame of a long motion as arrays, use:
+    mmdata seq -p ./model.pmx -v ./motion.vmd --start 0.0 --stop 60.0 --fps 30 -o ./sequence_output
+To export joint trajectories only, one file per motion, use:
+    mmdata joints -p ./model.pmx -v ./motion_1.vmd ./motion_2.vmd --stop 60.0 --fps 30 -o ./joint_output
+To resample motions once into the cache, for later runs with --clip_cache, use:
+    mmdata resample -p ./model.pmx -v ./motion_1.vmd ./motion_2.vmd --fps 30 --cache_dir ./cache
+To select the 100 most diverse poses of motions, for gen with --timestamps_file, use:
+    mmdata select -p ./model.pmx -v ./motion_1.vmd ./motion_2.vmd --fps 10 -n 100 -o ./selected.json
     """
     parser = argparse.ArgumentParser(prog="mmdata", description=desc, formatter_class=argparse.RawTextHelpFormatter)
     subparsers = parser.add_subparsers(help="commands", dest="command")
@@ -39,23 +57,136 @@ To generate mesh reconstruction training data, use:
     pose_parser.add_argument("--timestamp", "-t", required=True, type=float, help="timestamp in VMD file")
     pose_parser.add_argument("--output_dir", "-o", type=str, default=".", help="path to output directory")
     pose_parser.add_argument("--no_display", action="store_true", help="flag to prevent displaying the pose output")
+    pose_parser.add_argument("--cache_dir", type=str, default=None, help="path to the cache of compiled PMX models")
 
     gen_parser = subparsers.add_parser("gen")
     gen_parser.add_argument("--pmx_dir", "-p", required=True, type=str, help="path to the PMX directories")
     gen_parser.add_argument("--vmd", "-v", required=True, type=str, help="path to the VMD motion file")
-    gen_parser.add_argument("--timestamp", "-t", required=True, type=float, help="timestamp in VMD file")
+    gen_timestamp_group = gen_parser.add_mutually_exclusive_group(required=True)
+    gen_timestamp_group.add_argument("--timestamp", "-t", type=float, help="timestamp in VMD file")
+    gen_timestamp_group.add_argument("--timestamps", type=float, nargs="+", help="list of timestamps in VMD file")
+    gen_timestamp_group.add_argument("--frame-range", type=str, help="range of VMD frames (30 fps) as start:stop:step")
+    gen_timestamp_group.add_argument("--timestamps_file", type=str, help="path to the JSON output of select")
     gen_parser.add_argument("--mesh_dir", "-m", required=True, type=str, help="path to the OBJ directories")
     gen_parser.add_argument("--image_dir", "-i", required=True, type=str, help="path to the directory of output images")
+    gen_parser.add_argument("--cache_dir", type=str, default=None, help="path to the cache of compiled PMX models")
+    gen_parser.add_argument(
+        "--mesh_format", type=str, choices=MESH_FORMATS, default="obj",
+        help="OBJ, binary posed mesh that later steps read without text parsing, or both")
+    gen_parser.add_argument(
+        "--in_memory", action="store_true",
+        help="hand meshes from posing to preprocessing to rendering in memory, only final mesh files are written")
+
+    seq_parser = subparsers.add_parser("seq")
+    seq_parser.add_argument("--pmx", "-p", required=True, type=str, help="path to the PMX model file")
+    seq_parser.add_argument("--vmd", "-v", required=True, type=str, help="path to the VMD motion file")
+    seq_parser.add_argument("--start", type=float, default=0.0, help="first timestamp in VMD file")
+    seq_parser.add_argument("--stop", type=float, required=True, help="end timestamp in VMD file, excluded")
+    seq_parser.add_argument("--fps", type=float, default=30.0, help="frames per second")
+    seq_parser.add_argument("--output_dir", "-o", type=str, default=".", help="path to output directory")
+    seq_parser.add_argument("--cache_dir", type=str, default=None, help="path to the cache of compiled PMX models")
+    seq_parser.add_argument(
+        "--clip_cache", action="store_true", help="read IK-applied poses from the resampled clips of the cache")
+    add_ik_arguments(seq_parser)
+
+    joints_parser = subparsers.add_parser("joints")
+    joints_parser.add_argument("--pmx", "-p", required=True, type=str, help="path to the PMX model file")
+    joints_parser.add_argument("--vmd", "-v", required=True, type=str, nargs="+", help="paths to the VMD motion files")
+    joints_parser.add_argument("--start", type=float, default=0.0, help="first timestamp in VMD file")
+    joints_parser.add_argument("--stop", type=float, required=True, help="end timestamp in VMD file, excluded")
+    joints_parser.add_argument("--fps", type=float, default=30.0, help="frames per second")
+    joints_parser.add_argument("--output_dir", "-o", type=str, default=".", help="path to output directory")
+    joints_parser.add_argument("--cache_dir", type=str, default=None, help="path to the cache of compiled PMX models")
+    joints_parser.add_argument(
+        "--clip_cache", action="store_true", help="read IK-applied poses from the resampled clips of the cache")
+    add_ik_arguments(joints_parser)
+
+    resample_parser = subparsers.add_parser("resample")
+    resample_parser.add_argument("--pmx", "-p", required=True, type=str, help="path to the PMX model file")
+    resample_parser.add_argument("--vmd", "-v", required=True, type=str, nargs="+", help="paths to the VMD motion files")
+    resample_parser.add_argument("--fps", type=float, default=30.0, help="frames per second")
+    resample_parser.add_argument(
+        "--variant", type=str, choices=["ik", "fk", "both"], default="both", help="IK-applied, IK-free or both variants")
+    resample_parser.add_argument("--cache_dir", type=str, default=None, help="path to the cache of compiled PMX models and clips")
+    add_ik_arguments(resample_parser)
+
+    select_parser = subparsers.add_parser("select")
+    select_parser.add_argument("--pmx", "-p", required=True, type=str, help="path to the PMX model file")
+    select_parser.add_argument("--vmd", "-v", required=True, type=str, nargs="+", help="paths to the VMD motion files")
+    select_parser.add_argument("--fps", type=float, default=10.0, help="frames per second of the candidate frames")
+    select_count_group = select_parser.add_mutually_exclusive_group(required=True)
+    select_count_group.add_argument("--n_frames", "-n", type=int, help="number of the most diverse frames to select")
+    select_count_group.add_argument("--distance", type=float, help="skip frames within this pose distance of selected ones")
+    select_parser.add_argument("--output", "-o", type=str, default="selected.json", help="path to the output JSON file")
+    select_parser.add_argument("--cache_dir", type=str, default=None, help="path to the cache of compiled PMX models")
+    select_parser.add_argument(
+        "--clip_cache", action="store_true", help="read IK-applied poses from the resampled clips of the cache")
 
     return parser.parse_args(argv)
 
 
+def add_ik_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--analytic_ik", action="store_true", help="solve leg IK in closed form instead of CCD")
+    parser.add_argument("--ik_tolerance", type=float, default=None, help="effector distance at which CCD stops early")
+    parser.add_argument("--ik_warm_start", action="store_true", help="start IK from the previous frame")
+
+
+def parse_frame_range(frame_range: str) -> [float]:
+    """
+    :param frame_range: start:stop:step of VMD frames, step is optional
+    :return: timestamps
+    """
+    values = [int(v) for v in frame_range.split(":")]
+    if len(values) not in [2, 3]:
+        raise ValueError(f"Invalid frame range: {frame_range}")
+    return [frame / 30 for frame in range(*values)]
+
+
+def read_timestamps_file(timestamps_file: str, vmd_path: str) -> [float]:
+    """
+    :param timestamps_file: JSON list of timestamps, or the output of select that maps VMD paths to timestamps
+    :param vmd_path: VMD file to read the timestamps of
+    :return: timestamps
+    """
+    with open(timestamps_file, encoding="utf-8") as file:
+        content = json.load(file)
+    if isinstance(content, list):
+        return [float(t) for t in content]
+
+    for key, timestamps in content.items():
+        if os.path.abspath(key) == os.path.abspath(vmd_path):
+            return [float(t) for t in timestamps]
+    raise ValueError(f"No timestamps of {vmd_path} in {timestamps_file}")
+
+
+def get_timestamps(args) -> [float]:
+    if getattr(args, "timestamps", None):
+        return args.timestamps
+    elif getattr(args, "frame_range", None):
+        return parse_frame_range(args.frame_range)
+    elif getattr(args, "timestamps_file", None):
+        return read_timestamps_file(args.timestamps_file, args.vmd)
+    return [args.timestamp]
+
+
+def get_model_cache(args) -> Union[ModelCache, None]:
+    if getattr(args, "cache_dir", None):
+        return ModelCache(args.cache_dir)
+    return None
+
+
+def get_clip_cache(args) -> Union[ClipCache, None]:
+    if getattr(args, "clip_cache", False):
+        return ClipCache(args.cache_dir)
+    return None
+
+
 def pose_pmx_model(args):
     logger = logging.getLogger("mmdata")
 
     # init the Animator
     try:
-        animator = Animator(args.pmx, args.vmd)
+        animator = Animator(args.pmx, args.vmd, get_model_cache(args))
     except FileNotFoundError:
         logger.error("PMX/VMD file does not exist!")
         return
@@ -89,8 +220,17 @@ def pose_pmx_model(args):
 def generate_data(args):
     logger = logging.getLogger("mmdata")
 
+    try:
+        timestamps = get_timestamps(args)
+    except ValueError as e:
+        logger.error(e)
+        return
+
     # init processors
     model_dirs = natsorted(glob.glob(os.path.join(args.pmx_dir, "*")))
+    model_cache = get_model_cache(args)
+    # the VMD file is parsed once, then bound to every model
+    motion_cache = MotionCache()
     preprocessor = Preprocessor()
     # init OpenGL
     try:
@@ -103,7 +243,7 @@ def generate_data(args):
         pmx_path = glob.glob(os.path.join(model_dir, "*.pmx"))[0]
         # init the Animator
         try:
-            animator = Animator(pmx_path, args.vmd)
+            animator = Animator(pmx_path, args.vmd, model_cache, motion_cache)
         except FileNotFoundError:
             logger.error("PMX/VMD file does not exist!")
             return
@@ -112,31 +252,219 @@ def generate_data(args):
             return
 
         model_name = os.path.basename(model_dir)
-        model_pose_name = f"{model_name}_step_{args.timestamp:.2f}_model"
+        model_pose_dirs = []
+
+        for timestamp in timestamps:
+            model_pose_name = f"{model_name}_step_{timestamp:.2f}_model"
+            model_pose_dir = os.path.join(args.mesh_dir, model_pose_name)
+            os.makedirs(model_pose_dir, exist_ok=True)
+            model_pose_dirs.append(model_pose_dir)
+
+        # Animate the model, frames are processed as soon as they are written
+        if args.in_memory:
+            frames = animator.animate_meshes(timestamps, model_pose_dirs)
+        else:
+            frames = animator.animate_many(timestamps, model_pose_dirs, mesh_format=args.mesh_format)
+            frames = (frame + (None,) for frame in frames)
+        mesh_extension = ".obj" if args.mesh_format == "obj" else POSED_MESH_EXTENSION
+
+        while True:
+            try:
+                _, model_pose_dir, posed_mesh = next(frames)
+            except StopIteration:
+                break
+            except Exception as e:
+                logger.error(f"Animation failed: {e}")
+                return
+
+            # Preprocessing: normalization and computing PRT
+            try:
+                if posed_mesh is not None:
+                    preprocessor.process_mesh(posed_mesh, model_pose_dir, animator.character_name, args.mesh_format)
+                else:
+                    preprocessor.process(os.path.join(model_pose_dir, f"{model_name}{mesh_extension}"))
+            except Exception as e:
+                logger.error(f"Preprocessing failed: {e}")
+                return
+
+            # Render 3D mesh to 2D images
+            try:
+                renderer.render_mesh(model_pose_dir, posed_mesh)
+            except Exception as e:
+                logger.error(f"Rendering failed: {e}")
+                return
+    return
+
+
+def export_sequence(args):
+    """
+    Write every frame of a motion into .npy files, which are filled frame by frame through memory maps.
+    """
+    logger = logging.getLogger("mmdata")
+
+    # init the Animator
+    try:
+        animator = Animator(
+            args.pmx, args.vmd, get_model_cache(args),
+            analytic_ik=args.analytic_ik, ik_tolerance=args.ik_tolerance, ik_warm_start=args.ik_warm_start)
+        clip_cache = get_clip_cache(args)
+        resampled = animator.load_resampled(args.fps, clip_cache) if clip_cache is not None else None
+    except FileNotFoundError:
+        logger.error("PMX/VMD file does not exist!")
+        return
+    except Exception as e:
+        logger.error(f"Reading files failed: {e}")
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    n_frames = animator.count_frames(args.start, args.stop, args.fps)
+    n_vertices = animator.geometry.vertices.shape[0]
+    n_bones = len(animator.skeleton.bones)
+    n_morphs = len(animator.geometry.morph_targets)
+
+    timestamps = np.lib.format.open_memmap(
+        os.path.join(args.output_dir, "timestamps.npy"), mode="w+", dtype=np.float64, shape=(n_frames,))
+    vertices = np.lib.format.open_memmap(
+        os.path.join(args.output_dir, "vertices.npy"), mode="w+", dtype=np.float32, shape=(n_frames, n_vertices, 3))
+    bone_positions = np.lib.format.open_memmap(
+        os.path.join(args.output_dir, "bone_positions.npy"), mode="w+", dtype=np.float32, shape=(n_frames, n_bones, 3))
+    morph_weights = np.lib.format.open_memmap(
+        os.path.join(args.output_dir, "morph_weights.npy"), mode="w+", dtype=np.float32, shape=(n_frames, n_morphs))
+
+    try:
+        for i, (timestamp, frame_vertices, frame_bone_positions, frame_morph_weights) in enumerate(
+                animator.iter_frames(args.start, args.stop, args.fps, resampled)):
+            timestamps[i] = timestamp
+            vertices[i] = frame_vertices
+            bone_positions[i] = frame_bone_positions
+            morph_weights[i] = frame_morph_weights
+    except Exception as e:
+        logger.error(f"Animation failed: {e}")
+        return
+
+    for array in [timestamps, vertices, bone_positions, morph_weights]:
+        array.flush()
+    names = {
+        "bones": [bone.name for bone in animator.skeleton.bones],
+        "morphs": [morph_target["name"] for morph_target in animator.geometry.morph_targets],
+    }
+    json.dump(names, open(os.path.join(args.output_dir, "names.json"), "w+", encoding="utf-8"), indent=4, ensure_ascii=False)
+    return
 
-        model_pose_dir = os.path.join(args.mesh_dir, model_pose_name)
-        os.makedirs(model_pose_dir, exist_ok=True)
 
-        # Animate the model
+def export_joints(args):
+    """
+    Write joint trajectories of every motion into <output_dir>/<motion name>.npz, meshes are never skinned.
+    """
+    logger = logging.getLogger("mmdata")
+    model_cache = get_model_cache(args)
+    motion_cache = MotionCache()
+    clip_cache = get_clip_cache(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # the model is parsed once, then every motion is bound to it
+    animator = None
+    for vmd_path in args.vmd:
+        # init the Animator
         try:
-            animator.animate(args.timestamp, model_pose_dir)
+            if animator is None:
+                animator = Animator(
+                    args.pmx, vmd_path, model_cache, motion_cache, args.analytic_ik, args.ik_tolerance, args.ik_warm_start)
+            else:
+                animator.bind_motion(vmd_path, motion_cache)
+        except FileNotFoundError:
+            logger.error("PMX/VMD file does not exist!")
+            return
+        except Exception as e:
+            logger.error(f"Reading files failed: {e}")
+            return
+
+        motion_name = os.path.splitext(os.path.basename(vmd_path))[0]
+        timestamps = [args.start + i / args.fps for i in range(animator.count_frames(args.start, args.stop, args.fps))]
+        try:
+            resampled = animator.load_resampled(args.fps, clip_cache) if clip_cache is not None else None
+            animator.save_joints(timestamps, os.path.join(args.output_dir, f"{motion_name}.npz"), resampled)
         except Exception as e:
             logger.error(f"Animation failed: {e}")
             return
+    return
+
 
-        # Preprocessing: normalization and computing PRT
+def resample_motions(args):
+    """
+    Resample every motion into the clip cache, frames are then array slices for seq and joints with --clip_cache.
+    """
+    logger = logging.getLogger("mmdata")
+    model_cache = ModelCache(args.cache_dir)
+    motion_cache = MotionCache()
+    clip_cache = ClipCache(args.cache_dir)
+    variants = {"ik": [True], "fk": [False], "both": [True, False]}[args.variant]
+
+    # the model is parsed once, then every motion is bound to it
+    animator = None
+    for vmd_path in args.vmd:
+        # init the Animator
         try:
-            preprocessor.process(os.path.join(model_pose_dir, f"{model_name}.obj"))
+            if animator is None:
+                animator = Animator(
+                    args.pmx, vmd_path, model_cache, motion_cache, args.analytic_ik, args.ik_tolerance, args.ik_warm_start)
+            else:
+                animator.bind_motion(vmd_path, motion_cache)
+        except FileNotFoundError:
+            logger.error("PMX/VMD file does not exist!")
+            return
+        except Exception as e:
+            logger.error(f"Reading files failed: {e}")
+            return
+
+        try:
+            for apply_ik in variants:
+                animator.load_resampled(args.fps, clip_cache, apply_ik)
+        except Exception as e:
+            logger.error(f"Resampling failed: {e}")
+            return
+    return
+
+
+def select_poses(args):
+    """
+    Write the timestamps of the most diverse poses of every motion into a JSON file, which gen reads with --timestamps_file.
+    """
+    logger = logging.getLogger("mmdata")
+    model_cache = get_model_cache(args)
+    motion_cache = MotionCache()
+    clip_cache = get_clip_cache(args)
+    sampler = PoseDiversitySampler()
+
+    # the model is parsed once, then every motion is bound to it
+    animator = None
+    for vmd_path in args.vmd:
+        # init the Animator
+        try:
+            if animator is None:
+                animator = Animator(args.pmx, vmd_path, model_cache, motion_cache)
+            else:
+                animator.bind_motion(vmd_path, motion_cache)
+        except FileNotFoundError:
+            logger.error("PMX/VMD file does not exist!")
+            return
         except Exception as e:
-            logger.error(f"Preprocessing failed: {e}")
+            logger.error(f"Reading files failed: {e}")
             return
 
-        # Render 3D mesh to 2D images
         try:
-            renderer.render_mesh(model_pose_dir)
+            sampler.add_motion(animator, args.fps, clip_cache)
         except Exception as e:
-            logger.error(f"Rendering failed: {e}")
+            logger.error(f"Resampling failed: {e}")
             return
+
+    if args.n_frames is not None:
+        selection = sampler.select_diverse(args.n_frames)
+    else:
+        selection = sampler.select_distinct(args.distance)
+    # absolute paths, so gen finds the timestamps from any working directory
+    content = {os.path.abspath(vmd_path): timestamps for vmd_path, timestamps in zip(args.vmd, selection)}
+    json.dump(content, open(args.output, "w+", encoding="utf-8"), indent=4, ensure_ascii=False)
     return
 
 
@@ -145,6 +473,14 @@ def run_cli(args):
         pose_pmx_model(args)
     elif args.command == "gen":
         generate_data(args)
+    elif args.command == "seq":
+        export_sequence(args)
+    elif args.command == "joints":
+        export_joints(args)
+    elif args.command == "resample":
+        resample_motions(args)
+    elif args.command == "select":
+        select_poses(args)
     else:
         raise ValueError("Invalid command!")
     return
@@ -5,8 +5,10 @@ import pickle
 import numpy as np
 import trimesh
 import mmdata.utils.mesh_utils as mesh_utils
+import mmdata.utils.pmx_utils as pmx_utils
 import mmdata.utils.prt_utils as prt_utils
 from typing import Union
+from mmdata.utils.posed_mesh import PosedMesh, POSED_MESH_EXTENSION
 
 
 class Preprocessor:
@@ -14,17 +16,23 @@ class Preprocessor:
     Preprocessing has two steps:
         normalization, so all vertices have values [0, 1]
         computing PRT
+    Meshes are OBJ files, or binary posed meshes (see PosedMesh) that are read without text parsing.
     """
-    def __init__(self, n=40, order=2):
+    def __init__(self, n=40, order=2, max_rays=1 << 18):
+        """
+        :param n: n * n directions are sampled on the sphere
+        :param order: order of the spherical harmonics
+        :param max_rays: (vertex, direction) pairs processed at once, bounds the memory of compute_prt
+        """
         self.n = n
         self.order = order
+        self.max_rays = max_rays
 
-    def compute_prt(self, mesh_path: Union[str, pathlib.Path]):
+    def compute_prt(self, mesh_path: Union[str, pathlib.Path, PosedMesh]):
         """
-        :param mesh_path:
+        :param mesh_path: OBJ, posed mesh, or a PosedMesh in memory
         :return: PRT file
         """
-        mesh = trimesh.load(mesh_path, file_type="obj", split_object=True)
         prt_dict, face_dict, out_dict = {}, {}, {}
 
         # sample parameters
@@ -32,34 +40,8 @@ class Preprocessor:
         sh_orig = prt_utils.get_sh_coeffs(self.order, phi, theta)
         w = 4.0 * math.pi / (self.n * self.n)
 
-        for key, geometry in mesh_utils.get_mesh_geometry(mesh).items():
-            origins = geometry.vertices
-            normals = geometry.vertex_normals.copy()
-            n_v = origins.shape[0]
-
-            normals = normals * -1.0
-            origins = np.repeat(origins[:, None], self.n, axis=1).reshape(-1, 3)
-            normals = np.repeat(normals[:, None], self.n, axis=1).reshape(-1, 3)
-            prt_all = None
-
-            for i in range(0, self.n):
-                sh = np.repeat(sh_orig[None, (i * self.n):((i + 1) * self.n)], n_v, axis=0).reshape(-1, sh_orig.shape[1])
-                vectors = np.repeat(vectors_orig[None, (i * self.n):((i + 1) * self.n)], n_v, axis=0).reshape(-1, 3)
-
-                dots = (vectors * normals).sum(1)
-                front = (dots > 0.0)
-
-                delta = 1e-3 * min(geometry.bounding_box.extents)
-                hits = geometry.ray.intersects_any(origins + delta * normals, vectors)
-                no_hits = np.logical_and(front, np.logical_not(hits))
-                prt = (no_hits.astype(np.float32) * dots)[:, None] * sh
-
-                if prt_all is not None:
-                    prt_all += (prt.reshape(-1, self.n, sh.shape[1]).sum(1))
-                else:
-                    prt_all = (prt.reshape(-1, self.n, sh.shape[1]).sum(1))
-
-            prt = w * prt_all
+        for key, geometry in self.__load_mesh_geometry(mesh_path).items():
+            prt = w * self.__compute_visibility(geometry, vectors_orig, sh_orig)
             prt_dict[key] = prt
             face_dict[key] = geometry.faces
 
@@ -70,6 +52,59 @@ class Preprocessor:
             out_dict[key] = {"bounce0": prt, "face": face}
         return out_dict
 
+    def __compute_visibility(self, geometry: trimesh.Trimesh, vectors: np.ndarray, sh: np.ndarray) -> np.ndarray:
+        """
+        Back-facing (vertex, direction) pairs never contribute, so rays are cast for the front-facing ones only.
+        Vertices are processed in chunks of at most max_rays pairs.
+        :param geometry:
+        :param vectors: (D, 3) sampled directions
+        :param sh: (D, S) spherical harmonics of the directions
+        :return: (V, S) sum of cos * sh over the unoccluded directions of each vertex
+        """
+        origins = geometry.vertices
+        normals = geometry.vertex_normals * -1.0
+        delta = 1e-3 * min(geometry.bounding_box.extents)
+        prt = np.zeros([origins.shape[0], sh.shape[1]])
+        chunk_size = max(1, self.max_rays // vectors.shape[0])
+
+        for start in range(0, origins.shape[0], chunk_size):
+            chunk_normals = normals[start:(start + chunk_size)]
+            # same sum as (normals * vectors).sum(1) of each pair, without (C, D, 3) temporaries
+            dots = chunk_normals[:, 0:1] * vectors[:, 0] + chunk_normals[:, 1:2] * vectors[:, 1]
+            dots += chunk_normals[:, 2:3] * vectors[:, 2]
+            vertex_indices, direction_indices = np.nonzero(dots > 0.0)
+            if vertex_indices.shape[0] == 0:
+                continue
+
+            hits = geometry.ray.intersects_any(
+                origins[start + vertex_indices] + delta * chunk_normals[vertex_indices], vectors[direction_indices])
+            weights = np.zeros_like(dots)
+            weights[vertex_indices, direction_indices] = np.where(hits, 0.0, dots[vertex_indices, direction_indices])
+            prt[start:(start + chunk_size)] = weights @ sh
+        return prt
+
+    @staticmethod
+    def __load_mesh_geometry(mesh_path: Union[str, pathlib.Path, PosedMesh]) -> dict:
+        """
+        :param mesh_path: OBJ, posed mesh, or a PosedMesh in memory
+        :return: trimesh geometry of each object, an object holds the faces of a material
+        """
+        if isinstance(mesh_path, PosedMesh):
+            posed_mesh = mesh_path
+        elif str(mesh_path).endswith(POSED_MESH_EXTENSION):
+            posed_mesh = PosedMesh.load(mesh_path)
+        else:
+            return mesh_utils.get_mesh_geometry(trimesh.load(mesh_path, file_type="obj", split_object=True))
+
+        mesh_geometry = dict()
+        for key, faces in posed_mesh.get_material_faces().items():
+            # like OBJ objects, only the vertices that the faces use, vertex normals come from the faces too
+            vertex_indices, local_faces = np.unique(faces, return_inverse=True)
+            mesh_geometry[key] = trimesh.Trimesh(
+                vertices=posed_mesh.vertices[vertex_indices].astype(np.float64), faces=local_faces.reshape([-1, 3]),
+                process=False)
+        return mesh_geometry
+
     def __save_normalized_mesh(self, mesh_path, scale, offset):
         mesh_lines = []
         new_mesh_lines = []
@@ -98,16 +133,40 @@ class Preprocessor:
     def normalize(self, mesh_path: Union[str, pathlib.Path]):
         """
         Normalize then save the mesh.
-        :param mesh_path:
+        A posed mesh is normalized in place, and so is the OBJ next to it, if any.
+        :param mesh_path: OBJ or posed mesh
         """
-        mesh = trimesh.load(mesh_path, file_type="obj", split_object=True)
-        mesh_geometry_parts = []
+        if str(mesh_path).endswith(POSED_MESH_EXTENSION):
+            posed_mesh = PosedMesh.load(mesh_path, writable=True)
+            scale, offset = self.normalize_mesh(posed_mesh)
+            # empty arrays are not memory-mapped
+            if isinstance(posed_mesh.vertices, np.memmap):
+                posed_mesh.vertices.flush()
+            obj_path = str(mesh_path)[:-len(POSED_MESH_EXTENSION)] + ".obj"
+            if os.path.exists(obj_path):
+                self.__save_normalized_mesh(obj_path, scale, offset)
+            return
 
+        mesh_geometry_parts = []
         # get all vertices
-        for key, geometry in mesh_utils.get_mesh_geometry(mesh).items():
+        for key, geometry in self.__load_mesh_geometry(mesh_path).items():
             mesh_geometry_parts.append(geometry.vertices)
-        mesh_v = np.concatenate(mesh_geometry_parts, axis=0)
+        scale, offset = self.__get_normalization(np.concatenate(mesh_geometry_parts, axis=0))
+        self.__save_normalized_mesh(mesh_path, scale, offset)
+
+    def normalize_mesh(self, posed_mesh: PosedMesh):
+        """
+        Normalize the vertices of a posed mesh in place.
+        :param posed_mesh:
+        :return: scale and (3,) offset, normalized vertices are (vertices - offset) * scale
+        """
+        # like OBJ objects, only the vertices that the faces use
+        scale, offset = self.__get_normalization(np.asarray(posed_mesh.vertices[np.unique(posed_mesh.faces)], dtype=np.float64))
+        posed_mesh.vertices[...] = (posed_mesh.vertices - offset) * scale
+        return scale, offset
 
+    @staticmethod
+    def __get_normalization(mesh_v: np.ndarray):
         # compute bounding box of all vertices
         min_xyz = np.min(mesh_v, axis=0, keepdims=True)
         max_xyz = np.max(mesh_v, axis=0, keepdims=True)
@@ -116,16 +175,55 @@ class Preprocessor:
         # compute scale
         scale_inv = np.max(max_xyz - min_xyz)
         scale = 1.0 / scale_inv * (0.75 + 0.5 * 0.15)
-        self.__save_normalized_mesh(mesh_path, scale, offset[0])
+        return scale, offset[0]
 
     def process(self, mesh_path: Union[str, pathlib.Path]):
         """
-        :param mesh_path:
+        :param mesh_path: OBJ or posed mesh
         """
         self.normalize(mesh_path)
         out_dict = self.compute_prt(mesh_path)
 
-        bounce_dir = os.path.join(os.path.dirname(mesh_path), "bounce")
+        self.__save_prt(out_dict, os.path.dirname(mesh_path))
+
+    def process_mesh(self, posed_mesh: PosedMesh, output_dir: Union[str, pathlib.Path], mesh_name: str, mesh_format="obj"):
+        """
+        Same as process, but on a mesh in memory, see Animator.animate_meshes.
+        Only the normalized mesh and the PRT are written, the PRT is kept in posed_mesh.prt for Renderer.render_mesh.
+        Meshes are the same as those of process on the files of Animator.animate, and so is the PRT of posed meshes.
+        For an OBJ only, process gets the PRT vertices in the order of trimesh, here they are in the order of the faces.
+        :param posed_mesh: normalized in place
+        :param output_dir:
+        :param mesh_name: file name of the mesh, without extension
+        :param mesh_format: "obj", "pmesh" or "both"
+        """
+        # start from the vertices as the files of animate store them, so the meshes are the same as those of process:
+        # normalize reads the 6-decimal rows of an OBJ, or the float32 vertices of a posed mesh
+        obj_vertices = None
+        if mesh_format in ["obj", "both"]:
+            obj_vertices = np.round(np.asarray(posed_mesh.vertices, dtype=np.float64), 6)
+        if mesh_format == "obj":
+            posed_mesh.vertices = obj_vertices
+        else:
+            posed_mesh.vertices = np.array(posed_mesh.vertices, dtype=np.float32)
+
+        scale, offset = self.normalize_mesh(posed_mesh)
+        posed_mesh.prt = self.compute_prt(posed_mesh)
+
+        if mesh_format in ["obj", "both"]:
+            obj_vertices = posed_mesh.vertices if mesh_format == "obj" else (obj_vertices - offset) * scale
+            with open(os.path.join(output_dir, f"{mesh_name}.obj"), "w+") as file:
+                # shortest exact floats, same as the OBJs that normalize rewrites
+                pmx_utils.write_obj_arrays(
+                    file, obj_vertices, posed_mesh.uvs, posed_mesh.normals, posed_mesh.faces, posed_mesh.material_names,
+                    posed_mesh.face_ranges, vertex_format="v %r %r %r\n")
+        if mesh_format in ["pmesh", "both"]:
+            posed_mesh.save(os.path.join(output_dir, f"{mesh_name}{POSED_MESH_EXTENSION}"))
+        self.__save_prt(posed_mesh.prt, output_dir)
+
+    @staticmethod
+    def __save_prt(out_dict: dict, output_dir: Union[str, pathlib.Path]):
+        bounce_dir = os.path.join(output_dir, "bounce")
         os.makedirs(bounce_dir, exist_ok=True)
         pickle.dump(
             out_dict,
@@ -16,15 +16,22 @@ from PIL import Image
 from mmdata.renderer.gl.init_gl import initialize_GL_context
 from mmdata.renderer.gl.prt_render import PRTRender
 from mmdata.renderer.camera import Camera
+from mmdata.utils.posed_mesh import PosedMesh, get_posed_mesh_path
 
 
 class Renderer:
     """
     Render mesh to images with OpenGL.
     """
-    def __init__(self, config: dict, output_dir: Union[str, pathlib.Path]):
+    def __init__(self, config: dict, output_dir: Union[str, pathlib.Path], obj_cache: mesh_utils.ObjCache = None):
+        """
+        :param config:
+        :param output_dir:
+        :param obj_cache: if given, parsed OBJs are cached, e.g. when a mesh is rendered more than once
+        """
         self.config = config
         self.output_dir = output_dir
+        self.obj_cache = obj_cache
 
         # load lighting params
         initialize_GL_context(
@@ -68,10 +75,12 @@ class Renderer:
             )
         return cams
 
-    def render_mesh(self, input_dir: Union[str, pathlib.Path]):
+    def render_mesh(self, input_dir: Union[str, pathlib.Path], posed_mesh: PosedMesh = None):
         """
         Render OBJ mesh to images.
+        A binary posed mesh (see PosedMesh) is read instead of the OBJ if input_dir has one.
         :param input_dir: contains OBJ and texture files.
+        :param posed_mesh: mesh in memory, with its PRT, see Preprocessor.process_mesh. Then no mesh is read from input_dir
         """
         input_name = os.path.basename(input_dir)
         output_dir = os.path.join(self.output_dir, input_name)
@@ -82,12 +91,29 @@ class Renderer:
         os.makedirs(os.path.join(output_dir, "mask"), exist_ok=True)
         os.makedirs(os.path.join(output_dir, "meta"), exist_ok=True)
 
-        # load JSON
-        material_map = json.load(open(os.path.join(input_dir, "material.json")))
-
         # read data
-        mesh_filename = sorted(glob.glob(os.path.join(input_dir, "*.obj")))[0]
-        prt_data = pickle.load(open(os.path.join(input_dir, "bounce/prt_data.pkl"), "rb"))
+        if posed_mesh is None:
+            posed_mesh_path = get_posed_mesh_path(input_dir)
+            posed_mesh = PosedMesh.load(posed_mesh_path) if posed_mesh_path is not None else None
+        if posed_mesh is not None:
+            material_map = posed_mesh.texture_map
+            material_faces = posed_mesh.get_material_faces()
+            # vertex attributes are shared by all materials, GL buffers are float64
+            mesh_vertices = posed_mesh.vertices.astype(np.float64)
+            mesh_normals = mesh_utils.normalize_v3(posed_mesh.normals.astype(np.float64))
+            mesh_uvs = posed_mesh.uvs.astype(np.float64)
+        else:
+            material_map = json.load(open(os.path.join(input_dir, "material.json")))
+            mesh_filename = sorted(glob.glob(os.path.join(input_dir, "*.obj")))[0]
+            # every object is parsed in one pass
+            if self.obj_cache is not None:
+                obj_groups = self.obj_cache.load(mesh_filename)
+            else:
+                obj_groups = mesh_utils.load_obj_groups(mesh_filename)
+        if posed_mesh is not None and posed_mesh.prt is not None:
+            prt_data = posed_mesh.prt
+        else:
+            prt_data = pickle.load(open(os.path.join(input_dir, "bounce/prt_data.pkl"), "rb"))
 
         # texture rendering
         # while scene renderer can allocate regions for different texture images, UV renderer cannot
@@ -101,8 +127,14 @@ class Renderer:
 
             prt, face_prt = prt_data[key_name]["bounce0"], prt_data[key_name]["face"]
             text_file = os.path.join(input_dir, material_map[key_name])
-            vertices, faces, normals, faces_normals, textures, face_textures = mesh_utils.load_obj_mesh(
-                mesh_filename, key_name, with_normal=True, with_texture=True)
+            if posed_mesh is not None:
+                vertices, normals, textures = mesh_vertices, mesh_normals, mesh_uvs
+                faces = material_faces.get(key_name, np.zeros([0, 3], dtype=np.int32)).astype(np.int64)
+                faces_normals, face_textures = faces, faces
+            else:
+                if key_name not in obj_groups:
+                    continue
+                vertices, faces, normals, faces_normals, textures, face_textures = obj_groups[key_name]
 
             if not os.path.exists(text_file):
                 continue
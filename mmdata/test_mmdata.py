@@ -1,16 +1,37 @@
 import pytest
 import pathlib
+import json
+import filecmp
+import concurrent.futures
+import numpy as np
+import pymeshio.pmx.reader
+import pymeshio.vmd.reader
+import mmdata.utils.mmd_reader as mmd_reader
+import mmdata.utils.mesh_utils as mesh_utils
+import mmdata.utils.pmx_utils as pmx_utils
 from mmdata.animation.animator import Animator
+from mmdata.animation.animation_clip import AnimationClipBuilder
+from mmdata.animation.geometry import Geometry
+from mmdata.animation.skeleton import Skeleton, SkeletonPose
+from mmdata.animation.clip_sampler import ClipSampler
+from mmdata.animation.interpolation import BezierCurveCache, BezierInterpolationMethod
+from mmdata.animation.model_cache import ModelCache
+from mmdata.animation.clip_cache import ClipCache
+from mmdata.animation.motion import MotionCache
+from mmdata.preprocessing.preprocessor import Preprocessor
+from mmdata.cli import parse_arguments, parse_frame_range, read_timestamps_file, run_cli
+from mmdata.animation.pose_sampler import PoseDiversitySampler
+from mmdata.utils.posed_mesh import PosedMesh
 
 
 ASSETS_DIR = pathlib.Path(__file__).parent.parent.joinpath("assets")
 
 
-def test_animator():
+def test_animator(tmp_path):
     pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
     vmd_path = ASSETS_DIR.joinpath("walking.vmd")
     gt_obj_path = ASSETS_DIR.joinpath("mesh_data/A.obj")
-    output_dir = ASSETS_DIR.joinpath("output")
+    output_dir = tmp_path.joinpath("output")
     timestamp = 10.0
 
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -22,5 +43,448 @@ def test_animator():
     assert out_obj == gt_obj
 
 
+def test_clip_sampler():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    timestamps = np.linspace(0.1, 30.0, 50)
+
+    animator = Animator(pmx_path, vmd_path)
+    binding = animator.animation.binding
+    poses, influences = ClipSampler(animator.animation, animator.skeleton, animator.geometry).sample(timestamps)
+
+    for i, timestamp in enumerate(timestamps):
+        frame_pose = animator.animation.evaluate(timestamp)
+        assert np.allclose(poses[i, binding.bone_indices, :3], frame_pose.positions)
+        assert np.allclose(poses[i, binding.bone_indices, 3:], frame_pose.quaternions)
+        assert np.allclose(influences[i, binding.morph_indices], frame_pose.influences)
+
+
+def test_model_cache(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    gt_obj_path = ASSETS_DIR.joinpath("mesh_data/A.obj")
+    model_cache = ModelCache(tmp_path.joinpath("cache"))
+
+    for i in range(0, 2):
+        output_dir = tmp_path.joinpath(f"output_{i}")
+        output_dir.mkdir()
+        animator = Animator(pmx_path, vmd_path, model_cache)
+        animator.animate(10.0, output_dir)
+        assert open(output_dir.joinpath("A.obj")).read() == open(gt_obj_path).read()
+
+    assert model_cache.misses == 1
+    assert model_cache.hits == 1
+
+
+def test_mmd_reader():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+
+    geometry = Geometry(mmd_reader.read_pmx(pmx_path))
+    pymeshio_geometry = Geometry(pymeshio.pmx.reader.read_from_file(str(pmx_path)))
+    assert np.array_equal(geometry.vertices, pymeshio_geometry.vertices)
+    assert np.array_equal(geometry.faces, pymeshio_geometry.faces)
+    assert np.array_equal(geometry.skin_weights, pymeshio_geometry.skin_weights)
+    assert [bone["name"] for bone in geometry.bones] == [bone["name"] for bone in pymeshio_geometry.bones]
+    assert (geometry.morph_offsets != pymeshio_geometry.morph_offsets).nnz == 0
+
+    skeleton = Skeleton(*geometry.get_bone_hierarchy())
+    clip = AnimationClipBuilder().from_vmd_and_skeleton(mmd_reader.read_vmd(vmd_path), geometry, skeleton)
+    pymeshio_clip = AnimationClipBuilder().from_vmd_and_skeleton(
+        pymeshio.vmd.reader.read_from_file(str(vmd_path)), geometry, skeleton)
+    assert [track.name for track in clip.tracks] == [track.name for track in pymeshio_clip.tracks]
+    for track, pymeshio_track in zip(clip.tracks, pymeshio_clip.tracks):
+        assert np.array_equal(track.times, pymeshio_track.times)
+        assert np.array_equal(track.values, pymeshio_track.values)
+
+
+def test_motion_cache():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    motion_cache = MotionCache()
+
+    animators = [Animator(pmx_path, vmd_path, motion_cache=motion_cache) for _ in range(0, 2)]
+    assert motion_cache.misses == 1
+    assert motion_cache.hits == 1
+
+    # same bone set, so rotation tracks are shared, position tracks are per skeleton
+    bindings = [animator.animation.binding for animator in animators]
+    assert all(a is b for a, b in zip(bindings[0].rotation_tracks, bindings[1].rotation_tracks))
+    assert np.array_equal(bindings[0].bone_indices, bindings[1].bone_indices)
+    for a, b in zip(bindings[0].position_tracks, bindings[1].position_tracks):
+        assert np.array_equal(a.values, b.values)
+
+
+def test_animated_model_threads():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    timestamps = [0.0, 1.0, 2.5, 10.0, 17.3, 25.0]
+
+    model = Animator(pmx_path, vmd_path).model
+    expected = [model.get_vertices(model.pose(timestamp)) for timestamp in timestamps]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        states = list(executor.map(model.pose, timestamps * 4))
+    for i, state in enumerate(states):
+        assert np.array_equal(model.get_vertices(state), expected[i % len(timestamps)])
+
+
+def test_iter_frames():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    animator = Animator(pmx_path, vmd_path)
+
+    n_frames = 0
+    for timestamp, vertices, bone_positions, morph_weights in animator.iter_frames(0.0, 2.0, fps=10):
+        state = animator.model.pose(timestamp)
+        assert np.array_equal(vertices, animator.model.get_vertices(state))
+        assert np.array_equal(bone_positions, state.skeleton_pose.matrix_world[:, :3, 3])
+        assert np.array_equal(morph_weights, state.influences)
+        n_frames += 1
+    assert n_frames == animator.count_frames(0.0, 2.0, fps=10) == 20
+
+
+def test_compute_joints():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    animator = Animator(pmx_path, vmd_path)
+    timestamps = [0.0, 1.5, 10.0, 17.3]
+
+    joints, joint_names = animator.compute_joints(timestamps, batch_size=3)
+    assert joints.shape == (len(timestamps), len(joint_names), 3)
+
+    for i, timestamp in enumerate(timestamps):
+        bone_vertices = animator.model.get_bone_vertices(animator.model.pose(timestamp))
+        assert [bone["name"] for bone in bone_vertices] == joint_names
+        assert np.array_equal(np.array([bone["position"] for bone in bone_vertices]), joints[i])
+
+
+def test_analytic_ik():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    ccd_animator = Animator(pmx_path, vmd_path)
+    analytic_animator = Animator(pmx_path, vmd_path, analytic_ik=True)
+    ik_solver = analytic_animator.model.ik_solver
+    leg_iks = [ik for ik, chain in zip(ik_solver.iks, ik_solver.two_bone_chains) if chain is not None]
+    assert len(leg_iks) == 2
+
+    for timestamp in [0.7, 3.7, 5.0, 5.7, 10.0]:
+        ccd_state = ccd_animator.model.pose(timestamp)
+        analytic_state = analytic_animator.model.pose(timestamp)
+
+        for ik in leg_iks:
+            distances = [
+                np.linalg.norm(state.skeleton_pose.matrix_world[ik["effector"], :3, 3] - state.skeleton_pose.matrix_world[ik["target"], :3, 3])
+                for state in [ccd_state, analytic_state]]
+            assert distances[1] <= distances[0] + 1e-6
+
+
+def test_ik_warm_start(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    timestamps = np.arange(1, 91) / 30
+    distances = []
+    iterations = []
+
+    for ik_warm_start in [False, True]:
+        animator = Animator(pmx_path, vmd_path, ik_warm_start=ik_warm_start)
+        state = animator.model.create_pose_state()
+        frame_distances = []
+        for timestamp in timestamps:
+            animator.model.pose(timestamp, state)
+            matrix_world = state.skeleton_pose.matrix_world
+            frame_distances.append(np.mean([
+                np.linalg.norm(matrix_world[ik["effector"], :3, 3] - matrix_world[ik["target"], :3, 3]) for ik in animator.geometry.iks]))
+        distances.append(np.mean(frame_distances))
+
+        animator.compute_joints(timestamps)
+        iterations.append(animator.ik_iterations.sum())
+
+        # CCD iterations are recorded with warm starts only
+        joints_path = tmp_path.joinpath(f"joints_{ik_warm_start}.npz")
+        animator.save_joints(timestamps[:3], joints_path)
+        assert ("ik_iterations" in np.load(joints_path).files) == ik_warm_start
+
+    assert iterations[1] < iterations[0]
+    assert distances[1] <= distances[0] + 1e-2
+
+
+def test_skeleton_invalidate():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    geometry = Geometry(mmd_reader.read_pmx(pmx_path))
+    skeleton = Skeleton(*geometry.get_bone_hierarchy())
+    lazy_pose = skeleton.pose
+    skeleton.update_matrix_world(lazy_pose)
+
+    bone_index = skeleton.bone_index_by_name["右足"]
+    leaf_index = skeleton.subtrees[bone_index][-1]
+    lazy_pose.quaternions[bone_index] = [0.0, 0.0, np.sin(0.25), np.cos(0.25)]
+    skeleton.invalidate(bone_index)
+    assert lazy_pose.stale[skeleton.subtrees[bone_index]].all() and lazy_pose.stale.sum() == len(skeleton.subtrees[bone_index])
+
+    eager_pose = SkeletonPose(len(skeleton.bones)).copy_from(lazy_pose)
+    skeleton.update_matrix_world(eager_pose)
+    lazy_pose.matrix_updates = 0
+    # only the path from the rotated bone down to the leaf is computed
+    assert np.array_equal(skeleton.get_world_position(leaf_index), eager_pose.matrix_world[leaf_index, :3, 3])
+    assert lazy_pose.matrix_updates == skeleton.depths[leaf_index] - skeleton.depths[bone_index] + 1
+
+    skeleton.update_stale_matrix_world()
+    assert not lazy_pose.stale.any()
+    assert np.array_equal(lazy_pose.matrix_world, eager_pose.matrix_world)
+
+
+def test_clip_cache(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    clip_cache = ClipCache(tmp_path.joinpath("cache"))
+    animator = Animator(pmx_path, vmd_path)
+    timestamps = np.arange(0, 30) / 10
+
+    for _ in range(0, 2):
+        resampled = animator.load_resampled(10, clip_cache, apply_ik=True)
+    assert clip_cache.misses == 1
+    assert clip_cache.hits == 1
+    assert isinstance(resampled.positions, np.memmap)
+    assert resampled.n_frames == int(animator.animation.get_duration() * 10) + 1
+
+    joints, _ = animator.compute_joints(timestamps)
+    for apply_ik in [True, False]:
+        resampled_joints, _ = animator.compute_joints(timestamps, resampled=animator.load_resampled(10, clip_cache, apply_ik))
+        assert np.allclose(resampled_joints, joints, atol=1e-4)
+
+    # timestamps off the grid of the clip are sampled, e.g. seq --start 0.05
+    resampled = animator.load_resampled(10, clip_cache)
+    off_grid_timestamps = [0.05, 0.1, 0.25]
+    resampled_joints, _ = animator.compute_joints(off_grid_timestamps, resampled=resampled)
+    assert np.allclose(resampled_joints, animator.compute_joints(off_grid_timestamps)[0], atol=1e-4)
+    frames = [(timestamp, vertices.copy()) for timestamp, vertices, _, _ in animator.iter_frames(0.05, 0.3, 20, resampled)]
+    expected_frames = [(timestamp, vertices.copy()) for timestamp, vertices, _, _ in animator.iter_frames(0.05, 0.3, 20)]
+    for (timestamp, vertices), (expected_timestamp, expected_vertices) in zip(frames, expected_frames):
+        assert timestamp == expected_timestamp and np.allclose(vertices, expected_vertices, atol=1e-4)
+
+
+def test_pose_diversity_sampler():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    sampler = PoseDiversitySampler()
+    sampler.add_motion(Animator(pmx_path, vmd_path), 5)
+
+    selection = sampler.select_diverse(8)
+    assert len(selection) == 1 and len(selection[0]) == 8
+    assert selection[0] == sorted(set(selection[0])) and selection[0][0] > 0.0
+
+    # repeated poses are chosen once, even if more frames are asked for
+    repeated_sampler = PoseDiversitySampler()
+    repeated_sampler.add(np.array([[0.0], [0.0], [1.0], [1.0]]), np.array([0.1, 0.2, 0.3, 0.4]))
+    assert repeated_sampler.select_diverse(4) == [[0.1, 0.3]]
+
+    # a walking cycle repeats, so most frames are within a small distance of an earlier one
+    distinct = sampler.select_distinct(0.2)[0]
+    assert 0 < len(distinct) < sampler.timestamps[0].shape[0]
+    assert distinct == sorted(distinct)
+
+
+def test_posed_mesh(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    animator = Animator(pmx_path, vmd_path)
+    animator.animate(10.0, tmp_path, mesh_format="both")
+
+    posed_mesh = PosedMesh.load(tmp_path.joinpath("A.pmesh"))
+    vertices, faces, normals, _, uvs, _ = mesh_utils.load_obj_mesh(
+        str(tmp_path.joinpath("A.obj")), with_normal=True, with_texture=True)
+    assert np.allclose(posed_mesh.vertices, vertices, atol=1e-5)
+    assert np.array_equal(posed_mesh.faces, faces)
+    assert np.allclose(posed_mesh.uvs, uvs, atol=1e-5)
+    assert posed_mesh.texture_map == json.load(open(tmp_path.joinpath("material.json"), encoding="utf-8"))
+
+    for name, material_faces in posed_mesh.get_material_faces().items():
+        _, obj_faces = mesh_utils.load_obj_mesh(str(tmp_path.joinpath("A.obj")), name)
+        assert np.array_equal(material_faces, obj_faces)
+
+
+def test_animate_meshes(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    timestamps = [0.0, 10.0]
+    file_dirs = [tmp_path.joinpath(f"file_{i}") for i in range(0, len(timestamps))]
+    memory_dirs = [tmp_path.joinpath(f"memory_{i}") for i in range(0, len(timestamps))]
+    for output_dir in file_dirs + memory_dirs:
+        output_dir.mkdir()
+
+    animator = Animator(pmx_path, vmd_path)
+    preprocessor = Preprocessor()
+    list(animator.animate_many(timestamps, file_dirs, mesh_format="pmesh"))
+
+    for i, (timestamp, output_dir, posed_mesh) in enumerate(animator.animate_meshes(timestamps, memory_dirs)):
+        assert timestamp == timestamps[i] and output_dir == memory_dirs[i]
+        assert not output_dir.joinpath("A.obj").exists() and output_dir.joinpath("material.json").exists()
+
+        preprocessor.normalize(file_dirs[i].joinpath("A.pmesh"))
+        preprocessor.normalize_mesh(posed_mesh)
+        assert np.allclose(posed_mesh.vertices, PosedMesh.load(file_dirs[i].joinpath("A.pmesh")).vertices, atol=1e-5)
+
+
+def test_load_obj_groups(tmp_path):
+    obj_path = str(ASSETS_DIR.joinpath("mesh_data/A.obj"))
+    obj_cache = mesh_utils.ObjCache()
+    groups = obj_cache.load(obj_path)
+    assert obj_cache.load(obj_path) is groups and obj_cache.hits == 1
+
+    for name, group in groups.items():
+        with open(obj_path) as file:
+            expected = mesh_utils.load_obj_mesh(file, name, with_normal=True, with_texture=True)
+        for array, expected_array in zip(group, expected):
+            assert np.array_equal(array, expected_array)
+
+    # quads are split like load_obj_mesh does
+    quad_path = tmp_path.joinpath("quad.obj")
+    quad_path.write_text("v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nvt 0 0\nvt 1 0\nvt 1 1\nvt 0 1\no quad\nf 1/1 2/2 3/3 4/4\n")
+    _, faces, _, _, _, face_uvs = mesh_utils.load_obj_groups(quad_path)["quad"]
+    assert faces.tolist() == [[0, 1, 2], [2, 3, 0]] and face_uvs.tolist() == faces.tolist()
+
+
+def test_bezier_curve_cache():
+    params = [0.2, 0.8, 0.1, 0.9]
+    table_cache = BezierCurveCache(table_size=64)
+    table_method = BezierInterpolationMethod(cache=table_cache)
+    for weight in [0.1, 0.2, 0.3]:
+        table_method.compute_ratio(weight, params)
+    assert (table_cache.misses, table_cache.hits) == (1, 2)
+
+    dict_cache = BezierCurveCache(max_solves=2)
+    dict_method = BezierInterpolationMethod(cache=dict_cache)
+    for weight in [0.1, 0.2, 0.3, 0.3]:
+        dict_method.compute_ratio(weight, params)
+    assert (dict_cache.misses, dict_cache.hits, dict_cache.solve_evictions) == (3, 1, 2)
+
+
+def test_animate_many(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    timestamps = [0.0, 2.5, 10.0]
+    many_dirs = [tmp_path.joinpath(f"many_{i}") for i in range(0, len(timestamps))]
+    for output_dir in many_dirs:
+        output_dir.mkdir()
+    # frames of a batch are written together, several batches are written one after another
+    written = list(Animator(pmx_path, vmd_path).animate_many(timestamps, many_dirs, batch_size=2))
+    assert [timestamp for timestamp, _ in written] == timestamps
+
+    animator = Animator(pmx_path, vmd_path)
+    for timestamp, many_dir in zip(timestamps, many_dirs):
+        one_dir = tmp_path.joinpath(f"one_{timestamp}")
+        one_dir.mkdir()
+        animator.animate(timestamp, one_dir)
+        for filename in ["A.obj", "bone_vertices.json", "material.json"]:
+            assert filecmp.cmp(one_dir.joinpath(filename), many_dir.joinpath(filename), shallow=False)
+
+
+def test_parse_frame_range():
+    assert parse_frame_range("0:90:30") == [0.0, 1.0, 2.0]
+    assert parse_frame_range("30:60") == [frame / 30 for frame in range(30, 60)]
+    with pytest.raises(ValueError):
+        parse_frame_range("0:90:30:1")
+
+
+def test_pmx_to_obj_legacy():
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    pmx = pymeshio.pmx.reader.read_from_file(str(pmx_path))
+    geometry = Geometry(mmd_reader.read_pmx(pmx_path))
+
+    with pytest.warns(DeprecationWarning):
+        legacy_obj = pmx_utils.pmx_to_obj(pmx, geometry, geometry.vertices)
+    assert legacy_obj == pmx_utils.pmx_to_obj(geometry, geometry.vertices)
+    assert pmx_utils.pmx_to_mtl(pmx) == pmx_utils.pmx_to_mtl(geometry)
+
+
+def test_preprocess_posed_mesh(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    Animator(pmx_path, vmd_path).animate(1.0, tmp_path, mesh_format="both")
+    obj_path, pmesh_path = tmp_path.joinpath("A.obj"), tmp_path.joinpath("A.pmesh")
+
+    # objects of the posed mesh are the same triangles as the objects of the OBJ
+    mesh_geometry = Preprocessor._Preprocessor__load_mesh_geometry(pmesh_path)
+    groups = mesh_utils.load_obj_groups(obj_path)
+    assert sorted(mesh_geometry.keys()) == sorted(groups.keys())
+    for name, geometry in mesh_geometry.items():
+        vertices, faces = groups[name][0], groups[name][1]
+        assert np.allclose(geometry.vertices[geometry.faces], vertices[faces], atol=1e-5)
+
+    # the posed mesh is normalized in place, and so is the OBJ next to it
+    Preprocessor().normalize(pmesh_path)
+    posed_mesh = PosedMesh.load(pmesh_path, mmap=False)
+    normalized_vertices = posed_mesh.vertices[np.unique(posed_mesh.faces)]
+    assert np.all(np.abs(normalized_vertices) <= 0.5)
+    assert np.allclose(mesh_utils.load_obj_groups(obj_path)["Body"][0], posed_mesh.vertices, atol=1e-5)
+
+
+def test_process_mesh(tmp_path, monkeypatch):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+
+    def compute_prt(self, mesh_path):
+        # stands in for the ray queries: one value per face corner, from the vertices that PRT is computed on
+        if isinstance(mesh_path, PosedMesh):
+            posed_mesh = mesh_path
+        elif str(mesh_path).endswith(".pmesh"):
+            posed_mesh = PosedMesh.load(mesh_path)
+        else:
+            return {
+                name: {"bounce0": vertices[faces], "face": faces}
+                for name, (vertices, faces, *_) in mesh_utils.load_obj_groups(mesh_path).items()}
+        return {
+            name: {"bounce0": np.asarray(posed_mesh.vertices, dtype=np.float64)[faces], "face": faces.astype(np.int64)}
+            for name, faces in posed_mesh.get_material_faces().items()}
+    monkeypatch.setattr(Preprocessor, "compute_prt", compute_prt)
+
+    # the file path of OBJ only needs trimesh to normalize, .pmesh is normalized without it
+    for mesh_format, filenames in [("pmesh", ["A.pmesh"]), ("both", ["A.obj", "A.pmesh"])]:
+        file_dir, memory_dir = tmp_path.joinpath(f"file_{mesh_format}"), tmp_path.joinpath(f"memory_{mesh_format}")
+        file_dir.mkdir()
+        memory_dir.mkdir()
+
+        animator = Animator(pmx_path, vmd_path)
+        animator.animate(10.0, file_dir, mesh_format=mesh_format)
+        Preprocessor().process(file_dir.joinpath("A.pmesh"))
+        for _, output_dir, posed_mesh in animator.animate_meshes([10.0], [memory_dir]):
+            Preprocessor().process_mesh(posed_mesh, output_dir, animator.character_name, mesh_format)
+
+        for filename in filenames + ["bounce/prt_data.pkl"]:
+            assert filecmp.cmp(file_dir.joinpath(filename), memory_dir.joinpath(filename), shallow=False)
+
+
+def test_bind_motion(tmp_path):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    vmd_path = ASSETS_DIR.joinpath("walking.vmd")
+    other_vmd_path = tmp_path.joinpath("other.vmd")
+    other_vmd_path.write_bytes(vmd_path.read_bytes())
+    timestamps = [1.5, 1.6, 10.0]
+
+    animator = Animator(pmx_path, vmd_path, ik_warm_start=True)
+    animator.compute_joints([20.0, 20.1])
+    geometry = animator.geometry
+    animator.bind_motion(other_vmd_path, MotionCache())
+    assert animator.geometry is geometry and animator.vmd_path == other_vmd_path
+
+    joints, _ = animator.compute_joints(timestamps)
+    expected_joints, _ = Animator(pmx_path, other_vmd_path, ik_warm_start=True).compute_joints(timestamps)
+    assert np.array_equal(joints, expected_joints)
+
+
+def test_select_poses(tmp_path, monkeypatch):
+    pmx_path = ASSETS_DIR.joinpath("pmx_data/A/A.pmx")
+    output_path = tmp_path.joinpath("selected.json")
+    monkeypatch.chdir(ASSETS_DIR)
+    run_cli(parse_arguments(["select", "-p", str(pmx_path), "-v", "walking.vmd", "--fps", "5", "-n", "4", "-o", str(output_path)]))
+
+    # keys are absolute, so gen reads them from any working directory
+    monkeypatch.chdir(tmp_path)
+    vmd_path = str(ASSETS_DIR.joinpath("walking.vmd"))
+    assert list(json.load(open(output_path)).keys()) == [vmd_path]
+    assert len(read_timestamps_file(output_path, vmd_path)) == 4
+
+
 if __name__ == "__main__":
     pytest.main()
@@ -1,3 +1,6 @@
+import os
+import re
+import collections
 import numpy as np
 import trimesh
 
@@ -123,6 +126,134 @@ def load_obj_mesh(mesh_file, key_name=None, with_normal=False, with_texture=Fals
     return vertices, faces
 
 
+def parse_rows(rows: [str], n_columns: int, dtype=np.float64) -> np.ndarray:
+    """
+    Parse rows of numbers in bulk, only the first n_columns numbers of each row are kept.
+    :param rows: rows without their keyword, e.g. "1.0 2.0 3.0" of "v 1.0 2.0 3.0"
+    :param n_columns:
+    :param dtype:
+    :return: (N, n_columns)
+    """
+    values = np.fromstring(" ".join(rows), dtype=dtype, sep=" ") if rows else np.zeros([0], dtype=dtype)
+    if values.shape[0] == len(rows) * n_columns:
+        return values.reshape([-1, n_columns])
+    # rows of other lengths, e.g. vertex colors
+    return np.array([row.split()[:n_columns] for row in rows], dtype=dtype).reshape([-1, n_columns])
+
+
+def parse_face_rows(rows: [str]):
+    """
+    :param rows: face rows without their keyword, e.g. "1/1/1 2/2/2 3/3/3"
+    :return: (F, 3) faces, (F, 3) uv faces and (F, 3) normal faces, 1-based like OBJ, uv and normal faces may be empty
+    """
+    tokens = " ".join(rows).split()
+    text = " ".join(tokens)
+    layout = tokens[0] if tokens else ""
+    n_slashes = layout.count("/")
+
+    # triangles of the same layout, which are parsed at once
+    if len(tokens) == len(rows) * 3 and text.count("/") == len(tokens) * n_slashes and \
+            text.count("//") == len(tokens) * layout.count("//"):
+        n_values = n_slashes + 1 - layout.count("//")
+        values = np.fromstring(text.replace("/", " "), dtype=np.int64, sep=" ").reshape([-1, 3, n_values])
+        faces = values[:, :, 0]
+        empty = np.zeros([0, 3], dtype=np.int64)
+        if n_slashes == 2:
+            return faces, (values[:, :, 1] if n_values == 3 else empty), values[:, :, -1]
+        return faces, (values[:, :, 1] if n_slashes == 1 else empty), empty
+
+    # quads and mixed layouts, same as load_obj_mesh
+    face_data, face_uv_data, face_norm_data = [], [], []
+    for row in rows:
+        values = ["f"] + row.split()
+        corners = [values[1:4]] if len(values) <= 4 else [values[1:4], [values[3], values[4], values[1]]]
+        parts = values[1].split("/")
+        for corner in corners:
+            face_data.append([int(x.split("/")[0]) for x in corner])
+            if len(parts) >= 2 and (len(values) > 4 or len(parts[1]) != 0):
+                face_uv_data.append([int(x.split("/")[1]) for x in corner])
+            if len(parts) == 3 and (len(values) > 4 or len(parts[2]) != 0):
+                face_norm_data.append([int(x.split("/")[2]) for x in corner])
+    return tuple(np.array(data, dtype=np.int64).reshape([-1, 3]) for data in [face_data, face_uv_data, face_norm_data])
+
+
+def load_obj_groups(mesh_file) -> dict:
+    """
+    Load every object group of an OBJ in one pass, blocks of v/vt/vn/f rows are parsed in bulk.
+    Faces outside of any object group are left out.
+    :param mesh_file: path or file object
+    :return: (vertices, faces, norms, face_normals, uvs, face_uvs) of each object name,
+        same as load_obj_mesh(mesh_file, name, with_normal=True, with_texture=True). Vertices, norms and uvs are shared
+    """
+    if isinstance(mesh_file, (str, os.PathLike)):
+        with open(mesh_file, "r") as file:
+            text = file.read()
+    else:
+        text = mesh_file.read()
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    text = text.replace("\r\n", "\n")
+
+    vertices = parse_rows(re.findall(r"^v[ \t]+(.*)$", text, flags=re.MULTILINE), 3)
+    uvs = parse_rows(re.findall(r"^vt[ \t]+(.*)$", text, flags=re.MULTILINE), 2)
+    norms = parse_rows(re.findall(r"^vn[ \t]+(.*)$", text, flags=re.MULTILINE), 3)
+    if norms.shape[0] > 0:
+        norms = normalize_v3(norms)
+
+    # [text before the first group, name, group text, name, group text, ...]
+    sections = re.split(r"^o[ \t]+(\S+).*$", text, flags=re.MULTILINE)
+    face_rows = dict()
+    for name, section in zip(sections[1::2], sections[2::2]):
+        face_rows.setdefault(name, []).extend(re.findall(r"^f[ \t]+(.*)$", section, flags=re.MULTILINE))
+
+    groups = dict()
+    for name, rows in face_rows.items():
+        faces, face_uvs, face_normals = (face - 1 for face in parse_face_rows(rows))
+        if norms.shape[0] == 0:
+            groups[name] = (vertices, faces, compute_normal(vertices, faces), faces, uvs, face_uvs)
+        else:
+            groups[name] = (vertices, faces, norms, face_normals, uvs, face_uvs)
+    return groups
+
+
+class ObjCache:
+    """
+    In-memory cache of load_obj_groups, so an OBJ is parsed once however many times it is loaded.
+    Entries are keyed by path, and are parsed again when the size or modification time of the file changes.
+    Cached arrays are shared, callers must not modify them.
+    """
+    def __init__(self, max_entries=8):
+        """
+        :param max_entries: least recently used entries are dropped beyond this
+        """
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, mesh_path) -> dict:
+        """
+        :param mesh_path:
+        :return: cached groups, see load_obj_groups
+        """
+        stat = os.stat(mesh_path)
+        key = os.path.abspath(mesh_path)
+        entry = self.entries.get(key, None)
+
+        if entry is not None and entry[0] == (stat.st_size, stat.st_mtime_ns):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        groups = load_obj_groups(mesh_path)
+        self.entries[key] = ((stat.st_size, stat.st_mtime_ns), groups)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return groups
+
+
 def normalize_v3(arr):
     """ Normalize a numpy array of 3 component vectors shape=(n,3) """
     lens = np.sqrt(arr[:, 0] ** 2 + arr[:, 1] ** 2 + arr[:, 2] ** 2)
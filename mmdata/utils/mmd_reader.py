@@ -0,0 +1,733 @@
+import struct
+import pathlib
+import numpy as np
+from typing import Union
+
+
+VERTEX_DTYPE = np.dtype([
+    ("position", "<f4", 3),
+    ("normal", "<f4", 3),
+    ("uv", "<f4", 2),
+    ("deform_type", "u1"),
+    ("bone_indices", "<i4", 4),
+    ("bone_weights", "<f4", 4),
+    ("edge_scale", "<f4"),
+])
+
+MATERIAL_DTYPE = np.dtype([
+    ("diffuse_color", "<f4", 3),
+    ("alpha", "<f4"),
+    ("specular_color", "<f4", 3),
+    ("specular_factor", "<f4"),
+    ("ambient_color", "<f4", 3),
+    ("flag", "u1"),
+    ("edge_color", "<f4", 4),
+    ("edge_size", "<f4"),
+    ("texture_index", "<i4"),
+    ("sphere_texture_index", "<i4"),
+    ("sphere_mode", "u1"),
+    ("toon_sharing_flag", "u1"),
+    ("toon_texture_index", "<i4"),
+    ("vertex_count", "<i4"),
+])
+
+BONE_DTYPE = np.dtype([
+    ("position", "<f4", 3),
+    ("parent_index", "<i4"),
+    ("layer", "<i4"),
+    ("flag", "<u2"),
+    ("tail_index", "<i4"),
+    ("tail_position", "<f4", 3),
+    ("effect_index", "<i4"),
+    ("effect_factor", "<f4"),
+    ("fixed_axis", "<f4", 3),
+    ("local_x_vector", "<f4", 3),
+    ("local_z_vector", "<f4", 3),
+    ("external_key", "<i4"),
+    ("ik_target_index", "<i4"),
+    ("ik_loop", "<i4"),
+    ("ik_limit_radian", "<f4"),
+    ("ik_link_start", "<i4"),
+    ("ik_link_count", "<i4"),
+])
+
+IK_LINK_DTYPE = np.dtype([
+    ("bone_index", "<i4"),
+    ("limit_angle", "u1"),
+    ("limit_min", "<f4", 3),
+    ("limit_max", "<f4", 3),
+])
+
+MORPH_DTYPE = np.dtype([
+    ("panel", "u1"),
+    ("morph_type", "u1"),
+    ("offset_count", "<i4"),
+])
+
+VERTEX_MORPH_DTYPE = np.dtype([
+    ("morph_index", "<i4"),
+    ("vertex_index", "<i4"),
+    ("position_offset", "<f4", 3),
+])
+
+GROUP_MORPH_DTYPE = np.dtype([
+    ("morph_index", "<i4"),
+    ("target_index", "<i4"),
+    ("value", "<f4"),
+])
+
+BONE_MORPH_DTYPE = np.dtype([
+    ("morph_index", "<i4"),
+    ("bone_index", "<i4"),
+    ("position", "<f4", 3),
+    ("quaternion", "<f4", 4),
+])
+
+RIGID_BODY_DTYPE = np.dtype([
+    ("bone_index", "<i4"),
+    ("group", "u1"),
+    ("no_collision_group", "<u2"),
+    ("shape_type", "u1"),
+    ("shape_size", "<f4", 3),
+    ("position", "<f4", 3),
+    ("rotation", "<f4", 3),
+    ("mass", "<f4"),
+    ("linear_damping", "<f4"),
+    ("angular_damping", "<f4"),
+    ("restitution", "<f4"),
+    ("friction", "<f4"),
+    ("mode", "u1"),
+])
+
+MOTION_DTYPE = np.dtype([
+    ("name_index", "<i4"),
+    ("frame", "<u4"),
+    ("position", "<f4", 3),
+    ("quaternion", "<f4", 4),
+    ("interpolation", "u1", 64),
+])
+
+SHAPE_DTYPE = np.dtype([
+    ("name_index", "<i4"),
+    ("frame", "<u4"),
+    ("weight", "<f4"),
+])
+
+# records exactly as they are laid out in a VMD file
+VMD_MOTION_RECORD = np.dtype([
+    ("name", "S15"),
+    ("frame", "<u4"),
+    ("position", "<f4", 3),
+    ("quaternion", "<f4", 4),
+    ("interpolation", "u1", 64),
+])
+
+VMD_SHAPE_RECORD = np.dtype([
+    ("name", "S15"),
+    ("frame", "<u4"),
+    ("weight", "<f4"),
+])
+
+
+def get_index_dtype(size: int, unsigned=False) -> np.dtype:
+    """
+    PMX indices are 1, 2 or 4 bytes. Vertex indices of 1 and 2 bytes are unsigned, other indices are signed.
+    :param size:
+    :param unsigned:
+    :return: dtype
+    """
+    if size not in [1, 2, 4]:
+        raise ValueError(f"Invalid index size: {size}")
+    if size == 4:
+        return np.dtype("<i4")
+    return np.dtype(f"<u{size}" if unsigned else f"<i{size}")
+
+
+def decode_vmd_name(raw: bytes) -> str:
+    """
+    VMD names are cp932 and null-terminated, bytes after the terminator are garbage.
+    """
+    return raw.split(b"\x00")[0].decode("cp932", errors="replace")
+
+
+class _BinaryCursor:
+    """
+    Sequential reader over a memory-mapped file.
+    """
+    def __init__(self, data: np.ndarray, encoding="utf-16-le"):
+        self.data = data
+        self.view = memoryview(data)
+        self.offset = 0
+        self.encoding = encoding
+
+    def unpack(self, fmt: str):
+        values = struct.unpack_from(fmt, self.view, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def read_int(self) -> int:
+        return self.unpack("<i")[0]
+
+    def read_index(self, dtype: np.dtype) -> int:
+        return self.unpack(f"<{dtype.char}")[0]
+
+    def read_text(self) -> str:
+        size = self.read_int()
+        text = self.view[self.offset:(self.offset + size)].tobytes().decode(self.encoding)
+        self.offset += size
+        return text
+
+    def read_array(self, dtype: np.dtype, count: int) -> np.ndarray:
+        array = np.frombuffer(self.view, dtype=dtype, count=count, offset=self.offset)
+        self.offset += dtype.itemsize * count
+        return array
+
+    def skip(self, size: int):
+        self.offset += size
+
+    def gather(self, starts: np.ndarray, dtype, count=1) -> np.ndarray:
+        """
+        Read count values of dtype at many offsets at once.
+        :param starts: (N,) byte offsets
+        :param dtype:
+        :param count:
+        :return: (N, count)
+        """
+        dtype = np.dtype(dtype)
+        columns = np.arange(0, dtype.itemsize * count)
+        raw = self.data[starts[:, None] + columns[None, :]]
+        return raw.view(dtype).reshape([starts.shape[0], count])
+
+
+class PmxData:
+    """
+    Columnar content of a PMX file.
+    Every section is a NumPy structured array, names are kept in plain lists next to it.
+    SDEF deforms are read as BDEF2, QDEF as BDEF4. Unused bone slots of a deform are 0.
+    """
+    def __init__(self):
+        self.path = None
+        self.version = 2.0
+        self.encoding = "utf-16-le"
+        self.name = ""
+        self.english_name = ""
+        self.comment = ""
+        self.english_comment = ""
+
+        self.vertices = np.zeros([0], dtype=VERTEX_DTYPE)
+        self.additional_uvs = np.zeros([0, 0, 4], dtype=np.float32)
+        self.indices = np.zeros([0], dtype=np.int32)
+        self.textures = []
+        self.materials = np.zeros([0], dtype=MATERIAL_DTYPE)
+        self.material_names = []
+        self.bones = np.zeros([0], dtype=BONE_DTYPE)
+        self.bone_names = []
+        self.ik_links = np.zeros([0], dtype=IK_LINK_DTYPE)
+        self.morphs = np.zeros([0], dtype=MORPH_DTYPE)
+        self.morph_names = []
+        self.vertex_morph_offsets = np.zeros([0], dtype=VERTEX_MORPH_DTYPE)
+        self.group_morph_offsets = np.zeros([0], dtype=GROUP_MORPH_DTYPE)
+        self.bone_morph_offsets = np.zeros([0], dtype=BONE_MORPH_DTYPE)
+        self.rigid_bodies = np.zeros([0], dtype=RIGID_BODY_DTYPE)
+        self.rigid_body_names = []
+
+    @classmethod
+    def from_pymeshio(cls, pmx):
+        """
+        Convert a model that pymeshio.pmx.reader has read.
+        Only the fields that Geometry uses are filled in.
+        :param pmx: pymeshio.pmx.Model
+        :return: PmxData
+        """
+        data = cls()
+        data.path = getattr(pmx, "path", None)
+        data.version = pmx.version
+        data.name = pmx.name
+        data.english_name = pmx.english_name
+        data.comment = pmx.comment
+        data.english_comment = pmx.english_comment
+
+        deform_types = {"Bdef1": 0, "Bdef2": 1, "Bdef4": 2, "Sdef": 3, "Qdef": 4}
+        data.vertices = np.zeros([len(pmx.vertices)], dtype=VERTEX_DTYPE)
+        for vertex_index, v in enumerate(pmx.vertices):
+            data.vertices[vertex_index] = (
+                [v.position.x, v.position.y, v.position.z], [v.normal.x, v.normal.y, v.normal.z], [v.uv.x, v.uv.y],
+                deform_types[type(v.deform).__name__],
+                [int(getattr(v.deform, f"index{j}", 0)) for j in range(0, 4)],
+                [getattr(v.deform, f"weight{j}", 0.0) for j in range(0, 4)],
+                v.edge_factor)
+        data.indices = np.array(pmx.indices, dtype=np.int32)
+        data.textures = list(pmx.textures)
+
+        data.materials = np.zeros([len(pmx.materials)], dtype=MATERIAL_DTYPE)
+        for material_index, mat in enumerate(pmx.materials):
+            record = data.materials[material_index:(material_index + 1)]
+            record["diffuse_color"] = [mat.diffuse_color.r, mat.diffuse_color.g, mat.diffuse_color.b]
+            record["alpha"] = mat.alpha
+            record["texture_index"] = mat.texture_index
+            record["vertex_count"] = mat.vertex_count
+            data.material_names.append(mat.name)
+
+        ik_links = []
+        data.bones = np.zeros([len(pmx.bones)], dtype=BONE_DTYPE)
+        for bone_index, bone in enumerate(pmx.bones):
+            record = data.bones[bone_index:(bone_index + 1)]
+            record["position"] = [bone.position.x, bone.position.y, bone.position.z]
+            record["parent_index"] = bone.parent_index
+            record["layer"] = bone.layer
+            record["flag"] = bone.flag
+            record["effect_index"] = getattr(bone, "effect_index", -1)
+            record["effect_factor"] = getattr(bone, "effect_factor", 0.0)
+            record["ik_target_index"] = -1
+            data.bone_names.append(bone.name)
+
+            if bone.ik is not None:
+                record["ik_target_index"] = bone.ik.target_index
+                record["ik_loop"] = bone.ik.loop
+                record["ik_limit_radian"] = bone.ik.limit_radian
+                record["ik_link_start"] = len(ik_links)
+                record["ik_link_count"] = len(bone.ik.link)
+                for link in bone.ik.link:
+                    limit_min, limit_max = link.limit_min, link.limit_max
+                    ik_links.append((
+                        link.bone_index, link.limit_angle,
+                        [limit_min[0], limit_min[1], limit_min[2]], [limit_max[0], limit_max[1], limit_max[2]]))
+        data.ik_links = np.array(ik_links, dtype=IK_LINK_DTYPE)
+
+        vertex_offsets, group_offsets = [], []
+        data.morphs = np.zeros([len(pmx.morphs)], dtype=MORPH_DTYPE)
+        for morph_index, morph in enumerate(pmx.morphs):
+            offsets = morph.offsets or getattr(morph, "data", [])
+            data.morphs[morph_index] = (morph.panel, morph.morph_type, len(offsets))
+            data.morph_names.append(morph.name)
+
+            if morph.morph_type == 0:
+                group_offsets += [(morph_index, offset.morph_index, offset.value) for offset in offsets]
+            elif morph.morph_type == 1:
+                vertex_offsets += [
+                    (morph_index, offset.vertex_index, [offset.position_offset[j] for j in range(0, 3)]) for offset in offsets]
+        data.vertex_morph_offsets = np.array(vertex_offsets, dtype=VERTEX_MORPH_DTYPE)
+        data.group_morph_offsets = np.array(group_offsets, dtype=GROUP_MORPH_DTYPE)
+
+        data.rigid_bodies = np.zeros([len(pmx.rigidbodies)], dtype=RIGID_BODY_DTYPE)
+        for body_index, body in enumerate(pmx.rigidbodies):
+            record = data.rigid_bodies[body_index:(body_index + 1)]
+            record["bone_index"] = body.bone_index
+            record["mode"] = body.mode
+            data.rigid_body_names.append(body.name)
+        return data
+
+
+class VmdData:
+    """
+    Columnar content of a VMD file: bone keyframes (motions) and morph keyframes (shapes).
+    Keyframes keep the file order, name_index points into motion_names / shape_names.
+    """
+    def __init__(self):
+        self.path = None
+        self.model_name = ""
+        self.motions = np.zeros([0], dtype=MOTION_DTYPE)
+        self.motion_names = []
+        self.shapes = np.zeros([0], dtype=SHAPE_DTYPE)
+        self.shape_names = []
+
+    @staticmethod
+    def index_names(names: list) -> (np.ndarray, list):
+        """
+        :param names: name of every keyframe
+        :return: name index of every keyframe, unique names
+        """
+        unique_names = dict()
+        name_indices = np.array([unique_names.setdefault(name, len(unique_names)) for name in names], dtype=np.int32)
+        return name_indices, list(unique_names.keys())
+
+    @classmethod
+    def from_pymeshio(cls, vmd):
+        """
+        Convert a motion that pymeshio.vmd.reader has read.
+        :param vmd: pymeshio.vmd.Motion
+        :return: VmdData
+        """
+        data = cls()
+        data.model_name = getattr(vmd, "model_name", "")
+
+        name_indices, data.motion_names = cls.index_names([motion.name for motion in vmd.motions])
+        data.motions = np.zeros([len(vmd.motions)], dtype=MOTION_DTYPE)
+        data.motions["name_index"] = name_indices
+        for motion_index, motion in enumerate(vmd.motions):
+            record = data.motions[motion_index:(motion_index + 1)]
+            record["frame"] = motion.frame
+            record["position"] = [motion.pos.x, motion.pos.y, motion.pos.z]
+            record["quaternion"] = [motion.q.x, motion.q.y, motion.q.z, motion.q.w]
+            record["interpolation"] = list(motion.complement)
+
+        name_indices, data.shape_names = cls.index_names([shape.name for shape in vmd.shapes])
+        data.shapes = np.zeros([len(vmd.shapes)], dtype=SHAPE_DTYPE)
+        data.shapes["name_index"] = name_indices
+        data.shapes["frame"] = [shape.frame for shape in vmd.shapes]
+        data.shapes["weight"] = [shape.ratio for shape in vmd.shapes]
+        return data
+
+
+class PmxReader:
+    """
+    PmxReader decodes a PMX file directly into PmxData.
+    Fixed-size sections are read as arrays, vertices are located in one pass and then gathered column by column.
+    """
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = path
+        self.cursor = _BinaryCursor(np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray))
+        self.data = PmxData()
+        self.data.path = str(path)
+
+    def read(self) -> PmxData:
+        self.__read_header()
+        self.__read_vertices()
+        self.__read_faces()
+        self.__read_textures()
+        self.__read_materials()
+        self.__read_bones()
+        self.__read_morphs()
+        self.__skip_display_slots()
+        self.__read_rigid_bodies()
+        return self.data
+
+    def __read_header(self):
+        cursor, data = self.cursor, self.data
+        signature = cursor.view[0:4].tobytes()
+        if signature != b"PMX ":
+            raise ValueError(f"Invalid PMX signature: {signature}")
+        cursor.skip(4)
+
+        data.version = cursor.unpack("<f")[0]
+        n_globals = cursor.unpack("<B")[0]
+        if n_globals < 8:
+            raise ValueError(f"Invalid PMX header size: {n_globals}")
+        header = cursor.unpack(f"<{n_globals}B")
+
+        cursor.encoding = "utf-16-le" if header[0] == 0 else "utf-8"
+        data.encoding = cursor.encoding
+        self.additional_uv_count = header[1]
+        self.vertex_index = get_index_dtype(header[2], unsigned=True)
+        self.texture_index = get_index_dtype(header[3])
+        self.material_index = get_index_dtype(header[4])
+        self.bone_index = get_index_dtype(header[5])
+        self.morph_index = get_index_dtype(header[6])
+        self.rigid_body_index = get_index_dtype(header[7])
+
+        data.name = cursor.read_text()
+        data.english_name = cursor.read_text()
+        data.comment = cursor.read_text()
+        data.english_comment = cursor.read_text()
+        return
+
+    def __read_vertices(self):
+        cursor, data = self.cursor, self.data
+        n_vertices = cursor.read_int()
+        n_uvs = self.additional_uv_count
+        b = self.bone_index.itemsize
+
+        # record size depends on the deform type: BDEF1, BDEF2, BDEF4, SDEF, QDEF
+        prefix_size = 32 + 16 * n_uvs
+        deform_sizes = [b, 2 * b + 4, 4 * b + 16, 2 * b + 4 + 36, 4 * b + 16]
+        record_sizes = [prefix_size + 1 + size + 4 for size in deform_sizes]
+
+        # locate records, this is the only per-vertex Python work
+        view = cursor.view
+        starts = [0] * n_vertices
+        offset = cursor.offset
+        try:
+            for vertex_index in range(0, n_vertices):
+                starts[vertex_index] = offset
+                offset += record_sizes[view[offset + prefix_size]]
+        except IndexError:
+            raise ValueError(f"Invalid deform of vertex {vertex_index} in {self.path}")
+        cursor.offset = offset
+        starts = np.array(starts, dtype=np.int64)
+
+        vertices = np.zeros([n_vertices], dtype=VERTEX_DTYPE)
+        prefix = cursor.gather(starts, "<f4", 8 + 4 * n_uvs)
+        vertices["position"] = prefix[:, 0:3]
+        vertices["normal"] = prefix[:, 3:6]
+        vertices["uv"] = prefix[:, 6:8]
+        data.additional_uvs = prefix[:, 8:].reshape([n_vertices, n_uvs, 4]).copy()
+
+        deform_types = cursor.data[starts + prefix_size]
+        vertices["deform_type"] = deform_types
+        deform_starts = starts + prefix_size + 1
+
+        for deform_type, (n_bones, n_weights) in enumerate([(1, 0), (2, 1), (4, 4), (2, 1), (4, 4)]):
+            mask = deform_types == deform_type
+            if not np.any(mask):
+                continue
+            bone_starts = deform_starts[mask]
+            bone_indices = np.zeros([bone_starts.shape[0], 4], dtype=np.int32)
+            bone_indices[:, :n_bones] = cursor.gather(bone_starts, self.bone_index, n_bones)
+            bone_weights = np.zeros([bone_starts.shape[0], 4], dtype=np.float32)
+            if n_weights > 0:
+                bone_weights[:, :n_weights] = cursor.gather(bone_starts + n_bones * b, "<f4", n_weights)
+            vertices["bone_indices"][mask] = bone_indices
+            vertices["bone_weights"][mask] = bone_weights
+
+        sizes = np.array(record_sizes, dtype=np.int64)[deform_types]
+        vertices["edge_scale"] = cursor.gather(starts + sizes - 4, "<f4")[:, 0]
+        data.vertices = vertices
+        return
+
+    def __read_faces(self):
+        cursor = self.cursor
+        self.data.indices = cursor.read_array(self.vertex_index, cursor.read_int()).copy()
+        return
+
+    def __read_textures(self):
+        cursor = self.cursor
+        self.data.textures = [cursor.read_text() for _ in range(0, cursor.read_int())]
+        return
+
+    def __read_materials(self):
+        cursor, data = self.cursor, self.data
+        n_materials = cursor.read_int()
+        data.materials = np.zeros([n_materials], dtype=MATERIAL_DTYPE)
+
+        for material_index in range(0, n_materials):
+            record = data.materials[material_index:(material_index + 1)]
+            data.material_names.append(cursor.read_text())
+            cursor.read_text()
+            values = cursor.unpack("<4f3ff3fB4ff")
+            record["diffuse_color"] = values[0:3]
+            record["alpha"] = values[3]
+            record["specular_color"] = values[4:7]
+            record["specular_factor"] = values[7]
+            record["ambient_color"] = values[8:11]
+            record["flag"] = values[11]
+            record["edge_color"] = values[12:16]
+            record["edge_size"] = values[16]
+            record["texture_index"] = cursor.read_index(self.texture_index)
+            record["sphere_texture_index"] = cursor.read_index(self.texture_index)
+            record["sphere_mode"], record["toon_sharing_flag"] = cursor.unpack("<BB")
+            if record["toon_sharing_flag"][0] == 0:
+                record["toon_texture_index"] = cursor.read_index(self.texture_index)
+            else:
+                record["toon_texture_index"] = cursor.unpack("<B")[0]
+            cursor.read_text()
+            record["vertex_count"] = cursor.read_int()
+        return
+
+    def __read_bones(self):
+        cursor, data = self.cursor, self.data
+        n_bones = cursor.read_int()
+        data.bones = np.zeros([n_bones], dtype=BONE_DTYPE)
+        ik_links = []
+
+        for bone_index in range(0, n_bones):
+            record = data.bones[bone_index:(bone_index + 1)]
+            data.bone_names.append(cursor.read_text())
+            cursor.read_text()
+            record["position"] = cursor.unpack("<3f")
+            record["parent_index"] = cursor.read_index(self.bone_index)
+            record["layer"], flag = cursor.unpack("<iH")
+            record["flag"] = flag
+            record["tail_index"] = -1
+            record["effect_index"] = -1
+            record["ik_target_index"] = -1
+
+            if flag & 0x0001:
+                record["tail_index"] = cursor.read_index(self.bone_index)
+            else:
+                record["tail_position"] = cursor.unpack("<3f")
+            if flag & (0x0100 | 0x0200):
+                record["effect_index"] = cursor.read_index(self.bone_index)
+                record["effect_factor"] = cursor.unpack("<f")[0]
+            if flag & 0x0400:
+                record["fixed_axis"] = cursor.unpack("<3f")
+            if flag & 0x0800:
+                record["local_x_vector"] = cursor.unpack("<3f")
+                record["local_z_vector"] = cursor.unpack("<3f")
+            if flag & 0x2000:
+                record["external_key"] = cursor.read_int()
+
+            if flag & 0x0020:
+                record["ik_target_index"] = cursor.read_index(self.bone_index)
+                record["ik_loop"], record["ik_limit_radian"] = cursor.unpack("<if")
+                n_links = cursor.read_int()
+                record["ik_link_start"] = len(ik_links)
+                record["ik_link_count"] = n_links
+
+                for _ in range(0, n_links):
+                    link_bone_index = cursor.read_index(self.bone_index)
+                    limit_angle = cursor.unpack("<B")[0]
+                    limit_min, limit_max = (0.0, 0.0, 0.0), (0.0, 0.0, 0.0)
+                    if limit_angle == 1:
+                        limits = cursor.unpack("<6f")
+                        limit_min, limit_max = limits[0:3], limits[3:6]
+                    ik_links.append((link_bone_index, limit_angle, limit_min, limit_max))
+
+        data.ik_links = np.array(ik_links, dtype=IK_LINK_DTYPE)
+        return
+
+    def __read_morphs(self):
+        cursor, data = self.cursor, self.data
+        n_morphs = cursor.read_int()
+        data.morphs = np.zeros([n_morphs], dtype=MORPH_DTYPE)
+        v, b, m, r = self.vertex_index, self.bone_index, self.morph_index, self.rigid_body_index
+
+        # packed offset records of the supported types, other types are skipped
+        vertex_record = np.dtype([("vertex_index", v), ("position_offset", "<f4", 3)])
+        group_record = np.dtype([("target_index", m), ("value", "<f4")])
+        bone_record = np.dtype([("bone_index", b), ("position", "<f4", 3), ("quaternion", "<f4", 4)])
+        skipped_sizes = {
+            3: v.itemsize + 16, 4: v.itemsize + 16, 5: v.itemsize + 16, 6: v.itemsize + 16, 7: v.itemsize + 16,
+            8: self.material_index.itemsize + 1 + 112, 9: m.itemsize + 4, 10: r.itemsize + 1 + 24,
+        }
+        records = {0: [], 1: [], 2: []}
+
+        for morph_index in range(0, n_morphs):
+            data.morph_names.append(cursor.read_text())
+            cursor.read_text()
+            panel, morph_type = cursor.unpack("<BB")
+            n_offsets = cursor.read_int()
+            data.morphs[morph_index] = (panel, morph_type, n_offsets)
+
+            if morph_type == 0:
+                records[0].append((morph_index, cursor.read_array(group_record, n_offsets)))
+            elif morph_type == 1:
+                records[1].append((morph_index, cursor.read_array(vertex_record, n_offsets)))
+            elif morph_type == 2:
+                records[2].append((morph_index, cursor.read_array(bone_record, n_offsets)))
+            elif morph_type in skipped_sizes:
+                cursor.skip(skipped_sizes[morph_type] * n_offsets)
+            else:
+                raise ValueError(f"Unknown morph type: {morph_type}")
+
+        data.group_morph_offsets = self.__concatenate_offsets(records[0], GROUP_MORPH_DTYPE)
+        data.vertex_morph_offsets = self.__concatenate_offsets(records[1], VERTEX_MORPH_DTYPE)
+        data.bone_morph_offsets = self.__concatenate_offsets(records[2], BONE_MORPH_DTYPE)
+        return
+
+    @staticmethod
+    def __concatenate_offsets(records: list, dtype: np.dtype) -> np.ndarray:
+        """
+        :param records: list of (morph index, packed offset records)
+        :param dtype: output dtype, which has morph_index and the fields of the records
+        :return: offsets of all morphs in one array
+        """
+        n_offsets = sum([record.shape[0] for _, record in records])
+        offsets = np.zeros([n_offsets], dtype=dtype)
+        start = 0
+
+        for morph_index, record in records:
+            end = start + record.shape[0]
+            offsets["morph_index"][start:end] = morph_index
+            for name in record.dtype.names:
+                offsets[name][start:end] = record[name]
+            start = end
+        return offsets
+
+    def __skip_display_slots(self):
+        cursor = self.cursor
+        element_sizes = {0: self.bone_index.itemsize, 1: self.morph_index.itemsize}
+
+        for _ in range(0, cursor.read_int()):
+            cursor.read_text()
+            cursor.read_text()
+            cursor.skip(1)
+            for _ in range(0, cursor.read_int()):
+                element_type = cursor.unpack("<B")[0]
+                cursor.skip(element_sizes[element_type])
+        return
+
+    def __read_rigid_bodies(self):
+        cursor, data = self.cursor, self.data
+        n_bodies = cursor.read_int()
+        data.rigid_bodies = np.zeros([n_bodies], dtype=RIGID_BODY_DTYPE)
+
+        for body_index in range(0, n_bodies):
+            data.rigid_body_names.append(cursor.read_text())
+            cursor.read_text()
+            bone_index = cursor.read_index(self.bone_index)
+            values = cursor.unpack("<BHB3f3f3f5fB")
+            data.rigid_bodies[body_index] = (
+                bone_index, values[0], values[1], values[2], values[3:6], values[6:9], values[9:12], *values[12:18])
+        return
+
+
+class VmdReader:
+    """
+    VmdReader decodes a VMD file directly into VmdData.
+    Keyframe records have a fixed size, so each section is a single structured array over the mapped file.
+    """
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = path
+        self.cursor = _BinaryCursor(np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray))
+
+    def read(self) -> VmdData:
+        cursor = self.cursor
+        data = VmdData()
+        data.path = str(self.path)
+
+        signature = cursor.view[0:30].tobytes()
+        if signature[:25] == b"Vocaloid Motion Data 0002":
+            name_size = 20
+        elif signature[:25] == b"Vocaloid Motion Data file":
+            name_size = 10
+        else:
+            raise ValueError(f"Invalid VMD signature: {signature}")
+        cursor.skip(30)
+        data.model_name = decode_vmd_name(cursor.view[cursor.offset:(cursor.offset + name_size)].tobytes())
+        cursor.skip(name_size)
+
+        motions = self.__read_section(VMD_MOTION_RECORD)
+        name_indices, data.motion_names = self.__index_names(motions["name"])
+        data.motions = np.zeros([motions.shape[0]], dtype=MOTION_DTYPE)
+        data.motions["name_index"] = name_indices
+        for name in ["frame", "position", "quaternion", "interpolation"]:
+            data.motions[name] = motions[name]
+
+        shapes = self.__read_section(VMD_SHAPE_RECORD)
+        name_indices, data.shape_names = self.__index_names(shapes["name"])
+        data.shapes = np.zeros([shapes.shape[0]], dtype=SHAPE_DTYPE)
+        data.shapes["name_index"] = name_indices
+        for name in ["frame", "weight"]:
+            data.shapes[name] = shapes[name]
+        return data
+
+    def __read_section(self, dtype: np.dtype) -> np.ndarray:
+        cursor = self.cursor
+        # old files may end right after the bone keyframes
+        if cursor.offset + 4 > cursor.data.shape[0]:
+            return np.zeros([0], dtype=dtype)
+        count = cursor.unpack("<I")[0]
+        return cursor.read_array(dtype, count)
+
+    @staticmethod
+    def __index_names(raw_names: np.ndarray) -> (np.ndarray, list):
+        """
+        Decode each distinct raw name once.
+        Raw names that only differ after the terminator decode to the same name.
+        """
+        unique_raw_names, inverse = np.unique(raw_names, return_inverse=True)
+        # keep names in order of first appearance
+        first_indices = np.full([unique_raw_names.shape[0]], raw_names.shape[0], dtype=np.int64)
+        np.minimum.at(first_indices, inverse.reshape([-1]), np.arange(0, raw_names.shape[0]))
+        order = np.argsort(first_indices, kind="stable")
+
+        raw_name_indices, names = VmdData.index_names([decode_vmd_name(unique_raw_names[k]) for k in order])
+        name_indices = np.zeros([unique_raw_names.shape[0]], dtype=np.int32)
+        name_indices[order] = raw_name_indices
+        return name_indices[inverse.reshape([-1])], names
+
+
+def read_pmx(path: Union[str, pathlib.Path]) -> PmxData:
+    """
+    :param path: PMX file
+    :return: PmxData
+    """
+    return PmxReader(path).read()
+
+
+def read_vmd(path: Union[str, pathlib.Path]) -> VmdData:
+    """
+    :param path: VMD file
+    :return: VmdData
+    """
+    return VmdReader(path).read()
@@ -1,67 +1,136 @@
+import io
 import os
+import warnings
+import numpy as np
+from typing import TextIO
+from mmdata.animation.geometry import Geometry
+from mmdata.utils.mmd_reader import PmxData
 
 
-def pmx_to_obj(pmx, geometry, vertices):
-    # starting line
-    output = "mtllib material.mtl\n\n"
+# rows formatted by one % operation, bounds the size of the temporary strings
+OBJ_CHUNK_SIZE = 65536
+
+
+def write_rows(file: TextIO, row_format: str, rows: np.ndarray):
+    """
+    Format rows in bulk, row_format % row of every row is written in order.
+    :param file: text file to write into
+    :param row_format: printf-style format of one row, e.g. "v %f %f %f\n"
+    :param rows: (N, C) values of the rows
+    """
+    for start in range(0, rows.shape[0], OBJ_CHUNK_SIZE):
+        chunk = rows[start:start + OBJ_CHUNK_SIZE]
+        # tolist gives Python scalars, which format exactly like str.format of the same values
+        file.write((row_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+    return
 
-    # vertex
-    for i in range(0, vertices.shape[0]):
-        vertex = vertices[i, :]
-        output += "v {:f} {:f} {:f}\n".format(vertex[0], vertex[1], vertex[2])
 
-    # uv
-    for i in range(0, geometry.uvs.shape[0]):
-        uv = geometry.uvs[i, :]
-        output += "vt {:f} {:f}\n".format(uv[0], uv[1])
+def write_obj(geometry, vertices: np.ndarray, file: TextIO):
+    """
+    Stream the OBJ of a posed PMX model into a file, one block of rows at a time.
+    :param geometry: Geometry of the model
+    :param vertices: (V, 3) posed vertices
+    :param file: text file to write into
+    """
+    face_counts = np.array([mat["vertex_count"] // 3 for mat in geometry.materials], dtype=np.int64)
+    face_ends = np.cumsum(face_counts)
+    write_obj_arrays(
+        file, vertices, geometry.uvs, geometry.normals, geometry.faces, [mat["name"] for mat in geometry.materials],
+        np.stack([face_ends - face_counts, face_ends], axis=1))
+    return
+
+
+def write_obj_arrays(
+        file: TextIO, vertices: np.ndarray, uvs: np.ndarray, normals: np.ndarray, faces: np.ndarray,
+        material_names: [str], face_ranges: np.ndarray, vertex_format="v %f %f %f\n"):
+    """
+    :param file: text file to write into
+    :param vertices: (V, 3)
+    :param uvs: (V, 2)
+    :param normals: (V, 3)
+    :param faces: (F, 3) vertex indices, 0-based
+    :param material_names: (K,) one object per material
+    :param face_ranges: (K, 2) start and end faces of each material
+    :param vertex_format: format of vertex rows, e.g. "v %r %r %r\n" for the shortest exact floats
+    """
+    # starting line
+    file.write("mtllib material.mtl\n\n")
 
-    # normal
-    for i in range(0, geometry.normals.shape[0]):
-        normal = geometry.normals[i, :]
-        output += "vn {:f} {:f} {:f}\n".format(normal[0], normal[1], normal[2])
+    # vertex, uv and normal
+    write_rows(file, vertex_format, vertices[:, :3])
+    write_rows(file, "vt %f %f\n", uvs[:, :2])
+    write_rows(file, "vn %f %f %f\n", normals[:, :3])
 
-    face_start = 0
     # texture and face
-    for mat in pmx.materials:
-        output += "o {:s}\n".format(mat.name)
-        output += "usemtl {:s}\n".format(mat.name)
+    for name, (face_start, face_end) in zip(material_names, face_ranges):
+        file.write(f"o {name}\n")
+        file.write(f"usemtl {name}\n")
+
+        # v/vt/vn share the same 1-based index
+        face_indices = np.repeat(np.asarray(faces[face_start:face_end], dtype=np.int64) + 1, 3, axis=1)
+        write_rows(file, "f %d/%d/%d %d/%d/%d %d/%d/%d\n", face_indices)
+    return
+
+
+def pmx_to_obj(geometry, vertices, *args) -> str:
+    """
+    pmx_to_obj(pmx, geometry, vertices) of earlier versions still works, pmx is ignored.
+    :param geometry: Geometry of the model
+    :param vertices: (V, 3) posed vertices
+    :return: whole OBJ content, prefer write_obj to stream it into a file
+    """
+    if len(args) > 0:
+        warnings.warn("pmx_to_obj(pmx, geometry, vertices) is deprecated, use pmx_to_obj(geometry, vertices)",
+                      DeprecationWarning, stacklevel=2)
+        geometry, vertices = vertices, args[0]
+
+    output = io.StringIO()
+    write_obj(geometry, vertices, output)
+    return output.getvalue()
+
 
-        for j in range(face_start, face_start + mat.vertex_count // 3):
-            face_line = []
-            for k in range(0, 3):
-                face_index = geometry.faces[j][k] + 1
-                face_line.append("{:d}/{:d}/{:d}".format(face_index, face_index, face_index))
-            output += "f " + " ".join(face_line) + "\n"
-        face_start += mat.vertex_count // 3
-    return output
+def get_materials(model) -> [dict]:
+    """
+    :param model: Geometry, or PmxData or a model that pymeshio.pmx.reader has read, as in earlier versions
+    :return: materials, see Geometry.materials
+    """
+    if isinstance(model, Geometry):
+        return model.materials
+    if not isinstance(model, PmxData):
+        model = PmxData.from_pymeshio(model)
+    return Geometry.read_materials(model)
 
 
-def pmx_to_mtl(pmx):
+def pmx_to_mtl(geometry):
+    """
+    :param geometry: Geometry of the model, a PMX model as in earlier versions is also accepted
+    :return: texture of each material name, MTL content, texture paths
+    """
     mat_dict = dict()
     mtl_output = ""
     texture_names = []
 
-    for mat in pmx.materials:
-        assert len(mat.name) > 0
-        texture = pmx.textures[mat.texture_index]
-        texture_name = texture.replace("\\", "/")
+    for mat in get_materials(geometry):
+        assert len(mat["name"]) > 0
+        texture_name = mat["texture"].replace("\\", "/")
+        diffuse_r, diffuse_g, diffuse_b = mat["diffuse_color"]
         texture_basename = os.path.basename(texture_name)
 
-        mtl_output += f"newmtl {mat.name}\n"
+        mtl_output += f"newmtl {mat['name']}\n"
         mtl_output += "Ns 10.0000\n"
         mtl_output += "Ni 1.5000\n"
         mtl_output += "d 1.0000\n"
         mtl_output += "Tr 0.0000\n"
         mtl_output += "Tf 1.0000 1.0000 1.0000\n"
         mtl_output += "illum 2\n"
-        mtl_output += f"Ka {mat.diffuse_color.r:5f} {mat.diffuse_color.g:5f} {mat.diffuse_color.b:5f}\n"
-        mtl_output += f"Kd {mat.diffuse_color.r:5f} {mat.diffuse_color.g:5f} {mat.diffuse_color.b:5f}\n"
+        mtl_output += f"Ka {diffuse_r:5f} {diffuse_g:5f} {diffuse_b:5f}\n"
+        mtl_output += f"Kd {diffuse_r:5f} {diffuse_g:5f} {diffuse_b:5f}\n"
         mtl_output += "Ks 0.0000 0.0000 0.0000\n"
         mtl_output += "Ke 0.0000 0.0000 0.0000\n"
 
         mtl_output += f"map_Ka {texture_basename}\n"
         mtl_output += f"map_Kd {texture_basename}\n"
-        mat_dict[mat.name] = texture_basename
+        mat_dict[mat["name"]] = texture_basename
         texture_names.append(texture_name)
 
     return mat_dict, mtl_output, texture_names
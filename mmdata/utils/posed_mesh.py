@@ -0,0 +1,159 @@
+import os
+import json
+import pathlib
+import numpy as np
+import mmdata.utils.pmx_utils as pmx_utils
+from typing import Union, TextIO
+
+
+POSED_MESH_EXTENSION = ".pmesh"
+POSED_MESH_MAGIC = b"MMDMESH\x00"
+# bump when the layout of the file changes
+POSED_MESH_FORMAT_VERSION = 1
+# arrays start at multiples of this, so every array can be memory-mapped
+POSED_MESH_ALIGNMENT = 64
+POSED_MESH_ARRAYS = [("vertices", "float32"), ("normals", "float32"), ("uvs", "float32"), ("faces", "int32")]
+
+
+class PosedMesh:
+    """
+    Posed mesh of a PMX model in one binary file, an alternative to OBJ that is read without any text parsing.
+    The file is a magic string, a JSON header, then float32 vertices, normals and UVs and int32 faces.
+    Faces of the i-th material are faces[face_ranges[i, 0]:face_ranges[i, 1]], like the objects of the OBJ.
+    Vertices, normals and UVs share indices, like the v/vt/vn indices of the OBJ.
+    A PosedMesh is also the in-memory mesh that gen hands from Animator to Preprocessor and Renderer,
+    then prt holds the PRT of each material, which is not stored in the file.
+    """
+    def __init__(
+            self, vertices: np.ndarray, normals: np.ndarray, uvs: np.ndarray, faces: np.ndarray,
+            material_names: [str], face_ranges: np.ndarray, texture_map: dict):
+        """
+        :param vertices: (V, 3)
+        :param normals: (V, 3)
+        :param uvs: (V, 2)
+        :param faces: (F, 3) vertex indices, 0-based
+        :param material_names: (K,) names of the materials, in face order
+        :param face_ranges: (K, 2) start and end faces of each material
+        :param texture_map: texture of each material name, same as material.json
+        """
+        self.vertices = vertices
+        self.normals = normals
+        self.uvs = uvs
+        self.faces = faces
+        self.material_names = list(material_names)
+        self.face_ranges = np.asarray(face_ranges, dtype=np.int64).reshape([-1, 2])
+        self.texture_map = dict(texture_map)
+        # PRT of each material name, see Preprocessor.compute_prt
+        self.prt = None
+
+    @staticmethod
+    def from_geometry(geometry, vertices: np.ndarray, texture_map: dict) -> "PosedMesh":
+        """
+        :param geometry: Geometry of the model
+        :param vertices: (V, 3) posed vertices
+        :param texture_map: texture of each material name, see pmx_utils.pmx_to_mtl
+        :return: posed mesh with the same content as pmx_utils.write_obj
+        """
+        face_counts = np.array([mat["vertex_count"] // 3 for mat in geometry.materials], dtype=np.int64)
+        face_ends = np.cumsum(face_counts)
+        return PosedMesh(
+            vertices, geometry.normals, geometry.uvs, geometry.faces, [mat["name"] for mat in geometry.materials],
+            np.stack([face_ends - face_counts, face_ends], axis=1), texture_map)
+
+    def get_material_faces(self) -> dict:
+        """
+        Materials that share a name share their faces, like objects of the same name in OBJ.
+        :return: (F_k, 3) faces of each material name that has any face, in order of the materials
+        """
+        material_faces = dict()
+        for name, (start, end) in zip(self.material_names, self.face_ranges):
+            if end > start:
+                material_faces.setdefault(name, []).append(self.faces[start:end])
+        return {name: np.concatenate(faces, axis=0) for name, faces in material_faces.items()}
+
+    def write_obj(self, file: TextIO, vertex_format="v %f %f %f\n"):
+        """
+        :param file: text file to write into
+        :param vertex_format: format of vertex rows, see pmx_utils.write_obj_arrays
+        """
+        pmx_utils.write_obj_arrays(
+            file, self.vertices, self.uvs, self.normals, self.faces, self.material_names, self.face_ranges, vertex_format)
+        return
+
+    def save(self, path: Union[str, pathlib.Path]):
+        """
+        :param path: usually <name>.pmesh
+        """
+        arrays = [(name, np.ascontiguousarray(getattr(self, name), dtype=dtype)) for name, dtype in POSED_MESH_ARRAYS]
+        header = {
+            "format_version": POSED_MESH_FORMAT_VERSION,
+            "material_names": self.material_names,
+            "face_ranges": self.face_ranges.tolist(),
+            "texture_map": self.texture_map,
+            "arrays": dict(),
+        }
+
+        # offsets are relative to the start of the data section, which follows the header
+        offset = 0
+        for name, array in arrays:
+            header["arrays"][name] = {"dtype": str(array.dtype), "shape": list(array.shape), "offset": offset}
+            offset += -(-array.nbytes // POSED_MESH_ALIGNMENT) * POSED_MESH_ALIGNMENT
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        data_start = len(POSED_MESH_MAGIC) + 8 + len(header_bytes)
+        header_bytes += b" " * (-data_start % POSED_MESH_ALIGNMENT)
+        data_start += -data_start % POSED_MESH_ALIGNMENT
+
+        with open(path, "wb+") as file:
+            file.write(POSED_MESH_MAGIC)
+            file.write(np.uint64(len(header_bytes)).tobytes())
+            file.write(header_bytes)
+            for name, array in arrays:
+                file.seek(data_start + header["arrays"][name]["offset"])
+                file.write(array.tobytes())
+        return
+
+    @staticmethod
+    def load(path: Union[str, pathlib.Path], mmap=True, writable=False) -> "PosedMesh":
+        """
+        :param path:
+        :param mmap: memory-map arrays instead of reading them
+        :param writable: arrays are memory-mapped in r+ mode, changes are written back into the file
+        :return: posed mesh
+        """
+        with open(path, "rb") as file:
+            if file.read(len(POSED_MESH_MAGIC)) != POSED_MESH_MAGIC:
+                raise ValueError(f"Not a posed mesh file: {path}")
+            header_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+            header = json.loads(file.read(header_size).decode("utf-8"))
+            data_start = len(POSED_MESH_MAGIC) + 8 + header_size
+
+            if header.get("format_version") != POSED_MESH_FORMAT_VERSION:
+                raise ValueError(f"Unsupported posed mesh version: {header.get('format_version')}")
+
+            arrays = dict()
+            for name, _ in POSED_MESH_ARRAYS:
+                spec = header["arrays"][name]
+                shape = tuple(spec["shape"])
+                if mmap and int(np.prod(shape)) > 0:
+                    arrays[name] = np.memmap(
+                        path, dtype=spec["dtype"], mode="r+" if writable else "r", offset=data_start + spec["offset"],
+                        shape=shape)
+                else:
+                    file.seek(data_start + spec["offset"])
+                    arrays[name] = np.fromfile(file, dtype=spec["dtype"], count=int(np.prod(shape))).reshape(shape)
+
+        return PosedMesh(
+            arrays["vertices"], arrays["normals"], arrays["uvs"], arrays["faces"],
+            header["material_names"], np.array(header["face_ranges"], dtype=np.int64), header["texture_map"])
+
+
+def get_posed_mesh_path(mesh_dir: Union[str, pathlib.Path]) -> Union[str, None]:
+    """
+    :param mesh_dir: output directory of Animator
+    :return: path to the posed mesh in mesh_dir, None if there is none
+    """
+    for filename in sorted(os.listdir(mesh_dir)):
+        if filename.endswith(POSED_MESH_EXTENSION):
+            return os.path.join(mesh_dir, filename)
+    return None
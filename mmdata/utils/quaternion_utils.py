@@ -151,3 +151,68 @@ def quaternion_to_euler(q):
         x = math.atan2(-rotation_matrix[2, 1], rotation_matrix[1, 1])
         z = 0.0
     return np.array([x, y, z])
+
+
+def _get_output(out, shape):
+    if out is None:
+        return np.empty(shape)
+    assert out.shape == tuple(shape)
+    return out
+
+
+def batch_slerp(x, y, t, eps=1e-5, out=None):
+    """
+    Vectorized version of slerp.
+    :param x: (..., 4)
+    :param y: (..., 4)
+    :param t: (...)
+    :param eps:
+    :param out: (..., 4) optional output buffer
+    :return: (..., 4)
+    """
+    t = np.asarray(t, dtype=np.float64)
+    s = 1 - t
+    cos = x[..., 0] * y[..., 0] + x[..., 1] * y[..., 1] + x[..., 2] * y[..., 2] + x[..., 3] * y[..., 3]
+    direction = np.where(cos >= 0.0, 1.0, -1.0)
+    sqr_sin = 1.0 - cos * cos
+
+    # slerp where the quaternions are not (nearly) parallel, lerp otherwise
+    spherical = sqr_sin > eps
+    sin = np.sqrt(np.where(spherical, sqr_sin, 1.0))
+    length = np.arctan2(sin, cos * direction)
+    s = np.where(spherical, np.sin(s * length) / sin, s)
+    t = np.where(spherical, np.sin(t * length) / sin, t)
+
+    t_direction = t * direction
+    value = _get_output(out, np.broadcast_shapes(x.shape, y.shape, s.shape + (4,)))
+    np.add(x * s[..., None], y * t_direction[..., None], out=value)
+
+    # normalize in case we just did a lerp
+    lerped = s == 1.0 - t
+    if np.any(lerped):
+        norm = np.sqrt(
+            value[..., 0] * value[..., 0] + value[..., 1] * value[..., 1] +
+            value[..., 2] * value[..., 2] + value[..., 3] * value[..., 3])
+        value[lerped] *= (1.0 / norm[lerped])[..., None]
+    return value
+
+
+def batch_multiply_quaternions(a, b, out=None):
+    """
+    Vectorized version of multiply_quaternions.
+    :param a: (..., 4)
+    :param b: (..., 4)
+    :param out: (..., 4) optional output buffer, it may be a or b
+    :return: (..., 4)
+    """
+    qax, qay, qaz, qaw = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    qbx, qby, qbz, qbw = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+    x = qax * qbw + qaw * qbx + qay * qbz - qaz * qby
+    y = qay * qbw + qaw * qby + qaz * qbx - qax * qbz
+    z = qaz * qbw + qaw * qbz + qax * qby - qay * qbx
+    w = qaw * qbw - qax * qbx - qay * qby - qaz * qbz
+
+    q = _get_output(out, np.broadcast_shapes(a.shape, b.shape))
+    q[..., 0], q[..., 1], q[..., 2], q[..., 3] = x, y, z, w
+    return q